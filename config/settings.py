@@ -14,6 +14,7 @@ from pathlib import Path
 from os import getenv
 from dotenv import load_dotenv
 from datetime import timedelta
+from celery.schedules import crontab
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -150,7 +151,7 @@ ACCOUNT_AUTHENTICATION_METHOD = "email"
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'users.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
@@ -196,3 +197,122 @@ CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60
 
 TELEGRAM_BOT_TOKEN = getenv('TELEGRAM_BOT_TOKEN')
+
+# Адрес Bot API, для тестов подменяется локальной заглушкой
+TELEGRAM_API_URL = getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+
+# Таймаут запроса и количество попыток при ответе 429
+TELEGRAM_REQUEST_TIMEOUT = 10
+TELEGRAM_MAX_ATTEMPTS = 3
+
+# Размер пула keep-alive соединений в процессе воркера
+TELEGRAM_POOL_SIZE = 10
+
+# Лимиты отправки, общие для всех воркеров: сообщений в секунду на бота и в один чат
+TELEGRAM_GLOBAL_RATE_LIMIT = 30
+TELEGRAM_CHAT_RATE_LIMIT = 1
+
+# Хранилище корзин токенов. Для тестов - main.ratelimit.MemoryTokenBucket
+TELEGRAM_RATE_LIMIT_BACKEND = 'main.ratelimit.RedisTokenBucket'
+TELEGRAM_RATE_LIMIT_LOCATION = CELERY_BROKER_URL
+
+# Режим диспетчера напоминаний: вместо PeriodicTask на каждую привычку
+# одна задача beat раз в минуту выбирает привычки к отправке. Очередь напоминаний с защитой
+# от дублей и повторами есть только в этом режиме, задачи привычек отправляют один раз без повторов.
+# Периодичность режимы понимают по-разному: задача привычки срабатывает по crontab day_of_week=*/period,
+# то есть в дни недели 0, period, 2*period... (воскресенье - 0) и заново с каждой недели, а диспетчер
+# переносит next_due_at ровно на period дней от прошлого напоминания. При period 1 режимы совпадают,
+# при переключении режима привычки с period больше 1 напоминают в другие дни
+HABIT_DISPATCHER_ENABLED = bool(getenv('HABIT_DISPATCHER_ENABLED'))
+
+# Количество привычек, которые диспетчер ставит в очередь одной транзакцией
+HABIT_DISPATCH_BATCH_SIZE = 500
+
+# Очередь напоминаний: сколько воркеров запускать каждую минуту, сколько записей
+# захватывает воркер за раз и на какое время, число попыток и пауза перед первым повтором
+HABIT_OUTBOX_WORKERS = 4
+HABIT_OUTBOX_BATCH_SIZE = 100
+HABIT_OUTBOX_LEASE = timedelta(minutes=5)
+HABIT_OUTBOX_MAX_ATTEMPTS = 5
+HABIT_OUTBOX_RETRY_BACKOFF = timedelta(seconds=30)
+# Сколько хранить отправленные и не отправленные записи очереди, удаляет задача prune_reminder_outbox
+HABIT_OUTBOX_RETENTION = timedelta(days=7)
+
+# Способ отправки воркерами очереди: sync - последовательно, async - асинхронным движком
+HABIT_DELIVERY_ENGINE = getenv('HABIT_DELIVERY_ENGINE', 'sync')
+
+# Асинхронная доставка: число одновременных запросов и начальная пауза перед повтором, сек
+HABIT_DELIVERY_CONCURRENCY = 100
+HABIT_DELIVERY_BACKOFF = 0.5
+
+# Через сколько секунд после изменения привычки синхронизировать ее задачу в beat.
+# Изменения одной привычки за это время объединяются в одну синхронизацию
+HABIT_SCHEDULE_SYNC_DELAY = 5
+# Отметку ожидающей синхронизации снимает воркер, поэтому без общего кэша (CACHE_ENABLED)
+# изменения не объединяются: отметка в памяти веб-процесса не снималась бы и глотала изменения
+HABIT_SCHEDULE_SYNC_COALESCE = CACHE_ENABLED
+
+# Размер кэша готовых напоминаний в памяти воркера. Версии записей хранятся в общем кэше,
+# поэтому без CACHE_ENABLED кэш выключен: изменения в других процессах были бы не видны
+HABIT_REMINDER_CACHE_SIZE = 10000 if CACHE_ENABLED else 0
+
+# Наибольшее количество привычек в одном запросе пакетных эндпоинтов batch/*
+HABIT_BATCH_MAX_SIZE = 100
+
+# Время жизни страниц ленты публичных привычек в кэше, сек. 0 - кэш выключен.
+# Страницы сбрасываются сменой версии при изменении публичных привычек, время жизни - страховка
+HABIT_PUBLIC_FEED_CACHE_TIMEOUT = 300 if CACHE_ENABLED else 0
+
+# Наибольшая глубина цепочки связанных привычек в эндпоинте chain/
+HABIT_CHAIN_MAX_DEPTH = 10
+
+# Количество привычек, читаемых из базы за раз при потоковой выгрузке export/ и export_habits
+HABIT_EXPORT_CHUNK_SIZE = 2000
+
+# Количество строк файла загрузки import/ и import_habits, проверяемых и записываемых за раз
+HABIT_IMPORT_CHUNK_SIZE = 1000
+# Сколько ошибок строк возвращать в отчете о загрузке, остальные только считаются
+HABIT_IMPORT_MAX_ERRORS = 100
+# Наибольший размер файла в байтах для import/: загрузка идет в запросе, большие файлы загружаются import_habits
+HABIT_IMPORT_MAX_UPLOAD_SIZE = 2 * 1024 * 1024
+
+# Размер кэша пользователей для аутентификации по JWT в памяти процесса, см. users.authentication.
+# Версии записей хранятся в общем кэше, поэтому без CACHE_ENABLED кэш выключен
+USER_AUTH_CACHE_SIZE = 10000 if CACHE_ENABLED else 0
+# Время жизни пользователя в кэше, сек.
+USER_AUTH_CACHE_TIMEOUT = 300
+
+# Массовое создание пользователей: процессов для хэширования паролей и пользователей в одной вставке
+# команды provision_users. Эндпоинт users/bulk/ хэширует пароли в процессе запроса, поэтому пачка
+# в нем небольшая, большие файлы загружаются командой
+USER_PROVISION_WORKERS = 4
+USER_PROVISION_CHUNK_SIZE = 500
+USER_PROVISION_MAX_SIZE = 20
+
+# Отметки о выполнении привычек, см. main.completions: строк в одной вставке,
+# сколько месяцев вперед создавать секции и наибольшее количество отметок в ответе completions/
+HABIT_COMPLETION_BATCH_SIZE = 1000
+HABIT_COMPLETION_PARTITIONS_AHEAD = 2
+HABIT_COMPLETION_LIST_LIMIT = 1000
+
+# Сводки выполнения привычек: окно выполнения по умолчанию и наибольшее, пачка команды rebuild_habit_stats
+HABIT_STATS_DAYS = 30
+HABIT_STATS_MAX_DAYS = 366
+HABIT_STATS_REBUILD_CHUNK_SIZE = 500
+
+CELERY_BEAT_SCHEDULE = {
+    'ensure_completion_partitions': {
+        'task': 'main.tasks.ensure_completion_partitions',
+        'schedule': crontab(minute=0, hour=3),
+    },
+}
+
+if HABIT_DISPATCHER_ENABLED:
+    CELERY_BEAT_SCHEDULE['dispatch_due_habits'] = {
+        'task': 'main.tasks.dispatch_due_habits',
+        'schedule': crontab(),
+    }
+    CELERY_BEAT_SCHEDULE['prune_reminder_outbox'] = {
+        'task': 'main.tasks.prune_reminder_outbox',
+        'schedule': crontab(minute=30, hour=3),
+    }
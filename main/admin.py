@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from main.models import UsefulHabit
+from main.models import UsefulHabit, ReminderOutbox
 
 
 @admin.register(UsefulHabit)
@@ -8,3 +8,10 @@ class ClientsAdmin(admin.ModelAdmin):
     list_display = ('id', 'title', 'owner', 'is_good', 'period')
     list_filter = ('title', 'owner')
     search_fields = ('title', 'owner')
+
+
+@admin.register(ReminderOutbox)
+class ReminderOutboxAdmin(admin.ModelAdmin):
+    list_display = ('id', 'habit', 'scheduled_for', 'status', 'attempts', 'sent_at')
+    list_filter = ('status',)
+    raw_id_fields = ('habit',)
@@ -0,0 +1,89 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import transaction
+
+from main.feed_cache import invalidate_public_feed
+from main.reminders import invalidate_habit_reminders
+from main.services import bump_habits_version
+from main.stats import refresh_habit_stats
+from main.tasks import schedule_habits_sync
+
+_pending_changes = ContextVar('pending_habit_changes', default=None)
+
+
+class HabitChanges:
+    """
+    Последствия изменения привычек: сброс кэшей напоминаний и ленты, версии привычек владельцев,
+    пересчет сводок после смены периодичности и синхронизация расписаний.
+    Для пачки привычек выполняются один раз на всю пачку.
+    """
+
+    def __init__(self):
+        self.habit_ids = set()
+        self.owner_ids = set()
+        self.public = False
+        self.schedule_ids = set()
+        self.stats_ids = set()
+
+    def apply(self):
+        self.invalidate_caches()
+        # повтор после фиксации: страницы ленты и напоминания, собранные другими процессами
+        # по данным до фиксации, не остаются в кэше под новой версией
+        transaction.on_commit(self.invalidate_caches)
+        bump_habits_version(self.owner_ids)
+        if self.stats_ids:
+            # в той же транзакции, что и изменение: сводки не бывают посчитаны по прежней периодичности
+            refresh_habit_stats(self.stats_ids)
+        if self.schedule_ids:
+            schedule_ids = list(self.schedule_ids)
+            transaction.on_commit(lambda: schedule_habits_sync(schedule_ids))
+
+    def invalidate_caches(self):
+        invalidate_habit_reminders(list(self.habit_ids))
+        if self.public:
+            invalidate_public_feed()
+
+
+def habit_changed(instance, created=False, update_fields=None):
+    """
+    Учет сохранения или удаления привычки. Вызывается сигналами и массовыми операциями, минующими сигналы.
+    Перенос next_due_at ничего не меняет: поле не выводится и не влияет на текст и расписание.
+    """
+    if update_fields is not None and set(update_fields) <= {'next_due_at'}:
+        return
+
+    pending = _pending_changes.get()
+    changes = pending or HabitChanges()
+
+    changes.habit_ids.add(instance.id)
+    changes.owner_ids.update({instance.owner_id, getattr(instance, '_loaded_owner_id', None)} - {None})
+    # если признак публичности при загрузке неизвестен, лента сбрасывается
+    was_public = False if created else getattr(instance, '_loaded_is_public', None)
+    if instance.is_public or was_public is not False:
+        changes.public = True
+    if update_fields is None or {'time', 'period'} & set(update_fields):
+        changes.schedule_ids.add(instance.id)
+    # незагруженная периодичность (.only()) не менялась
+    period = instance.__dict__.get('period')
+    if not created and period is not None and period != getattr(instance, '_loaded_period', None):
+        changes.stats_ids.add(instance.id)
+
+    instance._loaded_is_public = instance.is_public
+    instance._loaded_owner_id = instance.owner_id
+    instance._loaded_period = period
+
+    if pending is None:
+        changes.apply()
+
+
+@contextmanager
+def deferred_habit_changes():
+    """Последствия всех изменений привычек внутри блока выполняются один раз при выходе из него"""
+    changes = HabitChanges()
+    token = _pending_changes.set(changes)
+    try:
+        yield changes
+    finally:
+        _pending_changes.reset(token)
+    changes.apply()
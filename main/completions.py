@@ -0,0 +1,130 @@
+import re
+import threading
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from main.models import HabitCompletion
+from main.stats import update_habit_stats
+
+PARTITION_PREFIX = f'{HabitCompletion._meta.db_table}_p'
+PARTITION_NAME = re.compile(rf'^{PARTITION_PREFIX}(\d{{4}})(\d{{2}})$')
+
+
+def month_start(value):
+    """Начало месяца в UTC: границы секций не зависят от часового пояса проекта"""
+    value = value.astimezone(dt_timezone.utc)
+    return datetime(value.year, value.month, 1, tzinfo=dt_timezone.utc)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month):
+    return f'{PARTITION_PREFIX}{month:%Y%m}'
+
+
+class CompletionPartitions:
+    """Известные процессу секции: проверка перед каждой вставкой не обращается к базе"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._months = set()
+
+    def ensure(self, months):
+        """Создание недостающих секций месяцев. Параллельные процессы создают секции под advisory lock."""
+        with self._lock:
+            missing = sorted(set(months) - self._months)
+        if not missing:
+            return
+
+        table = connection.ops.quote_name(HabitCompletion._meta.db_table)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', [HabitCompletion._meta.db_table])
+            for month in missing:
+                cursor.execute(
+                    f'CREATE TABLE IF NOT EXISTS {connection.ops.quote_name(partition_name(month))} '
+                    f'PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)',
+                    [month, add_months(month, 1)],
+                )
+            # секции, созданные в откаченной транзакции, процесс не запоминает
+            transaction.on_commit(lambda: self.remember(missing))
+
+    def remember(self, months):
+        with self._lock:
+            self._months.update(months)
+
+    def discard(self, months):
+        with self._lock:
+            self._months.difference_update(months)
+
+    def clear(self):
+        with self._lock:
+            self._months.clear()
+
+
+completion_partitions = CompletionPartitions()
+
+
+def list_completion_partitions():
+    """Месяцы существующих секций по возрастанию"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE pg_inherits.inhparent = %s::regclass',
+            [HabitCompletion._meta.db_table],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    return sorted(datetime(int(match[1]), int(match[2]), 1, tzinfo=dt_timezone.utc)
+                  for match in map(PARTITION_NAME.match, names) if match)
+
+
+def ensure_completion_partitions(now=None, ahead=None, since=None):
+    """
+    Секции текущего месяца и ahead следующих, чтобы вставки не ждали создания секции.
+    :param since: также создать секции прошлых месяцев с этого, например для загрузки истории.
+    """
+    ahead = settings.HABIT_COMPLETION_PARTITIONS_AHEAD if ahead is None else ahead
+    current = month_start(now or datetime.now(dt_timezone.utc))
+    first = min(month_start(since), current) if since else current
+    months = []
+    while (month := add_months(first, len(months))) <= add_months(current, ahead):
+        months.append(month)
+    completion_partitions.ensure(months)
+    return months
+
+
+def drop_completion_partitions(before, dry_run=False):
+    """
+    Удаление секций месяцев раньше before целиком: DROP TABLE без построчного DELETE и очистки таблицы.
+    :return: месяцы удаленных секций.
+    """
+    months = [month for month in list_completion_partitions() if month < month_start(before)]
+    if not dry_run and months:
+        with transaction.atomic(), connection.cursor() as cursor:
+            for month in months:
+                cursor.execute(f'DROP TABLE {connection.ops.quote_name(partition_name(month))}')
+        completion_partitions.discard(months)
+    return months
+
+
+def record_habit_completions(completions):
+    """
+    Добавление отметок о выполнении пачками по HABIT_COMPLETION_BATCH_SIZE. Сводки привычек обновляются
+    в той же транзакции. Секции месяцев отметок должны уже существовать: по данным запросов они не создаются,
+    см. ensure_completion_partitions.
+    :param completions: несохраненные HabitCompletion с habit_id, user_id и completed_at.
+    """
+    completions = list(completions)
+    if not completions:
+        return completions
+
+    with transaction.atomic():
+        completions = HabitCompletion.objects.bulk_create(completions,
+                                                          batch_size=settings.HABIT_COMPLETION_BATCH_SIZE)
+        update_habit_stats(completions)
+    return completions
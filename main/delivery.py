@@ -0,0 +1,156 @@
+import asyncio
+import math
+import time
+from collections import namedtuple
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+from django.conf import settings
+
+from main.ratelimit import get_token_bucket, telegram_buckets
+from main.services import digest_reminder_text
+
+# id - идентификатор привычки или записи очереди, по нему строится отчет о доставке
+Reminder = namedtuple('Reminder', 'id chat_id text')
+
+
+def outbox_reminder(entry, reminders, digest_habits):
+    """
+    Напоминание по записи очереди.
+    :param reminders: напоминания по привычкам, см. load_habit_reminders.
+    :param digest_habits: привычки сводок по идентификатору, см. load_digest_habits.
+    """
+    reminder = reminders[entry.habit_id]
+    text = reminder.text
+    if entry.digest_habit_ids:
+        text = digest_reminder_text([digest_habits[habit_id] for habit_id in entry.digest_habit_ids
+                                     if habit_id in digest_habits])
+    return Reminder(entry.id, reminder.chat_id, text)
+
+
+def percentile(values, percent):
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(len(values) * percent / 100) - 1, 0)]
+
+
+class DeliveryStats:
+    """Счетчики доставки: пропускная способность и задержки запросов, в том числе неудачных попыток"""
+
+    def __init__(self):
+        self.sent = []
+        self.failed = []
+        self.errors = {}
+        self.latencies = []
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def report(self):
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        return {
+            'sent': len(self.sent),
+            'failed': len(self.failed),
+            'elapsed': round(elapsed, 3),
+            'throughput': round(len(self.sent) / elapsed, 1) if elapsed else None,
+            'p50': percentile(self.latencies, 50),
+            'p95': percentile(self.latencies, 95),
+            'p99': percentile(self.latencies, 99),
+        }
+
+
+class DeliveryEngine:
+    """
+    Асинхронная доставка напоминаний в телеграм.
+    Поток напоминаний разбирают concurrency корутин через одно пуловое соединение,
+    у каждого запроса свой таймаут, неудачные запросы повторяются с экспоненциальной паузой.
+    """
+
+    def __init__(self, concurrency=None, timeout=None, max_attempts=None, backoff=None, rate_limit=True):
+        self.concurrency = concurrency or settings.HABIT_DELIVERY_CONCURRENCY
+        self.timeout = timeout or settings.TELEGRAM_REQUEST_TIMEOUT
+        self.max_attempts = max_attempts or settings.TELEGRAM_MAX_ATTEMPTS
+        self.backoff = settings.HABIT_DELIVERY_BACKOFF if backoff is None else backoff
+        self.rate_limit = rate_limit
+        self.url = f'{settings.TELEGRAM_API_URL}/bot{settings.TELEGRAM_BOT_TOKEN}/sendMessage'
+
+    def run(self, reminders):
+        """Синхронная обертка для задач Celery и команд"""
+        return asyncio.run(self.deliver(reminders))
+
+    async def deliver(self, reminders):
+        """
+        :param reminders: итератор Reminder, читается по мере освобождения корутин.
+            Итератор не должен обращаться к базе: ORM Django не работает внутри цикла событий.
+        :return: DeliveryStats
+        """
+        stats = DeliveryStats()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        connector = TCPConnector(limit=self.concurrency)
+
+        async with ClientSession(connector=connector) as session:
+            try:
+                # падение корутины отменяет остальные и заполнение очереди: иначе оно ждало бы места вечно
+                async with asyncio.TaskGroup() as group:
+                    for _ in range(self.concurrency):
+                        group.create_task(self._worker(session, queue, stats))
+                    group.create_task(self._produce(reminders, queue))
+            except ExceptionGroup as exc:
+                raise exc.exceptions[0]
+
+        stats.finished = time.perf_counter()
+        return stats
+
+    async def _produce(self, reminders, queue):
+        for reminder in reminders:
+            await queue.put(reminder)
+        for _ in range(self.concurrency):
+            await queue.put(None)
+
+    async def _worker(self, session, queue, stats):
+        while (reminder := await queue.get()) is not None:
+            error = await self._send(session, reminder, stats)
+            if error is None:
+                stats.sent.append(reminder.id)
+            else:
+                stats.failed.append(reminder.id)
+                stats.errors[reminder.id] = error
+
+    async def _wait_rate_limit(self, chat_id):
+        token_bucket = get_token_bucket()
+        buckets = telegram_buckets(chat_id)
+        while wait := await asyncio.to_thread(token_bucket.reserve, buckets):
+            await asyncio.sleep(wait)
+
+    async def _send(self, session, reminder, stats):
+        """Отправка с повторами. :return: None при успехе, иначе текст последней ошибки."""
+        error = None
+        for attempt in range(self.max_attempts):
+            if self.rate_limit:
+                await self._wait_rate_limit(reminder.chat_id)
+
+            started = time.perf_counter()
+            retry_after = None
+            try:
+                async with session.post(self.url, data={'chat_id': reminder.chat_id, 'text': reminder.text},
+                                        timeout=ClientTimeout(total=self.timeout)) as response:
+                    if response.status == 429:
+                        error = 'Too Many Requests'
+                        payload = await response.json()
+                        retry_after = payload.get('parameters', {}).get('retry_after', 1)
+                    else:
+                        response.raise_for_status()
+                        await response.read()
+            except (ClientError, asyncio.TimeoutError) as exc:
+                error = repr(exc)
+                retry_after = self.backoff * 2 ** attempt
+            finally:
+                # задержка каждой попытки, а не только удачной
+                stats.latencies.append(round(time.perf_counter() - started, 4))
+
+            if retry_after is None:
+                return None
+            # после последней попытки ждать нечего, в том числе retry_after ответа 429
+            if attempt < self.max_attempts - 1:
+                await asyncio.sleep(retry_after)
+        return error
@@ -0,0 +1,48 @@
+from hashlib import md5
+
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+
+def habit_list_etag(request):
+    """
+    ETag списка привычек пользователя: версия его привычек и параметры страницы.
+    Версия приходит вместе с пользователем при аутентификации, запросов к базе нет.
+    """
+    query = md5(request.get_full_path().encode()).hexdigest()[:16]
+    return quote_etag(f'{request.user.id}-{request.user.habits_version}-{query}')
+
+
+def habit_etag(habit_id, updated_at, fields=None):
+    """ETag одной привычки по времени ее изменения и набору выводимых полей"""
+    variant = '' if fields is None else '-' + md5(','.join(fields).encode()).hexdigest()[:8]
+    return quote_etag(f'{habit_id}-{updated_at.timestamp()}{variant}')
+
+
+def is_not_modified(request, etag, last_modified=None):
+    """
+    Проверка условного GET: совпадение If-None-Match,
+    а без него - If-Modified-Since не раньше времени изменения.
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return '*' in etags or etag in etags
+
+    if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    return (last_modified is not None and if_modified_since is not None
+            and int(last_modified.timestamp()) <= if_modified_since)
+
+
+def not_modified_response(etag, last_modified=None):
+    response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag, last_modified=None):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
@@ -0,0 +1,37 @@
+import csv
+import json
+
+from main.serializers import HabitRowSerializer
+
+EXPORT_FORMATS = {
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+
+class LineBuffer:
+    """Буфер для csv.writer, который сразу отдает записанную строку"""
+
+    def write(self, value):
+        return value
+
+
+def export_habit_lines(queryset, file_format, chunk_size, field_names=None):
+    """
+    Выгрузка привычек построчно в JSONL или CSV. Строки читаются серверным курсором пачками по chunk_size
+    и выводятся HabitRowSerializer, поэтому память не растет с количеством привычек,
+    а значения совпадают с ответами API.
+    """
+    serializer = HabitRowSerializer(field_names)
+    rows = serializer.iter_representation(serializer.values(queryset.order_by('id')).iterator(chunk_size=chunk_size))
+
+    if file_format == 'jsonl':
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False, separators=(',', ':')) + '\n'
+        return
+
+    writer = csv.writer(LineBuffer())
+    names = [name for name, _, _ in serializer.columns]
+    yield writer.writerow(names)
+    for row in rows:
+        yield writer.writerow(['' if row[name] is None else row[name] for name in names])
@@ -0,0 +1,97 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    """Отвечает на sendMessage как Bot API, соединение держит открытым"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        data = dict(parse_qsl(body))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        with self.server.lock:
+            failed = self.server.fail_first > 0
+            if failed:
+                self.server.fail_first -= 1
+            else:
+                self.server.messages.append({'path': self.path, **data})
+
+        if failed and self.server.retry_after is not None:
+            payload = json.dumps({'ok': False, 'error_code': 429,
+                                  'parameters': {'retry_after': self.server.retry_after}})
+            self.send_response(429)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload.encode())))
+            self.end_headers()
+            self.wfile.write(payload.encode())
+            return
+        if failed:
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        payload = json.dumps({'ok': True, 'result': {'chat': {'id': data.get('chat_id')}, 'text': data.get('text')}})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload.encode())))
+        self.end_headers()
+        self.wfile.write(payload.encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTelegramHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeTelegramServer:
+    """
+    Локальная заглушка Bot API телеграма для тестов и замеров без выхода в сеть.
+    Адрес подставляется в TELEGRAM_API_URL.
+    """
+
+    def __init__(self, delay=0, fail_first=0, retry_after=None):
+        """
+        :param delay: задержка ответа в секундах, имитирует сеть.
+        :param fail_first: сколько первых запросов завершить ошибкой 500.
+        :param retry_after: если задан, первые запросы завершаются ошибкой 429 с этой паузой в секундах.
+        """
+        self.server = FakeTelegramHTTPServer(('127.0.0.1', 0), FakeTelegramHandler)
+        self.server.lock = threading.Lock()
+        self.server.delay = delay
+        self.server.fail_first = fail_first
+        self.server.retry_after = retry_after
+        self.server.messages = []
+        self.server.connections = 0
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    @property
+    def messages(self):
+        return self.server.messages
+
+    @property
+    def connections(self):
+        return self.server.connections
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
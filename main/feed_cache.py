@@ -0,0 +1,62 @@
+from hashlib import md5
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+
+PUBLIC_FEED_VERSION_KEY = 'public-feed:version'
+PUBLIC_FEED_HITS_KEY = 'public-feed:hits'
+PUBLIC_FEED_MISSES_KEY = 'public-feed:misses'
+
+
+def public_feed_version():
+    """Текущая версия ленты. После вытеснения ключа начинается новая версия, старые страницы не читаются."""
+    version = cache.get(PUBLIC_FEED_VERSION_KEY)
+    if version is None:
+        cache.add(PUBLIC_FEED_VERSION_KEY, uuid4().hex, timeout=None)
+        version = cache.get(PUBLIC_FEED_VERSION_KEY)
+    return version
+
+
+def public_feed_key(request):
+    """Ключ страницы ленты: версия, адрес и параметры запроса. Лента одна для всех пользователей."""
+    url = md5(f'{request.get_host()}{request.get_full_path()}'.encode()).hexdigest()
+    return f'public-feed:{public_feed_version()}:{url}'
+
+
+def get_public_feed_page(key):
+    data = cache.get(key)
+    count_public_feed(PUBLIC_FEED_MISSES_KEY if data is None else PUBLIC_FEED_HITS_KEY)
+    return data
+
+
+def set_public_feed_page(key, data):
+    cache.set(key, data, timeout=settings.HABIT_PUBLIC_FEED_CACHE_TIMEOUT)
+
+
+def invalidate_public_feed():
+    """Сброс всех страниц ленты сменой версии"""
+    if settings.HABIT_PUBLIC_FEED_CACHE_TIMEOUT:
+        cache.set(PUBLIC_FEED_VERSION_KEY, uuid4().hex, timeout=None)
+
+
+def count_public_feed(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # счетчика еще нет
+        cache.add(key, 1, timeout=None)
+
+
+def public_feed_stats(reset=False):
+    """Счетчики попаданий и промахов кэша ленты общие для всех процессов"""
+    counters = cache.get_many([PUBLIC_FEED_HITS_KEY, PUBLIC_FEED_MISSES_KEY])
+    hits = counters.get(PUBLIC_FEED_HITS_KEY, 0)
+    misses = counters.get(PUBLIC_FEED_MISSES_KEY, 0)
+    if reset:
+        cache.delete_many([PUBLIC_FEED_HITS_KEY, PUBLIC_FEED_MISSES_KEY])
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': round(hits / (hits + misses), 3) if hits + misses else None,
+    }
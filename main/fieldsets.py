@@ -0,0 +1,50 @@
+from functools import lru_cache
+
+from rest_framework.exceptions import ValidationError
+
+from main.models import UsefulHabit
+
+FIELDS_QUERY_PARAM = 'fields'
+EXCLUDE_QUERY_PARAM = 'exclude'
+
+
+@lru_cache(maxsize=None)
+def habit_read_fields():
+    """Поля, которые можно запросить: все выводимые поля UsefulHabitSerializer в порядке вывода"""
+    from main.serializers import UsefulHabitSerializer
+    return tuple(name for name, field in UsefulHabitSerializer().fields.items() if not field.write_only)
+
+
+def parse_field_list(request, param):
+    value = request.query_params.get(param)
+    if value is None:
+        return None
+
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in names if name not in habit_read_fields()]
+    if unknown:
+        raise ValidationError({param: [f'Неизвестные поля: {", ".join(unknown)}. '
+                                       f'Доступны: {", ".join(habit_read_fields())}.']})
+    return set(names)
+
+
+def get_habit_fields(request):
+    """
+    Поля ответа по параметрам fields и exclude, например ?fields=title,time или ?exclude=owner,award.
+    :return: кортеж полей в порядке вывода или None, если выводятся все поля.
+    """
+    fields = parse_field_list(request, FIELDS_QUERY_PARAM)
+    exclude = parse_field_list(request, EXCLUDE_QUERY_PARAM)
+    if fields is None and exclude is None:
+        return None
+
+    names = tuple(name for name in habit_read_fields()
+                  if (fields is None or name in fields) and (exclude is None or name not in exclude))
+    if not names:
+        raise ValidationError({FIELDS_QUERY_PARAM: ['Не выбрано ни одного поля.']})
+    return names
+
+
+def habit_columns(field_names):
+    """Столбцы модели для полей ответа, для .only() и .values()"""
+    return [UsefulHabit._meta.get_field(name).attname for name in field_names]
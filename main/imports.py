@@ -0,0 +1,187 @@
+import csv
+import json
+import time
+from collections import defaultdict
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django_celery_beat.models import PeriodicTasks
+
+from main.feed_cache import invalidate_public_feed
+from main.models import UsefulHabit
+from main.serializers import UsefulHabitSerializer
+from main.services import bump_habits_version, sync_habit_periodic_tasks
+
+IMPORT_FORMATS = ('jsonl', 'csv')
+INVALID_ROW_MESSAGE = 'Строка не является объектом JSON'
+UNRESOLVED_RELATED_HABIT_MESSAGE = 'Связанная привычка не найдена среди приятных привычек файла'
+
+
+def parse_jsonl(lines):
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield row if isinstance(row, dict) else None
+
+
+def read_habit_rows(lines, file_format):
+    """
+    Записи файла загрузки по одной, файл не читается целиком. Пустые ячейки CSV считаются null.
+    :param lines: итератор текстовых строк файла.
+    :return: пары (номер записи с 1, данные привычки или None для нечитаемой строки).
+    """
+    if file_format == 'jsonl':
+        rows = parse_jsonl(lines)
+    else:
+        rows = ({name: value or None for name, value in row.items()} for row in csv.DictReader(lines))
+    return enumerate(rows, start=1)
+
+
+class HabitImport:
+    """
+    Загрузка привычек Владельца пачками: строки пачки проверяются сериализатором привычек разом,
+    записываются одним bulk_create, задачи напоминаний создаются массово в той же транзакции.
+    related_habit в файле - id другой строки файла. Ссылка на строку ниже по файлу ждет ее загрузки,
+    в памяти держатся только такие строки и соответствие id файла созданным приятным привычкам.
+    Состояние сохраняется в транзакции каждой пачки, загрузку можно продолжить с этого места, см. import_habits.
+    """
+
+    def __init__(self, owner, chunk_size=None, state=None):
+        self.owner = owner
+        self.chunk_size = chunk_size or settings.HABIT_IMPORT_CHUNK_SIZE
+        state = state or {}
+        self.rows = state.get('rows', 0)
+        self.imported = state.get('imported', 0)
+        self.failed = state.get('failed', 0)
+        self.errors = state.get('errors', [])
+        self.elapsed = state.get('elapsed', 0.0)
+        # id строки файла -> id созданной приятной привычки
+        self.good_ids = state.get('good_ids', {})
+        # id строки файла, на которую ссылаются -> [номер записи, id строки, данные] ждущих ее строк
+        self.pending = defaultdict(list, state.get('pending', {}))
+
+    @property
+    def state(self):
+        return {
+            'rows': self.rows, 'imported': self.imported, 'failed': self.failed, 'errors': self.errors,
+            'elapsed': self.elapsed, 'good_ids': self.good_ids, 'pending': self.pending,
+        }
+
+    def report(self):
+        return {
+            'rows': self.rows,
+            'imported': self.imported,
+            'failed': self.failed,
+            'errors': self.errors,
+            'elapsed': round(self.elapsed, 3),
+            'rows_per_second': round(self.rows / self.elapsed) if self.elapsed else None,
+        }
+
+    def run(self, rows, checkpoint=None, progress=None):
+        """
+        :param rows: пары из read_habit_rows. Записи, загруженные до сохраненного состояния, пропускаются.
+        :param checkpoint: вызывается с загрузкой в транзакции записи каждой пачки: состояние сохраняется
+            вместе с пачкой, ошибка сохранения откатывает пачку.
+        :param progress: вызывается с загрузкой после фиксации каждой пачки.
+        """
+        rows = islice(rows, self.rows, None)
+        started = time.perf_counter() - self.elapsed
+        while chunk := list(islice(rows, self.chunk_size)):
+            with transaction.atomic():
+                tasks_created = self.import_chunk(chunk)
+                self.rows = chunk[-1][0]
+                self.elapsed = time.perf_counter() - started
+                if checkpoint is not None:
+                    checkpoint(self)
+            if tasks_created:
+                PeriodicTasks.update_changed()
+            if progress is not None:
+                progress(self)
+
+        # ссылки, которые так и не нашлись
+        for waiting in self.pending.values():
+            for number, _, _ in waiting:
+                self.add_error(number, {'related_habit': [UNRESOLVED_RELATED_HABIT_MESSAGE]})
+        self.pending.clear()
+        return self
+
+    def import_chunk(self, chunk):
+        """
+        Запись пачки, вызывается в транзакции.
+        :return: созданы ли задачи напоминаний.
+        """
+        ready = []
+        for number, row in chunk:
+            if row is None:
+                self.add_error(number, {'non_field_errors': [INVALID_ROW_MESSAGE]})
+            else:
+                self.route(number, row, ready)
+
+        # созданные приятные привычки освобождают строки, ждущие их, в том числе из этой же пачки
+        created = []
+        while ready:
+            habits = self.create(ready)
+            created.extend(habit for _, habit in habits)
+            ready = []
+            for (_, source_id, _), habit in habits:
+                if habit.is_good and source_id is not None:
+                    self.good_ids[str(source_id)] = habit.id
+                    for waiting in self.pending.pop(str(source_id), ()):
+                        waiting[2]['related_habit'] = habit.id
+                        ready.append(waiting)
+
+        if not created:
+            return False
+        tasks_created = sync_habit_periodic_tasks(created)[0]
+        bump_habits_version([self.owner.id])
+        if any(habit.is_public for habit in created):
+            invalidate_public_feed()
+        return bool(tasks_created)
+
+    def route(self, number, row, ready):
+        """Строка со ссылкой на еще не созданную привычку откладывается до ее создания"""
+        row = dict(row)
+        source_id = row.pop('id', None)
+        row.pop('owner', None)
+        related = row.get('related_habit')
+        if related is not None:
+            if str(related) not in self.good_ids:
+                self.pending[str(related)].append([number, source_id, row])
+                return
+            row['related_habit'] = self.good_ids[str(related)]
+        ready.append([number, source_id, row])
+
+    def create(self, items):
+        """
+        Проверка строк пачкой и одна вставка прошедших проверку.
+        :return: пары (строка, созданная привычка).
+        """
+        serializer = UsefulHabitSerializer(data=[row for _, _, row in items], many=True, context={'owner': self.owner})
+        while items and not serializer.is_valid():
+            valid = []
+            for item, errors in zip(items, serializer.errors):
+                if errors:
+                    self.add_error(item[0], errors)
+                else:
+                    valid.append(item)
+            items = valid
+            serializer = UsefulHabitSerializer(data=[row for _, _, row in items], many=True,
+                                               context={'owner': self.owner})
+        if not items:
+            return []
+
+        habits = UsefulHabit.objects.bulk_create(
+            UsefulHabit(**attrs, owner=self.owner) for attrs in serializer.validated_data
+        )
+        self.imported += len(habits)
+        return list(zip(items, habits))
+
+    def add_error(self, number, errors):
+        self.failed += 1
+        if len(self.errors) < settings.HABIT_IMPORT_MAX_ERRORS:
+            self.errors.append({'row': number, 'errors': json.loads(json.dumps(errors))})
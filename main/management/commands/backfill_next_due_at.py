@@ -0,0 +1,36 @@
+from django.core.management import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from main.models import UsefulHabit
+
+
+class Command(BaseCommand):
+    """Пересчет времени следующего напоминания у существующих привычек"""
+    help = 'Заполняет next_due_at у привычек, где оно не задано или уже прошло'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='пересчитать все привычки')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='размер пачки обновления')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        habits = UsefulHabit.objects.only('id', 'time', 'period', 'next_due_at').order_by('id')
+        if not options['all']:
+            habits = habits.filter(Q(next_due_at__isnull=True) | Q(next_due_at__lt=now))
+
+        updated = 0
+        last_id = 0
+        while True:
+            chunk = list(habits.filter(id__gt=last_id)[:options['chunk_size']])
+            if not chunk:
+                break
+
+            for habit in chunk:
+                habit.refresh_next_due_at(now)
+            UsefulHabit.objects.bulk_update(chunk, ['next_due_at'])
+
+            updated += len(chunk)
+            last_id = chunk[-1].id
+
+        self.stdout.write(self.style.SUCCESS(f'Обновлено привычек: {updated}'))
@@ -0,0 +1,57 @@
+import time
+
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from users.models import User
+
+
+class Command(BaseCommand):
+    """Замер создания привычек: N запросов create/ против одного запроса batch/create/"""
+    help = 'Сравнивает создание привычек по одной и пачкой. Все изменения откатываются.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=30, help='количество привычек')
+        parser.add_argument('--repeat', type=int, default=5, help='количество повторов замера')
+
+    def handle(self, *args, **options):
+        habits = [{'title': f'Привычка {i}', 'location': 'Дом', 'action': 'Зарядка', 'is_good': False,
+                   'period': i % 7 + 1, 'time_to_complete': 60, 'time': f'{i % 24:02}:{i % 60:02}'}
+                  for i in range(options['count'])]
+
+        results = {'create/': [], 'batch/create/': []}
+        with override_settings(ALLOWED_HOSTS=['*']):
+            for _ in range(options['repeat']):
+                results['create/'].append(self.measure(lambda client: [
+                    client.post('/create/', data=habit, format='json') for habit in habits
+                ]))
+                results['batch/create/'].append(self.measure(lambda client: [
+                    client.post('/batch/create/', data=habits, format='json')
+                ]))
+
+        self.stdout.write(f'{"способ":<16}{"привычек":>10}{"запросов":>10}{"к базе":>10}{"мс":>10}{"прив/с":>10}')
+        for name, runs in results.items():
+            queries, elapsed = min(runs, key=lambda run: run[1])
+            requests = options['count'] if name == 'create/' else 1
+            self.stdout.write(f'{name:<16}{options["count"]:>10}{requests:>10}{queries:>10}'
+                              f'{elapsed * 1000:>10.1f}{options["count"] / elapsed:>10.0f}')
+
+    @staticmethod
+    def measure(run):
+        """Запуск на временном пользователе в транзакции, которая откатывается вместе с задачами расписаний"""
+        with transaction.atomic():
+            user = User.objects.create(email='bench-batch@test.ru', chat_id=-1)
+            client = APIClient()
+            client.force_authenticate(user=user)
+
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                responses = run(client)
+                elapsed = time.perf_counter() - started
+
+            assert all(response.status_code == 201 for response in responses), responses[0].content
+            transaction.set_rollback(True)
+        return len(queries), elapsed
@@ -0,0 +1,54 @@
+import time
+
+from django.core.management import BaseCommand
+from django.test import override_settings
+from requests import post
+
+from main.delivery import DeliveryEngine, DeliveryStats, Reminder
+from main.fake_telegram import FakeTelegramServer
+from main.telegram import send_message
+
+
+class Command(BaseCommand):
+    """Замер доставки напоминаний на локальной заглушке телеграма"""
+    help = 'Сравнивает последовательную отправку send_message_bot с асинхронным движком доставки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=200, help='количество напоминаний')
+        parser.add_argument('--latency', type=float, default=0.05, help='задержка ответа заглушки, сек')
+        parser.add_argument('--concurrency', type=int, default=100, help='одновременных запросов движка')
+
+    def handle(self, *args, **options):
+        reminders = [Reminder(i, 100000 + i, f'Напоминание {i}') for i in range(options['count'])]
+        unlimited = 10 ** 9
+
+        with FakeTelegramServer(delay=options['latency']) as server, override_settings(
+                TELEGRAM_API_URL=server.url, TELEGRAM_BOT_TOKEN='bench',
+                TELEGRAM_RATE_LIMIT_BACKEND='main.ratelimit.MemoryTokenBucket',
+                TELEGRAM_RATE_LIMIT_LOCATION='bench',
+                TELEGRAM_GLOBAL_RATE_LIMIT=unlimited, TELEGRAM_CHAT_RATE_LIMIT=unlimited):
+            url = f'{server.url}/botbench/sendMessage'
+
+            results = {
+                'requests.post': self.run_sync(reminders, lambda r: post(
+                    url=url, data={'chat_id': r.chat_id, 'text': r.text})),
+                'send_message_bot': self.run_sync(reminders, lambda r: send_message(r.chat_id, r.text)),
+                'async': DeliveryEngine(concurrency=options['concurrency'], rate_limit=False).run(reminders).report(),
+            }
+
+        self.stdout.write(f'{"способ":<18}{"отпр.":>7}{"сек":>9}{"сообщ/с":>10}{"p50":>9}{"p95":>9}{"p99":>9}')
+        for name, report in results.items():
+            self.stdout.write(f'{name:<18}{report["sent"]:>7}{report["elapsed"]:>9}{report["throughput"]:>10}'
+                              f'{report["p50"]:>9}{report["p95"]:>9}{report["p99"]:>9}')
+
+    @staticmethod
+    def run_sync(reminders, send):
+        """Последовательная отправка, как в задаче send_message_bot"""
+        stats = DeliveryStats()
+        for reminder in reminders:
+            started = time.perf_counter()
+            send(reminder)
+            stats.latencies.append(round(time.perf_counter() - started, 4))
+            stats.sent.append(reminder.id)
+        stats.finished = time.perf_counter()
+        return stats.report()
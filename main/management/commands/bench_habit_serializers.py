@@ -0,0 +1,55 @@
+import time
+from datetime import timedelta
+
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+from rest_framework.renderers import JSONRenderer
+
+from main.models import UsefulHabit
+from main.serializers import UsefulHabitSerializer, HabitRowSerializer
+from users.models import User
+
+
+class Command(BaseCommand):
+    """Замер вывода списка привычек: UsefulHabitSerializer против быстрого пути HabitRowSerializer"""
+    help = 'Сравнивает загрузку и вывод в JSON N привычек двумя сериализаторами. Все изменения откатываются.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[20, 1000, 10000], help='количество привычек')
+        parser.add_argument('--repeat', type=int, default=5, help='количество повторов замера')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{"строк":>8}{"serializer, мс":>18}{"values, мс":>14}{"ускорение":>12}')
+        with transaction.atomic():
+            user = User.objects.create(email='bench-serializers@test.ru', chat_id=-1)
+            UsefulHabit.objects.bulk_create(
+                UsefulHabit(title=f'Привычка {i:05}', location='Дом', action='Зарядка', owner=user, period=i % 7 + 1,
+                            award=None if i % 2 else 'Кино', time_to_complete=timedelta(seconds=i % 120))
+                for i in range(max(options['rows']))
+            )
+            # статистика по новым строкам, чтобы план запроса был как на рабочей базе
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE main_usefulhabit')
+
+            for rows in options['rows']:
+                queryset = UsefulHabit.objects.filter(owner=user).order_by('title', 'id')[:rows]
+                full = self.measure(options['repeat'], lambda: UsefulHabitSerializer(queryset.all(), many=True).data)
+                fast = self.measure(options['repeat'], lambda: self.fast_path(queryset))
+                self.stdout.write(f'{rows:>8}{full * 1000:>18.2f}{fast * 1000:>14.2f}{full / fast:>11.1f}x')
+
+            transaction.set_rollback(True)
+
+    @staticmethod
+    def fast_path(queryset):
+        serializer = HabitRowSerializer()
+        return serializer.to_representation(serializer.values(queryset))
+
+    @staticmethod
+    def measure(repeat, serialize):
+        """Лучшее время загрузки страницы и вывода ее в JSON"""
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            JSONRenderer().render(serialize())
+            timings.append(time.perf_counter() - started)
+        return min(timings)
@@ -0,0 +1,36 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.utils import timezone
+
+from main.delivery import DeliveryEngine
+from main.services import enqueue_due_reminders
+from main.tasks import drain_outbox
+
+
+class Command(BaseCommand):
+    """Отдельный процесс асинхронной доставки напоминаний"""
+    help = ('Раз в минуту ставит напоминания этой минуты в очередь и разбирает ее асинхронным движком. '
+            'Запускается вместо диспетчера Celery, а не вместе с ним.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='обработать текущую минуту и выйти')
+        parser.add_argument('--concurrency', type=int, default=settings.HABIT_DELIVERY_CONCURRENCY,
+                            help='число одновременных запросов')
+
+    def handle(self, *args, **options):
+        engine = DeliveryEngine(concurrency=options['concurrency'])
+
+        while True:
+            # минута берется по текущему времени: минуты, пропущенные за долгий разбор очереди,
+            # подбирает сама выборка, она ставит в очередь и просроченные привычки, см. get_due_habits
+            slot = timezone.localtime().replace(second=0, microsecond=0)
+            due = enqueue_due_reminders(slot)
+            sent = drain_outbox(engine.run)
+            self.stdout.write(f'{slot:%H:%M} привычек: {due}, отправлено: {sent}')
+
+            if options['once']:
+                break
+            time.sleep(max((slot + timedelta(minutes=1) - timezone.now()).total_seconds(), 0))
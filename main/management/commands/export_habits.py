@@ -0,0 +1,61 @@
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from main.exports import EXPORT_FORMATS, export_habit_lines
+from main.fieldsets import habit_read_fields
+from main.models import UsefulHabit
+from users.models import User
+
+
+class Command(BaseCommand):
+    """Потоковая выгрузка привычек в JSONL или CSV: всех или одного Владельца"""
+    help = 'Выгружает привычки построчно в файл или в stdout, память не растет с количеством привычек'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='jsonl', help='формат файла')
+        parser.add_argument('--owner', help='id или email Владельца, без него выгружаются все привычки')
+        parser.add_argument('--output', help='файл выгрузки, без него - stdout')
+        parser.add_argument('--fields', help='выгружаемые поля через запятую')
+        parser.add_argument('--chunk-size', type=int, default=settings.HABIT_EXPORT_CHUNK_SIZE,
+                            help='сколько привычек читать из базы за раз')
+
+    def handle(self, *args, **options):
+        queryset = UsefulHabit.objects.all()
+        if options['owner']:
+            lookup = {'id': options['owner']} if options['owner'].isdigit() else {'email': options['owner']}
+            owner = User.objects.filter(**lookup).first()
+            if owner is None:
+                raise CommandError(f'Пользователь {options["owner"]} не найден')
+            queryset = queryset.filter(owner=owner)
+
+        field_names = None
+        if options['fields']:
+            requested = {name.strip() for name in options['fields'].split(',')}
+            unknown = requested - set(habit_read_fields())
+            if unknown:
+                raise CommandError(f'Неизвестные поля: {", ".join(sorted(unknown))}')
+            field_names = [name for name in habit_read_fields() if name in requested]
+
+        lines = export_habit_lines(queryset, options['format'], options['chunk_size'], field_names)
+        started = time.perf_counter()
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                count = self.write(lines, output.write)
+        else:
+            # строки уже с переводом строки, OutputWrapper свой не добавляет
+            count = self.write(lines, lambda line: self.stdout.write(line, ending=''))
+
+        # заголовок CSV не привычка
+        count -= options['format'] == 'csv'
+        elapsed = time.perf_counter() - started
+        self.stderr.write(f'Выгружено привычек: {count} за {elapsed:.1f} с, {count / max(elapsed, 1e-9):.0f} в секунду')
+
+    @staticmethod
+    def write(lines, write):
+        count = 0
+        for line in lines:
+            write(line)
+            count += 1
+        return count
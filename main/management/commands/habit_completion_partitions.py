@@ -0,0 +1,40 @@
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from main.completions import drop_completion_partitions, ensure_completion_partitions, list_completion_partitions
+
+
+class Command(BaseCommand):
+    """Обслуживание секций отметок о выполнении: создание на месяцы вперед и удаление старых месяцев"""
+    help = 'Создает секции отметок о выполнении на --ahead месяцев вперед и удаляет секции до --drop-before'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=settings.HABIT_COMPLETION_PARTITIONS_AHEAD,
+                            help='на сколько месяцев вперед создать секции')
+        parser.add_argument('--since', help='создать также секции прошлых месяцев с этого, ГГГГ-ММ')
+        parser.add_argument('--drop-before', help='удалить секции месяцев раньше этого, ГГГГ-ММ')
+        parser.add_argument('--dry-run', action='store_true', help='только показать удаляемые секции')
+
+    def handle(self, *args, **options):
+        since = self.parse_month(options, 'since')
+        ensure_completion_partitions(ahead=options['ahead'], since=since)
+
+        if options['drop_before']:
+            before = self.parse_month(options, 'drop_before')
+            dropped = drop_completion_partitions(before, dry_run=options['dry_run'])
+            action = 'Будут удалены' if options['dry_run'] else 'Удалены'
+            self.stdout.write(f'{action} секции: {", ".join(f"{month:%Y-%m}" for month in dropped) or "нет"}')
+
+        months = list_completion_partitions()
+        self.stdout.write(f'Секции: {", ".join(f"{month:%Y-%m}" for month in months)}')
+
+    @staticmethod
+    def parse_month(options, name):
+        if not options[name]:
+            return None
+        try:
+            return datetime.strptime(options[name], '%Y-%m').replace(tzinfo=dt_timezone.utc)
+        except ValueError:
+            raise CommandError(f'--{name.replace("_", "-")} ожидается в формате ГГГГ-ММ')
@@ -0,0 +1,77 @@
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from main.imports import IMPORT_FORMATS, HabitImport, read_habit_rows
+from main.models import HabitImportCheckpoint
+from users.models import User
+
+
+class Command(BaseCommand):
+    """Загрузка привычек Владельца из файла JSONL или CSV пачками с контрольными точками"""
+    help = 'Загружает привычки из файла построчно. С --checkpoint прерванную загрузку можно продолжить.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='файл загрузки')
+        parser.add_argument('--owner', required=True, help='id или email Владельца привычек')
+        parser.add_argument('--format', choices=IMPORT_FORMATS, help='формат файла, по умолчанию - по расширению')
+        parser.add_argument('--chunk-size', type=int, default=settings.HABIT_IMPORT_CHUNK_SIZE,
+                            help='сколько строк проверять и записывать за раз')
+        parser.add_argument('--checkpoint', help='имя контрольной точки: состояние сохраняется в базе вместе '
+                                                 'с каждой пачкой, при повторном запуске загрузка продолжается с него')
+
+    def handle(self, *args, **options):
+        path = Path(options['path'])
+        file_format = options['format'] or path.suffix.lstrip('.')
+        if file_format not in IMPORT_FORMATS:
+            raise CommandError(f'Неизвестный формат файла {path.name}, укажите --format')
+
+        lookup = {'id': options['owner']} if options['owner'].isdigit() else {'email': options['owner']}
+        owner = User.objects.filter(**lookup).first()
+        if owner is None:
+            raise CommandError(f'Пользователь {options["owner"]} не найден')
+
+        state = self.load_checkpoint(options['checkpoint'], path, owner)
+        if state:
+            self.stdout.write(f'Продолжение с записи {state["rows"] + 1}')
+
+        source = str(path.resolve())
+
+        def checkpoint(habit_import):
+            HabitImportCheckpoint.objects.update_or_create(
+                name=options['checkpoint'], defaults={'owner': owner, 'source': source, 'state': habit_import.state})
+
+        def progress(habit_import):
+            report = habit_import.report()
+            self.stdout.write(f'Записей: {report["rows"]}, загружено: {report["imported"]}, '
+                              f'ошибок: {report["failed"]}, {report["rows_per_second"]} записей в секунду')
+
+        with path.open(encoding='utf-8', newline='') as lines:
+            habit_import = HabitImport(owner, options['chunk_size'], state)
+            report = habit_import.run(read_habit_rows(lines, file_format),
+                                      checkpoint if options['checkpoint'] else None, progress).report()
+
+        for error in report['errors']:
+            self.stderr.write(f'Запись {error["row"]}: {json.dumps(error["errors"], ensure_ascii=False)}')
+        if report['failed'] > len(report['errors']):
+            self.stderr.write(f'... и еще ошибок: {report["failed"] - len(report["errors"])}')
+
+        if options['checkpoint']:
+            # загрузка завершена, продолжать нечего
+            HabitImportCheckpoint.objects.filter(name=options['checkpoint']).delete()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Загружено привычек: {report["imported"]} из {report["rows"]} записей за {report["elapsed"]:.1f} с, '
+            f'{report["rows_per_second"]} записей в секунду. Ошибок: {report["failed"]}'
+        ))
+
+    @staticmethod
+    def load_checkpoint(name, path, owner):
+        checkpoint = HabitImportCheckpoint.objects.filter(name=name).first() if name else None
+        if checkpoint is None:
+            return None
+        if (checkpoint.source, checkpoint.owner_id) != (str(path.resolve()), owner.id):
+            raise CommandError(f'Контрольная точка {name} относится к другому файлу или Владельцу')
+        return checkpoint.state
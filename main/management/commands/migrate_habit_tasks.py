@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from django_celery_beat.models import PeriodicTask
+
+
+class Command(BaseCommand):
+    """Перевод напоминаний с задач HabitTask* на диспетчер напоминаний"""
+    help = 'Удаляет задачи HabitTask*, напоминания по которым теперь рассылает диспетчер'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='только показать количество задач')
+
+    def handle(self, *args, **options):
+        if not settings.HABIT_DISPATCHER_ENABLED:
+            raise CommandError('Режим диспетчера выключен. Задайте HABIT_DISPATCHER_ENABLED, '
+                               'иначе напоминания перестанут отправляться.')
+
+        habit_tasks = PeriodicTask.objects.filter(name__startswith='HabitTask',
+                                                  task='main.tasks.send_message_bot')
+        count = habit_tasks.count()
+
+        if options['dry_run']:
+            self.stdout.write(f'Будет удалено задач: {count}')
+            return
+
+        with transaction.atomic():
+            habit_tasks.delete()
+
+        self.stdout.write(self.style.SUCCESS(f'Удалено задач: {count}'))
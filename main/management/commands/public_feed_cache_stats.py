@@ -0,0 +1,16 @@
+from django.core.management import BaseCommand
+
+from main.feed_cache import public_feed_stats
+
+
+class Command(BaseCommand):
+    """Счетчики кэша ленты публичных привычек"""
+    help = 'Показывает попадания и промахи кэша ленты публичных привычек'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='обнулить счетчики после вывода')
+
+    def handle(self, *args, **options):
+        stats = public_feed_stats(reset=options['reset'])
+        self.stdout.write(f'Попаданий: {stats["hits"]}, промахов: {stats["misses"]}, '
+                          f'доля попаданий: {stats["hit_ratio"]}')
@@ -0,0 +1,94 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import islice
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Max, Min
+from django_celery_beat.models import PeriodicTasks
+
+from main.models import UsefulHabit
+from main.schedules import schedule_registry
+from main.services import sync_habit_periodic_tasks
+
+
+def rebuild_range(first_id, last_id, chunk_size, dry_run):
+    """
+    Пересборка задач привычек с идентификаторами из [first_id, last_id].
+    Каждая пачка записывается своей транзакцией.
+    :return: количество обработанных привычек, созданных, обновленных и удаленных задач.
+    """
+    habits = (UsefulHabit.objects
+              .filter(id__gte=first_id, id__lte=last_id)
+              .only('id', 'time', 'period')
+              .order_by('id')
+              .iterator(chunk_size=chunk_size))
+
+    totals = [0, 0, 0, 0]
+    while chunk := list(islice(habits, chunk_size)):
+        for index, count in enumerate((len(chunk), *sync_habit_periodic_tasks(chunk, dry_run))):
+            totals[index] += count
+    return totals
+
+
+class Command(BaseCommand):
+    """Пересборка задач HabitTask* всех привычек, например после смены TIME_ZONE или восстановления базы"""
+    help = 'Создает, обновляет и удаляет задачи HabitTask* пачками по текущему состоянию привычек'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='только посчитать изменения')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='размер пачки')
+        parser.add_argument('--workers', type=int, default=1, help='количество процессов')
+
+    def handle(self, *args, **options):
+        if settings.HABIT_DISPATCHER_ENABLED:
+            raise CommandError('Включен режим диспетчера, задачи HabitTask* не используются. '
+                               'Удалите их командой migrate_habit_tasks.')
+
+        chunk_size = options['chunk_size']
+        bounds = UsefulHabit.objects.aggregate(first_id=Min('id'), last_id=Max('id'))
+        if bounds['first_id'] is None:
+            self.stdout.write('Привычек нет')
+            return
+
+        # диапазоны идентификаторов по несколько пачек: процессы разбирают их по мере освобождения
+        step = chunk_size * 10
+        ranges = [(first_id, min(first_id + step - 1, bounds['last_id']), chunk_size, options['dry_run'])
+                  for first_id in range(bounds['first_id'], bounds['last_id'] + 1, step)]
+
+        schedule_registry.warm()
+        started = time.perf_counter()
+        totals = [0, 0, 0, 0]
+
+        if options['workers'] > 1:
+            # дочерние процессы открывают свои соединения с базой
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options['workers'],
+                                     mp_context=multiprocessing.get_context('fork')) as executor:
+                futures = [executor.submit(rebuild_range, *job) for job in ranges]
+                for future in as_completed(futures):
+                    self.add_totals(totals, future.result(), started)
+        else:
+            for job in ranges:
+                self.add_totals(totals, rebuild_range(*job), started)
+
+        processed, created, updated, deleted = totals
+        if options['dry_run']:
+            self.stdout.write(f'Будет создано задач: {created}, обновлено: {updated}, удалено: {deleted}')
+            return
+
+        if created or updated or deleted:
+            # bulk-операции не вызывают сигналы, beat узнает об изменениях по отметке
+            PeriodicTasks.update_changed()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Обработано привычек: {processed}. Создано задач: {created}, обновлено: {updated}, удалено: {deleted}'
+        ))
+
+    def add_totals(self, totals, counts, started):
+        for index, count in enumerate(counts):
+            totals[index] += count
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'Обработано привычек: {totals[0]}, {totals[0] / elapsed:.0f} в секунду')
@@ -0,0 +1,42 @@
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from main.models import UsefulHabit
+from main.stats import rebuild_habit_stats
+
+
+class Command(BaseCommand):
+    """
+    Пересчет сводок выполнения привычек по истории отметок, например для проверки
+    инкрементальных сводок или после изменения часового пояса проекта.
+    Считается только сохраненная история: после удаления старых секций отметок сводки с ней расходятся.
+    """
+    help = 'Пересчитывает сводки выполнения привычек по отметкам пачками и сообщает о расхождениях'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='только найти расхождения')
+        parser.add_argument('--chunk-size', type=int, default=settings.HABIT_STATS_REBUILD_CHUNK_SIZE,
+                            help='привычек в одной транзакции')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        habit_ids = UsefulHabit.objects.order_by('id').values_list('id', flat=True).iterator(chunk_size=chunk_size)
+
+        started = time.perf_counter()
+        processed, mismatched = 0, []
+        while chunk := list(islice(habit_ids, chunk_size)):
+            mismatched.extend(rebuild_habit_stats(chunk, options['dry_run']))
+            processed += len(chunk)
+            self.stdout.write(f'Обработано привычек: {processed}, '
+                              f'{processed / (time.perf_counter() - started):.0f} в секунду')
+
+        if mismatched:
+            sample = ', '.join(map(str, mismatched[:20]))
+            action = 'Расходятся' if options['dry_run'] else 'Исправлены'
+            self.stdout.write(self.style.WARNING(f'{action} сводки привычек: {len(mismatched)} ({sample})'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Обработано привычек: {processed}. Расхождений: {len(mismatched)}'
+        ))
@@ -0,0 +1,77 @@
+import json
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django_celery_beat.models import PeriodicTask, PeriodicTasks
+
+from main.models import UsefulHabit
+from main.services import delete_periodic_tasks, sync_habit_periodic_tasks
+
+
+class Command(BaseCommand):
+    """Сверка задач HabitTask* с привычками"""
+    help = 'Удаляет задачи HabitTask* без привычки, создает недостающие и исправляет устаревшие задачи пачками'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='только показать количество задач')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='размер пачки')
+
+    def handle(self, *args, **options):
+        deleted = self.delete_orphans(options['chunk_size'], options['dry_run'])
+        created = updated = 0
+        if not settings.HABIT_DISPATCHER_ENABLED:
+            # в режиме диспетчера задачи на привычки не нужны, все HabitTask* считаются лишними
+            created, updated = self.sync_timed(options['chunk_size'], options['dry_run'])
+
+        if options['dry_run']:
+            self.stdout.write(f'Будет удалено задач: {deleted}, будет создано задач: {created}, '
+                              f'будет исправлено задач: {updated}')
+            return
+
+        if deleted or created or updated:
+            # bulk-операции не вызывают сигналы, beat узнает об изменениях по отметке
+            PeriodicTasks.update_changed()
+
+        self.stdout.write(self.style.SUCCESS(f'Удалено задач: {deleted}, создано задач: {created}, '
+                                             f'исправлено задач: {updated}'))
+
+    def delete_orphans(self, chunk_size, dry_run):
+        habit_tasks = (PeriodicTask.objects
+                       .filter(name__startswith='HabitTask', task='main.tasks.send_message_bot')
+                       .order_by('id'))
+        habits = UsefulHabit.objects.all()
+        if settings.HABIT_DISPATCHER_ENABLED:
+            habits = habits.none()
+
+        deleted = 0
+        last_id = 0
+        while True:
+            chunk = list(habit_tasks.filter(id__gt=last_id).values_list('id', 'args')[:chunk_size])
+            if not chunk:
+                break
+            last_id = chunk[-1][0]
+
+            habit_ids = {task_id: json.loads(task_args)[0] for task_id, task_args in chunk}
+            existing = set(habits.filter(id__in=habit_ids.values()).values_list('id', flat=True))
+            orphan_ids = [task_id for task_id, habit_id in habit_ids.items() if habit_id not in existing]
+
+            deleted += len(orphan_ids) if dry_run else delete_periodic_tasks(orphan_ids)
+
+        return deleted
+
+    def sync_timed(self, chunk_size, dry_run):
+        """Задачи привычек со временем сверяются той же sync_habit_periodic_tasks, что и при изменении привычек"""
+        habits = UsefulHabit.objects.filter(time__isnull=False).only('id', 'time', 'period').order_by('id')
+
+        created = updated = 0
+        last_id = 0
+        while True:
+            chunk = list(habits.filter(id__gt=last_id)[:chunk_size])
+            if not chunk:
+                break
+            last_id = chunk[-1].id
+            chunk_created, chunk_updated, _ = sync_habit_periodic_tasks(chunk, dry_run)
+            created += chunk_created
+            updated += chunk_updated
+
+        return created, updated
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-18 12:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usefulhabit',
+            name='next_due_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='время следующего напоминания'),
+        ),
+    ]
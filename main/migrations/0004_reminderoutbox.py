@@ -0,0 +1,36 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_usefulhabit_next_due_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReminderOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scheduled_for', models.DateTimeField(verbose_name='время напоминания')),
+                ('status', models.CharField(choices=[('pending', 'ожидает отправки'), ('processing', 'отправляется'), ('sent', 'отправлено'), ('failed', 'не отправлено')], default='pending', max_length=16, verbose_name='статус')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='количество попыток')),
+                ('next_attempt_at', models.DateTimeField(verbose_name='время следующей попытки')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='время отправки')),
+                ('last_error', models.TextField(blank=True, null=True, verbose_name='последняя ошибка')),
+                ('habit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.usefulhabit', verbose_name='привычка')),
+            ],
+            options={
+                'verbose_name': 'напоминание',
+                'verbose_name_plural': 'очередь напоминаний',
+                'indexes': [models.Index(condition=models.Q(('status__in', ['pending', 'processing'])), fields=['next_attempt_at'], name='main_outbox_claim_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='reminderoutbox',
+            constraint=models.UniqueConstraint(fields=('habit', 'scheduled_for'), name='main_outbox_habit_slot_uniq'),
+        ),
+    ]
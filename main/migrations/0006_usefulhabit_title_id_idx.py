@@ -0,0 +1,21 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_reminderoutbox_digest_habit_ids'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='usefulhabit',
+            index=models.Index(fields=['owner', 'title', 'id'], name='main_habit_owner_title_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usefulhabit',
+            index=models.Index(condition=models.Q(('is_public', True)), fields=['title', 'id'], name='main_habit_public_title_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_usefulhabit_title_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usefulhabit',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='время изменения'),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,67 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Таблица секционирована по месяцам completed_at, секции создает main.completions.
+# Первичный ключ включает ключ секционирования. Каскадное удаление по привычке и пользователю выполняет база:
+# Django с DO_NOTHING не выбирает отметки перед удалением. Индексы родительской таблицы наследуются секциями
+CREATE_HABIT_COMPLETION_SQL = """
+    CREATE TABLE main_habitcompletion (
+        id bigint GENERATED BY DEFAULT AS IDENTITY,
+        habit_id bigint NOT NULL
+            REFERENCES main_usefulhabit (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        user_id bigint NOT NULL
+            REFERENCES users_user (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        completed_at timestamp with time zone NOT NULL,
+        PRIMARY KEY (id, completed_at)
+    ) PARTITION BY RANGE (completed_at);
+    CREATE INDEX main_completion_user_idx ON main_habitcompletion (user_id, completed_at);
+    CREATE INDEX main_completion_habit_idx ON main_habitcompletion (habit_id, completed_at);
+"""
+
+
+def create_partitions(apps, schema_editor):
+    """Секции текущего и следующих месяцев сразу, иначе до ночной задачи отметки некуда записать"""
+    from main.completions import ensure_completion_partitions
+
+    ensure_completion_partitions()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('main', '0007_usefulhabit_updated_at'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(CREATE_HABIT_COMPLETION_SQL, reverse_sql='DROP TABLE main_habitcompletion'),
+                migrations.RunPython(create_partitions, migrations.RunPython.noop),
+            ],
+            state_operations=[
+                migrations.CreateModel(
+                    name='HabitCompletion',
+                    fields=[
+                        ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                        ('completed_at', models.DateTimeField(verbose_name='время выполнения')),
+                        ('habit', models.ForeignKey(db_constraint=False,
+                                                    on_delete=django.db.models.deletion.DO_NOTHING,
+                                                    to='main.usefulhabit', verbose_name='привычка')),
+                        ('user', models.ForeignKey(db_constraint=False,
+                                                   on_delete=django.db.models.deletion.DO_NOTHING,
+                                                   to=settings.AUTH_USER_MODEL, verbose_name='пользователь')),
+                    ],
+                    options={
+                        'verbose_name': 'выполнение привычки',
+                        'verbose_name_plural': 'выполнения привычек',
+                        'indexes': [
+                            models.Index(fields=['user', 'completed_at'], name='main_completion_user_idx'),
+                            models.Index(fields=['habit', 'completed_at'], name='main_completion_habit_idx'),
+                        ],
+                    },
+                ),
+            ],
+        ),
+    ]
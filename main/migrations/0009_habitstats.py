@@ -0,0 +1,65 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Каскадное удаление сводок по привычке выполняет база: Django с DO_NOTHING не выбирает их перед удалением
+HABIT_STATS_FOREIGN_KEYS_SQL = """
+    ALTER TABLE main_habitstats ADD CONSTRAINT main_habitstats_habit_fk FOREIGN KEY (habit_id)
+        REFERENCES main_usefulhabit (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED;
+    ALTER TABLE main_habitperiodcount ADD CONSTRAINT main_habitperiodcount_habit_fk FOREIGN KEY (habit_id)
+        REFERENCES main_usefulhabit (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED;
+"""
+
+DROP_HABIT_STATS_FOREIGN_KEYS_SQL = """
+    ALTER TABLE main_habitstats DROP CONSTRAINT main_habitstats_habit_fk;
+    ALTER TABLE main_habitperiodcount DROP CONSTRAINT main_habitperiodcount_habit_fk;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_habitcompletion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HabitStats',
+            fields=[
+                ('habit', models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING,
+                                               primary_key=True, related_name='stats', serialize=False,
+                                               to='main.usefulhabit', verbose_name='привычка')),
+                ('period', models.IntegerField(verbose_name='периодичность, по которой посчитана сводка')),
+                ('total', models.PositiveIntegerField(default=0, verbose_name='количество отметок')),
+                ('current_streak', models.PositiveIntegerField(
+                    default=0, verbose_name='серия, заканчивающаяся последним периодом')),
+                ('longest_streak', models.PositiveIntegerField(default=0, verbose_name='самая длинная серия')),
+                ('first_period', models.DateField(blank=True, null=True, verbose_name='первый период с отметкой')),
+                ('last_period', models.DateField(blank=True, null=True, verbose_name='последний период с отметкой')),
+            ],
+            options={
+                'verbose_name': 'сводка привычки',
+                'verbose_name_plural': 'сводки привычек',
+            },
+        ),
+        migrations.CreateModel(
+            name='HabitPeriodCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period_start', models.DateField(verbose_name='начало периода')),
+                ('count', models.PositiveIntegerField(verbose_name='количество отметок')),
+                ('habit', models.ForeignKey(db_constraint=False, db_index=False,
+                                            on_delete=django.db.models.deletion.DO_NOTHING,
+                                            related_name='period_counts', to='main.usefulhabit',
+                                            verbose_name='привычка')),
+            ],
+            options={
+                'verbose_name': 'отметки за период',
+                'verbose_name_plural': 'отметки по периодам',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='habitperiodcount',
+            constraint=models.UniqueConstraint(fields=('habit', 'period_start'), name='main_period_count_uniq'),
+        ),
+        migrations.RunSQL(HABIT_STATS_FOREIGN_KEYS_SQL, reverse_sql=DROP_HABIT_STATS_FOREIGN_KEYS_SQL),
+    ]
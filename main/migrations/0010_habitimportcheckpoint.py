@@ -0,0 +1,31 @@
+# Generated by Django 4.2.9 on 2026-10-18 14:07
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('main', '0009_habitstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HabitImportCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='имя контрольной точки')),
+                ('source', models.TextField(verbose_name='файл загрузки')),
+                ('state', models.JSONField(verbose_name='состояние загрузки')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='время сохранения')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Владелец')),
+            ],
+            options={
+                'verbose_name': 'контрольная точка загрузки',
+                'verbose_name_plural': 'контрольные точки загрузки',
+            },
+        ),
+    ]
@@ -1,11 +1,61 @@
 from datetime import datetime, timedelta
+from django.contrib.postgres.fields import ArrayField
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db import models
+from django.db import NotSupportedError, models
 from django.conf import settings
+from django.utils import timezone
 
 NULLABLE = {'null': True, 'blank': True}
 
 
+SCHEDULE_FIELDS = ('time', 'period')
+
+
+def compute_next_due_at(habit_time, now=None):
+    """
+    Первое напоминание привычки: ближайшее наступление time в часовом поясе проекта, не раньше now.
+    Периодичность на него не влияет: period дней отсчитываются уже от первого напоминания, см. advance_due_habits.
+    """
+    if habit_time is None:
+        return None
+
+    now = timezone.localtime(now)
+    due_at = now.replace(hour=habit_time.hour, minute=habit_time.minute, second=0, microsecond=0)
+    if due_at < now:
+        due_at += timedelta(days=1)
+    return due_at
+
+
+class UsefulHabitQuerySet(models.QuerySet):
+    """
+    Массовые операции заполняют next_due_at, как и save: привычка без него не попадет к диспетчеру.
+    bulk_create заполняет незаданные значения, bulk_update с time или period пересчитывает измененные привычки.
+    """
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for habit in objs:
+            if habit.next_due_at is None:
+                habit.refresh_next_due_at()
+        created = super().bulk_create(objs, *args, **kwargs)
+        for habit in objs:
+            habit._loaded_schedule = habit.loaded_schedule()
+        return created
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs, fields = list(objs), list(fields)
+        if set(fields) & set(SCHEDULE_FIELDS):
+            changed = [habit for habit in objs if habit.schedule_changed()]
+            for habit in changed:
+                habit.refresh_next_due_at()
+            if changed and 'next_due_at' not in fields:
+                fields.append('next_due_at')
+        updated = super().bulk_update(objs, fields, *args, **kwargs)
+        for habit in objs:
+            habit._loaded_schedule = habit.loaded_schedule()
+        return updated
+
+
 class UsefulHabit(models.Model):
     """Модель привычек. Подробное описание см в Readme"""
 
@@ -39,11 +89,218 @@ class UsefulHabit(models.Model):
     time_to_complete = models.DurationField(default=timedelta(seconds=120), verbose_name='время на выполнение')
     time = models.TimeField(default=datetime.time(datetime.now()), **NULLABLE, verbose_name='время выполнения')
     related_habit = models.ForeignKey('self', on_delete=models.CASCADE, **NULLABLE, verbose_name='связанная привычка')
+    next_due_at = models.DateTimeField(**NULLABLE, db_index=True, verbose_name='время следующего напоминания')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='время изменения')
+
+    objects = UsefulHabitQuerySet.as_manager()
 
     def __str__(self):
         return f'{self.title} - {self.owner}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Запоминаем загруженные признак публичности, владельца и периодичность, чтобы сигналы видели их изменение"""
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_is_public = instance.__dict__.get('is_public')
+        instance._loaded_owner_id = instance.__dict__.get('owner_id')
+        instance._loaded_period = instance.__dict__.get('period')
+        instance._loaded_schedule = instance.loaded_schedule()
+        return instance
+
+    def loaded_schedule(self):
+        """Загруженные значения полей расписания, отложенные поля не читаются"""
+        return {name: self.__dict__[name] for name in SCHEDULE_FIELDS if name in self.__dict__}
+
+    def schedule_changed(self):
+        """Изменились ли время или периодичность с загрузки или прошлой записи"""
+        loaded = getattr(self, '_loaded_schedule', None)
+        return loaded is None or self.loaded_schedule() != loaded
+
+    def refresh_next_due_at(self, now=None):
+        self.next_due_at = compute_next_due_at(self.time, now)
+
+    def save(self, *args, **kwargs):
+        """
+        Время следующего напоминания задается здесь, а не в каждом месте создания и изменения привычек:
+        новой привычке, если оно не задано явно, и привычке с измененными временем или периодичностью.
+        """
+        update_fields = kwargs.get('update_fields')
+        if self._state.adding:
+            if self.next_due_at is None:
+                self.refresh_next_due_at()
+        elif (update_fields is None or set(update_fields) & set(SCHEDULE_FIELDS)) and self.schedule_changed():
+            self.refresh_next_due_at()
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'next_due_at'}
+        super().save(*args, **kwargs)
+        self._loaded_schedule = self.loaded_schedule()
+
     class Meta:
         verbose_name = 'привычка'
         verbose_name_plural = 'привычки'
         ordering = ('title',)
+        indexes = [
+            # постраничный вывод по ключу (title, id), см. HabitCursorPaginator
+            models.Index(fields=['owner', 'title', 'id'], name='main_habit_owner_title_idx'),
+            models.Index(fields=['title', 'id'], name='main_habit_public_title_idx',
+                         condition=models.Q(is_public=True)),
+        ]
+
+
+class ReminderOutbox(models.Model):
+    """
+    Очередь напоминаний. Одна запись на привычку и минуту напоминания,
+    поэтому повторный запуск диспетчера по той же минуте не создает дублей.
+    Запись сводки содержит все привычки пользователя этой минуты, habit - первая из них.
+    Очередь заполняет только диспетчер (HABIT_DISPATCHER_ENABLED), обработанные записи удаляются
+    через HABIT_OUTBOX_RETENTION, см. main.services.prune_reminder_outbox.
+    """
+
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+
+    STATUSES = (
+        (STATUS_PENDING, 'ожидает отправки'),
+        (STATUS_PROCESSING, 'отправляется'),
+        (STATUS_SENT, 'отправлено'),
+        (STATUS_FAILED, 'не отправлено'),
+    )
+
+    habit = models.ForeignKey(UsefulHabit, on_delete=models.CASCADE, verbose_name='привычка')
+    digest_habit_ids = ArrayField(models.BigIntegerField(), **NULLABLE, verbose_name='привычки сводки')
+    scheduled_for = models.DateTimeField(verbose_name='время напоминания')
+    status = models.CharField(max_length=16, choices=STATUSES, default=STATUS_PENDING, verbose_name='статус')
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name='количество попыток')
+    next_attempt_at = models.DateTimeField(verbose_name='время следующей попытки')
+    sent_at = models.DateTimeField(**NULLABLE, verbose_name='время отправки')
+    last_error = models.TextField(**NULLABLE, verbose_name='последняя ошибка')
+
+    def __str__(self):
+        return f'{self.habit_id} - {self.scheduled_for}'
+
+    class Meta:
+        verbose_name = 'напоминание'
+        verbose_name_plural = 'очередь напоминаний'
+        constraints = [
+            models.UniqueConstraint(fields=['habit', 'scheduled_for'], name='main_outbox_habit_slot_uniq'),
+        ]
+        indexes = [
+            # только записи, которые еще предстоит взять в работу
+            models.Index(fields=['next_attempt_at'], name='main_outbox_claim_idx',
+                         condition=models.Q(status__in=['pending', 'processing'])),
+        ]
+
+
+class HabitImportCheckpoint(models.Model):
+    """
+    Состояние прерванной загрузки привычек, см. main.imports. Сохраняется в транзакции записи пачки,
+    поэтому записанная пачка и точка, после которой загрузка продолжится, не расходятся.
+    """
+
+    name = models.CharField(max_length=255, unique=True, verbose_name='имя контрольной точки')
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name='Владелец')
+    source = models.TextField(verbose_name='файл загрузки')
+    state = models.JSONField(verbose_name='состояние загрузки')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='время сохранения')
+
+    def __str__(self):
+        return f'{self.name} - {self.state.get("rows")}'
+
+    class Meta:
+        verbose_name = 'контрольная точка загрузки'
+        verbose_name_plural = 'контрольные точки загрузки'
+
+
+class HabitCompletionQuerySet(models.QuerySet):
+    """Отметки только добавляются: изменение и построчное удаление запрещены, месяцы удаляются секциями"""
+
+    def update(self, **kwargs):
+        raise NotSupportedError('Отметки о выполнении не изменяются')
+
+    def delete(self):
+        raise NotSupportedError('Отметки о выполнении удаляются секциями, см. main.completions')
+
+
+class HabitCompletion(models.Model):
+    """
+    Отметка о выполнении привычки. Таблица секционирована по месяцам completed_at (см. миграцию 0008):
+    записи только добавляются пачками через main.completions, старые месяцы удаляются целыми секциями.
+    Первичный ключ в базе - (id, completed_at): ключ секционирования обязан входить в него.
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    # удаление привычки и пользователя каскадом выполняет сама база, без выборки отметок
+    habit = models.ForeignKey(UsefulHabit, on_delete=models.DO_NOTHING, db_constraint=False,
+                              verbose_name='привычка')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING, db_constraint=False,
+                             verbose_name='пользователь')
+    completed_at = models.DateTimeField(verbose_name='время выполнения')
+
+    objects = HabitCompletionQuerySet.as_manager()
+
+    def __str__(self):
+        return f'{self.habit_id} - {self.completed_at}'
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise NotSupportedError('Отметки о выполнении не изменяются')
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise NotSupportedError('Отметки о выполнении удаляются секциями, см. main.completions')
+
+    class Meta:
+        verbose_name = 'выполнение привычки'
+        verbose_name_plural = 'выполнения привычек'
+        indexes = [
+            # выборки за период по пользователю и по привычке
+            models.Index(fields=['user', 'completed_at'], name='main_completion_user_idx'),
+            models.Index(fields=['habit', 'completed_at'], name='main_completion_habit_idx'),
+        ]
+
+
+class HabitStats(models.Model):
+    """
+    Сводка выполнения привычки: обновляется при добавлении отметок (см. main.stats), поэтому серии
+    и количества не считаются по истории отметок при каждом запросе.
+    Периоды привычки - отрезки по period дней, недельные начинаются с понедельника.
+    """
+
+    # удаление привычки каскадом выполняет сама база, см. миграцию 0009
+    habit = models.OneToOneField(UsefulHabit, on_delete=models.DO_NOTHING, db_constraint=False, primary_key=True,
+                                 related_name='stats', verbose_name='привычка')
+    period = models.IntegerField(verbose_name='периодичность, по которой посчитана сводка')
+    total = models.PositiveIntegerField(default=0, verbose_name='количество отметок')
+    current_streak = models.PositiveIntegerField(default=0, verbose_name='серия, заканчивающаяся последним периодом')
+    longest_streak = models.PositiveIntegerField(default=0, verbose_name='самая длинная серия')
+    first_period = models.DateField(**NULLABLE, verbose_name='первый период с отметкой')
+    last_period = models.DateField(**NULLABLE, verbose_name='последний период с отметкой')
+
+    def __str__(self):
+        return f'{self.habit_id} - {self.current_streak}/{self.longest_streak}'
+
+    class Meta:
+        verbose_name = 'сводка привычки'
+        verbose_name_plural = 'сводки привычек'
+
+
+class HabitPeriodCount(models.Model):
+    """Количество отметок привычки за ее период: для выполнения за последние дни читаются только эти строки"""
+
+    # отдельный индекс не нужен: привычка - первое поле уникального ограничения
+    habit = models.ForeignKey(UsefulHabit, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False,
+                              related_name='period_counts', verbose_name='привычка')
+    period_start = models.DateField(verbose_name='начало периода')
+    count = models.PositiveIntegerField(verbose_name='количество отметок')
+
+    def __str__(self):
+        return f'{self.habit_id} - {self.period_start}: {self.count}'
+
+    class Meta:
+        verbose_name = 'отметки за период'
+        verbose_name_plural = 'отметки по периодам'
+        constraints = [
+            models.UniqueConstraint(fields=['habit', 'period_start'], name='main_period_count_uniq'),
+        ]
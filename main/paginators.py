@@ -1,4 +1,12 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class MainPaginator(PageNumberPagination):
@@ -6,3 +14,105 @@ class MainPaginator(PageNumberPagination):
     page_size = 5
     max_page_size = 20
     page_query_param = 'page_size'
+
+
+class HabitCursorPaginator(BasePagination):
+    """
+    Постраничный вывод по ключу (title, id): страница выбирается условием по индексу,
+    а не OFFSET, поэтому запрос любой страницы стоит одинаково.
+    Курсор - закодированные title и id крайней привычки страницы и направление.
+    """
+    page_size = MainPaginator.page_size
+    max_page_size = MainPaginator.max_page_size
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    invalid_cursor_message = 'Неверный курсор.'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        title, habit_id, reverse = self.decode_cursor(request)
+
+        queryset = queryset.order_by('-title', '-id') if reverse else queryset.order_by('title', 'id')
+        if title is not None:
+            # условие title >= позволяет postgres пройти индекс диапазоном
+            if reverse:
+                queryset = queryset.filter(Q(title__lte=title), Q(title__lt=title) | Q(id__lt=habit_id))
+            else:
+                queryset = queryset.filter(Q(title__gte=title), Q(title__gt=title) | Q(id__gt=habit_id))
+
+        page = list(queryset[:self.page_size + 1])
+        has_more = len(page) > self.page_size
+        page = page[:self.page_size]
+        if reverse:
+            page.reverse()
+
+        self.next_position = self.previous_position = None
+        if page:
+            if has_more or reverse:
+                self.next_position = self.get_position(page[-1], False)
+            if (has_more and reverse) or (not reverse and title is not None):
+                self.previous_position = self.get_position(page[0], True)
+        return page
+
+    @staticmethod
+    def get_position(habit, reverse):
+        """Позиция курсора по привычке или по строке .values()"""
+        if isinstance(habit, dict):
+            return habit['title'], habit['id'], reverse
+        return habit.title, habit.id, reverse
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, None, False
+        try:
+            title, habit_id, reverse = json.loads(urlsafe_b64decode(encoded.encode()))
+            return str(title), int(habit_id), bool(reverse)
+        except (BinasciiError, ValueError, TypeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, position):
+        if position is None:
+            return None
+        encoded = urlsafe_b64encode(json.dumps(position, ensure_ascii=False).encode()).decode()
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.encode_cursor(self.next_position),
+            'previous': self.encode_cursor(self.previous_position),
+            'results': data,
+        })
+
+
+class HabitPaginator(BasePagination):
+    """
+    Выбор режима клиентом: с параметром cursor (в том числе пустым для первой страницы) -
+    вывод по курсору, иначе - по номеру страницы, как раньше.
+    """
+    cursor_class = HabitCursorPaginator
+    page_class = MainPaginator
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_class.cursor_query_param in request.query_params:
+            self.paginator = self.cursor_class()
+        else:
+            self.paginator = self.page_class()
+            # порядок по id при одинаковых названиях делает страницы устойчивыми
+            queryset = queryset.order_by('title', 'id')
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+    def get_paginated_response_schema(self, schema):
+        return self.page_class().get_paginated_response_schema(schema)
@@ -4,5 +4,5 @@ from rest_framework.permissions import BasePermission
 class IsOwner(BasePermission):
     """система аутентификации и авторизации пользователей"""
 
-    def has_permission(self, request, view):
-        return request.user == view.get_object().owner
+    def has_object_permission(self, request, view, obj):
+        return obj.owner_id == request.user.id
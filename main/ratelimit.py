@@ -0,0 +1,120 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from redis import Redis
+
+
+class BaseTokenBucket(ABC):
+    """
+    Хранилище корзин токенов.
+    Корзина описывается кортежем (ключ, скорость пополнения в секунду, емкость).
+    """
+
+    @abstractmethod
+    def reserve(self, buckets):
+        """
+        Забирает по одному токену из всех корзин сразу.
+        :return: 0, если токены получены, иначе сколько секунд подождать до повторной попытки.
+        """
+
+
+class MemoryTokenBucket(BaseTokenBucket):
+    """Корзины в памяти процесса. Для тестов и запуска без Redis."""
+
+    def __init__(self, location=None):
+        self._lock = threading.Lock()
+        self._state = {}
+
+    def reserve(self, buckets):
+        now = time.monotonic()
+        with self._lock:
+            wait = 0.0
+            levels = []
+            for key, rate, capacity in buckets:
+                tokens, updated = self._state.get(key, (capacity, now))
+                tokens = min(capacity, tokens + (now - updated) * rate)
+                levels.append(tokens)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+
+            for (key, rate, capacity), tokens in zip(buckets, levels):
+                self._state[key] = (tokens if wait else tokens - 1, now)
+            return wait
+
+
+class RedisTokenBucket(BaseTokenBucket):
+    """Корзины в Redis, общие для всех воркеров. Проверка и списание выполняются одним скриптом."""
+
+    SCRIPT = """
+    local now = redis.call('TIME')
+    local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+    local wait = 0
+    local levels = {}
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[2 * i - 1])
+        local capacity = tonumber(ARGV[2 * i])
+        local state = redis.call('HMGET', key, 'tokens', 'updated')
+        local tokens = tonumber(state[1]) or capacity
+        local updated = tonumber(state[2]) or now_ms
+        tokens = math.min(capacity, tokens + (now_ms - updated) * rate / 1000)
+        levels[i] = tokens
+        if tokens < 1 then
+            wait = math.max(wait, math.ceil((1 - tokens) * 1000 / rate))
+        end
+    end
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[2 * i - 1])
+        local capacity = tonumber(ARGV[2 * i])
+        local tokens = levels[i]
+        if wait == 0 then
+            tokens = tokens - 1
+        end
+        redis.call('HSET', key, 'tokens', tostring(tokens), 'updated', now_ms)
+        redis.call('PEXPIRE', key, math.ceil(capacity * 1000 / rate) + 1000)
+    end
+    return wait
+    """
+
+    def __init__(self, location):
+        self._client = Redis.from_url(location)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def reserve(self, buckets):
+        keys = [key for key, _, _ in buckets]
+        args = [value for _, rate, capacity in buckets for value in (rate, capacity)]
+        return self._script(keys=keys, args=args) / 1000
+
+
+_token_buckets = {}
+
+
+def get_token_bucket():
+    """Хранилище корзин из настроек, одно на процесс"""
+    key = (settings.TELEGRAM_RATE_LIMIT_BACKEND, settings.TELEGRAM_RATE_LIMIT_LOCATION)
+    if key not in _token_buckets:
+        _token_buckets[key] = import_string(settings.TELEGRAM_RATE_LIMIT_BACKEND)(
+            settings.TELEGRAM_RATE_LIMIT_LOCATION
+        )
+    return _token_buckets[key]
+
+
+def telegram_buckets(chat_id):
+    """Общий лимит бота и лимит на один чат"""
+    return [
+        ('telegram:rate:global', settings.TELEGRAM_GLOBAL_RATE_LIMIT, settings.TELEGRAM_GLOBAL_RATE_LIMIT),
+        (f'telegram:rate:chat:{chat_id}', settings.TELEGRAM_CHAT_RATE_LIMIT, settings.TELEGRAM_CHAT_RATE_LIMIT),
+    ]
+
+
+def wait_telegram_rate_limit(chat_id):
+    """Блокирует, пока лимиты не позволят отправить сообщение в чат"""
+    token_bucket = get_token_bucket()
+    buckets = telegram_buckets(chat_id)
+    while True:
+        wait = token_bucket.reserve(buckets)
+        if not wait:
+            return
+        time.sleep(wait)
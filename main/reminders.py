@@ -0,0 +1,112 @@
+import threading
+from collections import OrderedDict
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+
+from main.delivery import Reminder
+from main.models import UsefulHabit
+from main.services import habit_reminder_text
+
+
+class ReminderCache:
+    """
+    Ограниченный LRU кэш готовых напоминаний в памяти процесса.
+    Запись хранит версию привычки из общего кэша Django: сохранение привычки
+    или пользователя в любом процессе меняет версию, и запись перестает совпадать.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, habit_id, version):
+        with self._lock:
+            entry = self._entries.get(habit_id)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(habit_id)
+            return entry[1]
+
+    def set(self, habit_id, version, reminder):
+        with self._lock:
+            self._entries[habit_id] = (version, reminder)
+            self._entries.move_to_end(habit_id)
+            while len(self._entries) > settings.HABIT_REMINDER_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def discard(self, habit_ids):
+        with self._lock:
+            for habit_id in habit_ids:
+                self._entries.pop(habit_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+reminder_cache = ReminderCache()
+
+
+def reminder_version_key(habit_id):
+    return f'reminder:version:{habit_id}'
+
+
+def reminder_versions(habit_ids):
+    """
+    Версии привычек из общего кэша одним запросом. Вытесненный ключ получает новую версию через add,
+    как версия ленты в main.feed_cache: записи, сохраненные до вытеснения, больше не совпадают.
+    :return: словарь идентификатор привычки - версия, None только если общий кэш не хранит ключи.
+    """
+    keys = {reminder_version_key(habit_id): habit_id for habit_id in habit_ids}
+    versions = cache.get_many(keys)
+    evicted = [key for key in keys if key not in versions]
+    if evicted:
+        for key in evicted:
+            cache.add(key, uuid4().hex, timeout=None)
+        versions.update(cache.get_many(evicted))
+    return {habit_id: versions.get(key) for key, habit_id in keys.items()}
+
+
+def load_habit_reminders(habit_ids):
+    """
+    Напоминания по привычкам: из кэша процесса, а промахи - одним запросом
+    только нужных полей привычки и chat_id владельца.
+    :return: словарь идентификатор привычки - Reminder, удаленные привычки пропускаются.
+    """
+    reminders = {}
+    missing = list(habit_ids)
+    versions = {}
+
+    if settings.HABIT_REMINDER_CACHE_SIZE:
+        versions = reminder_versions(habit_ids)
+        missing = []
+        for habit_id in habit_ids:
+            reminder = reminder_cache.get(habit_id, versions[habit_id]) if versions[habit_id] else None
+            if reminder is None:
+                missing.append(habit_id)
+            else:
+                reminders[habit_id] = reminder
+
+    if missing:
+        habits = (UsefulHabit.objects
+                  .filter(id__in=missing)
+                  .select_related('owner')
+                  .only('id', 'action', 'time', 'location', 'owner__chat_id'))
+        for habit in habits:
+            reminder = Reminder(habit.id, habit.owner.chat_id, habit_reminder_text(habit))
+            reminders[habit.id] = reminder
+            if versions.get(habit.id):
+                reminder_cache.set(habit.id, versions[habit.id], reminder)
+
+    return reminders
+
+
+def invalidate_habit_reminders(habit_ids):
+    """Сброс напоминаний по привычкам во всех процессах сменой версии в общем кэше"""
+    if not settings.HABIT_REMINDER_CACHE_SIZE or not habit_ids:
+        return
+    reminder_cache.discard(habit_ids)
+    version = uuid4().hex
+    cache.set_many({reminder_version_key(habit_id): version for habit_id in habit_ids}, timeout=None)
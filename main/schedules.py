@@ -0,0 +1,155 @@
+import logging
+import threading
+import zlib
+
+from celery.signals import worker_process_init
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django_celery_beat.models import CrontabSchedule
+
+logger = logging.getLogger(__name__)
+
+# пространство рекомендательных блокировок postgres для создания расписаний
+ADVISORY_LOCK_NAMESPACE = zlib.crc32(b'main.crontab_schedule') & 0x7fffffff
+
+
+class CrontabScheduleRegistry:
+    """
+    Идентификаторы расписаний crontab по ключу (час, минута, период) в памяти процесса.
+    Расписаний не больше 1440 × 7, поэтому при первом обращении загружаются все используемые,
+    а привычке подставляется готовый объект расписания без запроса к базе.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._warmed = set()
+
+    @staticmethod
+    def schedule_fields(key):
+        hour, minute, period = key
+        return {
+            'minute': str(minute),
+            'hour': str(hour),
+            # дни недели, кратные period, с начала каждой недели; диспетчер считает period от прошлого напоминания
+            'day_of_week': f'*/{period}',
+            'day_of_month': '*',
+            'month_of_year': '*',
+            'timezone': settings.TIME_ZONE,
+        }
+
+    @staticmethod
+    def load():
+        """Идентификаторы всех расписаний привычек по ключу одним запросом"""
+        schedules = (CrontabSchedule.objects
+                     .filter(day_of_week__startswith='*/', day_of_month='*', month_of_year='*',
+                             timezone=settings.TIME_ZONE)
+                     .order_by('-id')
+                     .values_list('id', 'hour', 'minute', 'day_of_week'))
+        ids = {}
+        for schedule_id, hour, minute, day_of_week in schedules:
+            try:
+                key = (int(hour), int(minute), int(day_of_week[2:]))
+            except ValueError:
+                continue
+            # дубли от прошлых гонок: остается расписание с меньшим идентификатором
+            ids[key] = schedule_id
+        return ids
+
+    def warm(self):
+        """Загрузка всех расписаний привычек в реестр"""
+        ids = self.load()
+        with self._lock:
+            self._ids.update({(settings.TIME_ZONE, *key): schedule_id for key, schedule_id in ids.items()})
+            self._warmed.add(settings.TIME_ZONE)
+
+    def get(self, habit_time, period):
+        """Расписание для времени и периода привычки. Запрос к базе только при промахе."""
+        key = (habit_time.hour, habit_time.minute, period)
+        return self.get_many([key])[key]
+
+    def get_many(self, keys):
+        """
+        Расписания по ключам (час, минута, период).
+        Все промахи находятся или создаются одной транзакцией.
+        """
+        if settings.TIME_ZONE not in self._warmed:
+            self.warm()
+
+        keys = set(keys)
+        ids = {key: self._ids.get((settings.TIME_ZONE, *key)) for key in keys}
+        missing = sorted(key for key, schedule_id in ids.items() if schedule_id is None)
+        if missing:
+            resolved = self._create(missing)
+            ids.update(resolved)
+            # расписания запоминаются после фиксации: при откате транзакции вызывающего кода их нет в базе
+            transaction.on_commit(lambda: self.remember(resolved))
+
+        return {key: CrontabSchedule(id=ids[key], **self.schedule_fields(key)) for key in keys}
+
+    def _create(self, keys):
+        """
+        Поиск или создание расписаний под блокировками по ключам: у CrontabSchedule нет
+        ограничения уникальности, и параллельный get_or_create создает дубли.
+        """
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                # блокировки берутся в порядке ключей, чтобы процессы не ждали друг друга по кругу
+                cursor.execute(
+                    'SELECT pg_advisory_xact_lock(%s, lock_key) '
+                    'FROM unnest(%s::integer[]) AS lock_key ORDER BY lock_key',
+                    [ADVISORY_LOCK_NAMESPACE, [(hour * 60 + minute) * 10 + period for hour, minute, period in keys]]
+                )
+            existing = self.load()
+            ids = {key: existing[key] for key in keys if key in existing}
+            new_keys = [key for key in keys if key not in ids]
+            created = CrontabSchedule.objects.bulk_create(
+                [CrontabSchedule(**self.schedule_fields(key)) for key in new_keys]
+            )
+            ids.update({key: schedule.id for key, schedule in zip(new_keys, created)})
+        return ids
+
+    def remember(self, ids):
+        with self._lock:
+            self._ids.update({(settings.TIME_ZONE, *key): schedule_id for key, schedule_id in ids.items()})
+
+    def discard(self, schedule_id):
+        with self._lock:
+            self._ids = {key: value for key, value in self._ids.items() if value != schedule_id}
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            self._warmed.clear()
+
+
+schedule_registry = CrontabScheduleRegistry()
+
+
+def write_with_schedules(write):
+    """
+    Запись задач с расписаниями из реестра. Расписание могли удалить в другом процессе, поэтому внешние ключи
+    проверяются сразу в точке сохранения: при ошибке реестр загружается заново и запись повторяется.
+    :param write: функция, которая берет расписания из реестра и записывает задачи.
+    """
+    try:
+        with transaction.atomic():
+            result = write()
+            connection.check_constraints()
+        return result
+    except IntegrityError:
+        logger.warning('Расписание из реестра не найдено в базе, реестр загружается заново')
+        schedule_registry.clear()
+
+    with transaction.atomic():
+        return write()
+
+
+@worker_process_init.connect
+def warm_schedule_registry(**kwargs):
+    """Прогрев реестра в каждом процессе воркера: расписания задач привычек обновляет Celery"""
+    try:
+        schedule_registry.warm()
+    except Exception:
+        # реестр прогреется при первом обращении
+        logger.exception('Не удалось загрузить расписания crontab')
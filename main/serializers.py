@@ -1,24 +1,231 @@
+from datetime import timedelta
+from functools import lru_cache
+
+from django.db import transaction
+from django.utils import timezone
 from rest_framework import serializers
-from main.models import UsefulHabit
-from main.validators import (one_of_related_habit_or_award, time_to_complete_no_more_120seconds,
-                             only_good_habit_into_related_habit, good_habit_cannot_have_award_or_related_habit)
+from main.changes import deferred_habit_changes, habit_changed
+from main.completions import list_completion_partitions, month_start
+from main.models import UsefulHabit, HabitCompletion
+from main.validators import HABIT_VALIDATORS, OwnRelatedHabit, validate_habits
+
+# допустимое расхождение часов клиента и сервера для времени выполнения
+COMPLETION_CLOCK_SKEW = timedelta(minutes=5)
+
+
+class RelatedHabitField(serializers.PrimaryKeyRelatedField):
+    """Связанная привычка. В пачке берется из загруженных заранее одним запросом, а не запросом на элемент."""
+
+    def to_internal_value(self, data):
+        related_habits = self.context.get('related_habits')
+        if related_habits is None:
+            return super().to_internal_value(data)
+
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            habit = related_habits.get(int(data))
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if habit is None:
+            self.fail('does_not_exist', pk_value=data)
+        return habit
+
+
+class UsefulHabitListSerializer(serializers.ListSerializer):
+    """
+    Пакетные операции с привычками: вся пачка пишется одним bulk-запросом в одной транзакции,
+    кэши, версии и расписания обновляются один раз на пачку.
+    """
+
+    def to_internal_value(self, data):
+        """
+        Проверка пачки: связанные привычки всех элементов загружаются одним in_bulk,
+        поля проверяются по элементам, затем цепочка проверок validate_habits - по всей пачке.
+        """
+        if not isinstance(data, list) or not data:
+            return super().to_internal_value(data)
+
+        related_ids = {item.get('related_habit') for item in data if isinstance(item, dict)}
+        related_ids = {int(value) for value in related_ids if isinstance(value, int) or str(value).isdigit()}
+        self.context['related_habits'] = UsefulHabit.objects.only('id', 'owner_id', 'is_good').in_bulk(related_ids)
+
+        # проверки уровня привычки выполняются ниже сразу для всей пачки
+        validators = self.child.validators
+        self.child.validators = []
+        try:
+            validated, errors = [], []
+            for item in data:
+                try:
+                    validated.append(self.child.run_validation(item))
+                    errors.append({})
+                except serializers.ValidationError as exc:
+                    validated.append(None)
+                    errors.append(exc.detail)
+        finally:
+            self.child.validators = validators
+            del self.context['related_habits']
+
+        valid = [index for index, value in enumerate(validated) if value is not None]
+        # загрузка из файла передает Владельца без запроса, см. main.imports
+        owner = self.context.get('owner') or (self.context['request'].user if 'request' in self.context else None)
+        for index, item_errors in zip(valid, validate_habits([validated[index] for index in valid], owner)):
+            if item_errors:
+                errors[index] = {'non_field_errors': item_errors}
+
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return validated
+
+    def create(self, validated_data):
+        owner = self.context['request'].user
+        habits = [UsefulHabit(**{**attrs, 'owner': owner}) for attrs in validated_data]
+
+        with transaction.atomic(), deferred_habit_changes():
+            UsefulHabit.objects.bulk_create(habits)
+            for habit in habits:
+                habit_changed(habit, created=True)
+        return habits
+
+    def update(self, instances, validated_data):
+        """:param instances: привычки в порядке элементов validated_data"""
+        fields = {'updated_at'}
+        now = timezone.now()
+        for habit, attrs in zip(instances, validated_data):
+            for field, value in attrs.items():
+                setattr(habit, field, value)
+                fields.add(field)
+            # bulk_update не заполняет auto_now
+            habit.updated_at = now
+
+        with transaction.atomic(), deferred_habit_changes():
+            UsefulHabit.objects.bulk_update(instances, fields)
+            for habit in instances:
+                habit_changed(habit, update_fields=fields)
+        return instances
 
 
 class UsefulHabitSerializer(serializers.ModelSerializer):
     """Сериализатор для модели Привычки"""
+    related_habit = RelatedHabitField(queryset=UsefulHabit.objects.all(), required=False, allow_null=True,
+                                      label='связанная привычка')
 
     class Meta:
         model = UsefulHabit
-        fields = '__all__'
+        exclude = ('next_due_at', 'updated_at')
         extra_kwargs = {'owner': {'required': False}}
+        list_serializer_class = UsefulHabitListSerializer
+
+        validators = [*HABIT_VALIDATORS, OwnRelatedHabit()]
 
-        validators = [
-            one_of_related_habit_or_award,
-            time_to_complete_no_more_120seconds,
-            only_good_habit_into_related_habit,
-            good_habit_cannot_have_award_or_related_habit,
-        ]
+    def __init__(self, *args, fields=None, **kwargs):
+        """:param fields: выводимые поля, см. main.fieldsets. None - все поля."""
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
 
     def create(self, validated_data):
         validated_data['owner'] = self.context['request'].user
         return super().create(validated_data)
+
+
+def _row_converter(field):
+    """
+    Преобразование значения из .values() в значение ответа, совпадающее с field.to_representation.
+    None - значение выводится как есть.
+    """
+    if isinstance(field, serializers.RelatedField):
+        # .values() отдает первичный ключ, как PKOnlyObject в PrimaryKeyRelatedField
+        return None
+    if isinstance(field, serializers.ChoiceField):
+        choices = field.choice_strings_to_values
+        return lambda value: choices.get(str(value), value)
+    if type(field) in (serializers.IntegerField, serializers.BooleanField, serializers.CharField):
+        # значения из базы уже нужного типа
+        return None
+    return field.to_representation
+
+
+class HabitRowSerializer:
+    """
+    Быстрый путь чтения списков привычек: строки загружаются .values() и выводятся подготовленными
+    заранее преобразователями полей UsefulHabitSerializer, без экземпляров модели и объектов полей на строку.
+    Результат совпадает с UsefulHabitSerializer(many=True).data.
+    """
+
+    def __init__(self, field_names=None):
+        self.columns = self.build_columns(None if field_names is None else tuple(field_names))
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def build_columns(field_names):
+        """:return: (имя в ответе, столбец .values(), преобразователь) в порядке полей сериализатора"""
+        fields = UsefulHabitSerializer().fields
+        columns = []
+        for name, field in fields.items():
+            if field.write_only or (field_names is not None and name not in field_names):
+                continue
+            columns.append((name, UsefulHabit._meta.get_field(field.source).attname, _row_converter(field)))
+        return tuple(columns)
+
+    @property
+    def value_fields(self):
+        return [source for _, source, _ in self.columns]
+
+    def values(self, queryset):
+        """Строки с выводимыми столбцами. id и title нужны курсору постраничного вывода и загружаются всегда."""
+        return queryset.values(*dict.fromkeys([*self.value_fields, 'id', 'title']))
+
+    def to_representation(self, rows):
+        return list(self.iter_representation(rows))
+
+    def iter_representation(self, rows):
+        """Вывод строк по одной, для потоковой выгрузки"""
+        columns = self.columns
+        for row in rows:
+            yield {name: row[source] if convert is None or row[source] is None else convert(row[source])
+                   for name, source, convert in columns}
+
+
+class HabitCompletionSerializer(serializers.ModelSerializer):
+    """
+    Отметка о выполнении привычки. Привычки Владельца для пачки отметок загружаются заранее одним запросом
+    в context['related_habits'], чужая привычка не находится. Месяцы секций - в context['completion_months'].
+    """
+    habit = RelatedHabitField(queryset=UsefulHabit.objects.none(), label='привычка')
+    completed_at = serializers.DateTimeField(default=timezone.now, label='время выполнения')
+
+    class Meta:
+        model = HabitCompletion
+        fields = ('id', 'habit', 'completed_at')
+
+    def validate_completed_at(self, value):
+        """Месяц отметки должен быть среди существующих секций: удаленные и давние месяцы не принимаются"""
+        if value > timezone.now() + COMPLETION_CLOCK_SKEW:
+            raise serializers.ValidationError('Время выполнения не может быть в будущем.')
+        months = self.context.get('completion_months')
+        if months is None:
+            months = self.context['completion_months'] = set(list_completion_partitions())
+        if month_start(value) not in months:
+            raise serializers.ValidationError('Отметки за этот месяц не хранятся.')
+        return value
+
+
+class HabitPeriodCountSerializer(serializers.Serializer):
+    """Количество отметок за период привычки"""
+    start = serializers.DateField(label='начало периода')
+    count = serializers.IntegerField(label='количество отметок')
+
+
+class HabitStatsSerializer(serializers.Serializer):
+    """Сводка выполнения привычки, строки готовит main.stats.habit_stats_rows"""
+    habit = serializers.IntegerField(label='привычка')
+    title = serializers.CharField(label='наименование')
+    period = serializers.IntegerField(label='периодичность')
+    total = serializers.IntegerField(label='количество отметок')
+    current_streak = serializers.IntegerField(label='текущая серия периодов')
+    longest_streak = serializers.IntegerField(label='самая длинная серия периодов')
+    last_period = serializers.DateField(label='последний период с отметкой', allow_null=True)
+    adherence = serializers.FloatField(label='доля периодов с отметками за окно')
+    periods = HabitPeriodCountSerializer(many=True, label='отметки по периодам за окно')
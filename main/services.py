@@ -1,33 +1,372 @@
-from django_celery_beat.models import CrontabSchedule, PeriodicTask
-from config import settings
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+from django_celery_beat.models import PeriodicTask
+
+from main.models import UsefulHabit, ReminderOutbox
+from main.schedules import schedule_registry, write_with_schedules
+from users.authentication import invalidate_cached_users
+
+OUTBOX_HABIT_MISSING_MESSAGE = 'Привычка удалена, напоминание не найдено'
 
 
 # функции для работы с задачами
+def habit_task_name(habit_id):
+    return f'HabitTask{habit_id}'
+
+
+def get_habit_crontab_schedule(habit):
+    """Расписание crontab для привычки из реестра процесса"""
+    return schedule_registry.get(habit.time, habit.period)
+
+
 def create_schedule_and_habit_periodic_task(habit):
     """Создание задачи"""
-    schedule, created = CrontabSchedule.objects.get_or_create(
-        minute=habit.time.minute,
-        hour=habit.time.hour,
-        day_of_week=f'*/{habit.period}',
-        month_of_year='*',
-        timezone=settings.TIME_ZONE
-    )
+    if settings.HABIT_DISPATCHER_ENABLED:
+        # напоминания рассылает диспетчер, отдельная задача не нужна
+        return
 
-    PeriodicTask.objects.create(
-        crontab=schedule,
-        name=f'HabitTask{habit.id}',
+    write_with_schedules(lambda: PeriodicTask.objects.create(
+        crontab=get_habit_crontab_schedule(habit),
+        name=habit_task_name(habit.id),
         task='main.tasks.send_message_bot',
-        args=[habit.id],
-    )
+        args=json.dumps([habit.id]),
+    ))
 
 
-def delete_habit_periodic_task(habit):
+def delete_habit_periodic_task(habit_id):
     """Удаление задачи"""
 
-    PeriodicTask.objects.filter(name=f'HabitTask{habit.id}').delete()
+    PeriodicTask.objects.filter(name=habit_task_name(habit_id)).delete()
 
 
 def update_habit_periodic_task(habit):
-    """Пересоздание задачи"""
-    delete_habit_periodic_task(habit)
-    create_schedule_and_habit_periodic_task(habit)
+    """
+    Приведение задачи к текущему состоянию привычки одним upsert.
+    Задача удаляется, если привычка без времени или напоминания рассылает диспетчер.
+    """
+    if settings.HABIT_DISPATCHER_ENABLED or habit.time is None:
+        delete_habit_periodic_task(habit.id)
+        return
+
+    write_with_schedules(lambda: PeriodicTask.objects.update_or_create(
+        name=habit_task_name(habit.id),
+        defaults={
+            'crontab': get_habit_crontab_schedule(habit),
+            'task': 'main.tasks.send_message_bot',
+            'args': json.dumps([habit.id]),
+        },
+    ))
+
+
+def delete_periodic_tasks(task_ids):
+    """
+    Удаление задач одним DELETE. QuerySet.delete() загружает задачи и на каждую отмечает изменение
+    расписаний сигналом, об изменениях beat здесь сообщает PeriodicTasks.update_changed вызывающего кода.
+    :return: количество удаленных задач.
+    """
+    if not task_ids:
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {connection.ops.quote_name(PeriodicTask._meta.db_table)} WHERE id = ANY(%s)',
+                       [list(task_ids)])
+        return cursor.rowcount
+
+
+def sync_habit_periodic_tasks(habits, dry_run=False):
+    """
+    Приведение задач пачки привычек к их состоянию: недостающие создаются, устаревшие обновляются,
+    задачи привычек без времени удаляются. Все расписания пачки берутся из реестра одним вызовом.
+    Массовые операции не вызывают сигналы PeriodicTask, об изменениях beat сообщает PeriodicTasks.update_changed.
+    :param habits: привычки с загруженными id, time и period.
+    :return: количество созданных, обновленных и удаленных задач.
+    """
+    if dry_run:
+        return _sync_habit_periodic_tasks(habits, dry_run)
+    return write_with_schedules(lambda: _sync_habit_periodic_tasks(habits, dry_run))
+
+
+def _sync_habit_periodic_tasks(habits, dry_run):
+    timed = [habit for habit in habits if habit.time is not None and not settings.HABIT_DISPATCHER_ENABLED]
+    schedules = schedule_registry.get_many((habit.time.hour, habit.time.minute, habit.period) for habit in timed)
+
+    names = {habit_task_name(habit.id): habit for habit in habits}
+    tasks = {task.name: task for task in PeriodicTask.objects.filter(name__in=names)
+             .only('id', 'name', 'crontab_id', 'task', 'args')}
+
+    to_create, to_update = [], []
+    for habit in timed:
+        crontab = schedules[(habit.time.hour, habit.time.minute, habit.period)]
+        args = json.dumps([habit.id])
+        task = tasks.pop(habit_task_name(habit.id), None)
+        if task is None:
+            to_create.append(PeriodicTask(crontab=crontab, name=habit_task_name(habit.id),
+                                          task='main.tasks.send_message_bot', args=args))
+        elif (task.crontab_id, task.task, task.args) != (crontab.id, 'main.tasks.send_message_bot', args):
+            task.crontab, task.task, task.args = crontab, 'main.tasks.send_message_bot', args
+            to_update.append(task)
+
+    # оставшиеся задачи принадлежат привычкам без времени или режиму диспетчера
+    to_delete = [task.id for task in tasks.values()]
+
+    deleted = len(to_delete)
+    if not dry_run:
+        with transaction.atomic():
+            PeriodicTask.objects.bulk_create(to_create)
+            PeriodicTask.objects.bulk_update(to_update, ['crontab', 'task', 'args'])
+            # задачу мог уже удалить параллельный процесс
+            deleted = delete_periodic_tasks(to_delete)
+
+    return len(to_create), len(to_update), deleted
+
+
+# функции для работы с версиями привычек
+def bump_habits_version(owner_ids):
+    """
+    Увеличение версии привычек владельцев, по ней строится ETag списка.
+    Массовые операции с привычками, минующие сигналы, вызывают ее сами.
+    """
+    owner_ids = {owner_id for owner_id in owner_ids if owner_id is not None}
+    if owner_ids:
+        get_user_model().objects.filter(id__in=owner_ids).update(habits_version=F('habits_version') + 1)
+        # update() минует сигналы, а версия берется из пользователя в кэше аутентификации
+        invalidate_cached_users(owner_ids)
+
+
+# функции для работы с цепочками связанных привычек
+# direction: 0 - исходная привычка, 1 - ее связанные привычки, -1 - привычки, которые ссылаются на нее.
+# path - пройденные привычки ветки: привычка, уже бывшая в пути, отмечается is_cycle и дальше не обходится.
+# Обход идет на уровень глубже лимита, чтобы узнать, обрезана ли цепочка
+HABIT_CHAIN_SQL = """
+    WITH RECURSIVE chain (id, related_habit_id, depth, direction, path, is_cycle) AS (
+        SELECT h.id, h.related_habit_id, 0, 0, ARRAY[h.id], false
+        FROM main_usefulhabit h
+        WHERE h.id = %(habit_id)s AND h.owner_id = %(owner_id)s
+    UNION ALL
+        SELECT h.id, h.related_habit_id, c.depth + 1,
+               CASE WHEN h.id = c.related_habit_id AND c.direction >= 0 THEN 1 ELSE -1 END,
+               c.path || h.id, h.id = ANY(c.path)
+        FROM chain c
+        JOIN main_usefulhabit h ON (
+            (c.direction >= 0 AND h.id = c.related_habit_id)
+            OR (%(reverse)s AND c.direction <= 0 AND h.related_habit_id = c.id)
+        )
+        WHERE h.owner_id = %(owner_id)s AND NOT c.is_cycle AND c.depth <= %(depth)s
+    )
+    SELECT {columns}, c.depth AS chain_depth, c.direction AS chain_direction, c.is_cycle AS chain_is_cycle
+    FROM chain c
+    JOIN main_usefulhabit h ON h.id = c.id
+    ORDER BY c.depth, c.direction DESC, h.id
+"""
+
+
+def get_habit_chain(habit_id, owner_id, depth, reverse=False, columns=None):
+    """
+    Привычка Владельца с цепочкой связанных привычек одним рекурсивным запросом.
+    :param depth: наибольшее количество звеньев от исходной привычки.
+    :param reverse: добавить привычки, которые ссылаются на исходную, и те, что ссылаются на них.
+    :param columns: загружаемые столбцы привычек, None - все.
+    :return: словарь habit, related, dependents, cycle, truncated или None, если привычка не найдена.
+    """
+    if columns is None:
+        select = 'h.*'
+    else:
+        select = ', '.join(f'h.{connection.ops.quote_name(column)}' for column in dict.fromkeys(['id', *columns]))
+    rows = list(UsefulHabit.objects.raw(HABIT_CHAIN_SQL.format(columns=select), {
+        'habit_id': habit_id, 'owner_id': owner_id, 'depth': depth, 'reverse': reverse,
+    }))
+    if not rows:
+        return None
+
+    chain = {'habit': rows[0], 'related': [], 'dependents': [], 'cycle': False, 'truncated': False}
+    for habit in rows[1:]:
+        if habit.chain_is_cycle:
+            chain['cycle'] = True
+        elif habit.chain_depth > depth:
+            chain['truncated'] = True
+        else:
+            chain['related' if habit.chain_direction > 0 else 'dependents'].append(habit)
+    return chain
+
+
+# функции для работы с временем следующего напоминания, первое задает модель, см. UsefulHabit.refresh_next_due_at
+# перенос на period дней, пропущенные периоды пропускаются; дни добавляются в часовом поясе проекта
+ADVANCE_NEXT_DUE_AT_SQL = """
+    CASE WHEN next_due_at > %s THEN next_due_at
+    ELSE ((next_due_at AT TIME ZONE %s) + make_interval(
+        days => period * (floor(extract(epoch FROM (%s - next_due_at)) / (period * 86400))::integer + 1)
+    )) AT TIME ZONE %s
+    END
+"""
+
+
+def advance_due_habits(habits, now=None):
+    """
+    Перенос следующего напоминания после отправки одним UPDATE, без загрузки привычек.
+    Результат всегда позже now. Переносится ровно на period дней, а не по дням недели crontab
+    задач привычек, см. HABIT_DISPATCHER_ENABLED.
+    :param habits: QuerySet привычек.
+    """
+    now = timezone.now() if now is None else now
+    tz = settings.TIME_ZONE
+    return habits.filter(next_due_at__isnull=False).update(
+        next_due_at=RawSQL(ADVANCE_NEXT_DUE_AT_SQL, (now, tz, now, tz))
+    )
+
+
+# функции для работы диспетчера напоминаний
+def habit_reminder_text(habit):
+    """Текст напоминания по привычке"""
+    return f'Я буду [{habit.action}] в [{habit.time}] в [{habit.location}] !'
+
+
+def digest_reminder_text(habits):
+    """Текст сводки по нескольким привычкам одного пользователя, со связанными привычками и вознаграждениями"""
+    lines = [f'Напоминания на {habits[0].time:%H:%M}:']
+    for number, habit in enumerate(habits, start=1):
+        line = f'{number}. Я буду [{habit.action}] в [{habit.location}]'
+        if habit.related_habit is not None:
+            line += f', затем [{habit.related_habit.action}]'
+        if habit.award:
+            line += f', вознаграждение: [{habit.award}]'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def get_due_habits(slot):
+    """
+    Привычки, напоминание по которым приходится на минуту slot или раньше. Пропущенные минуты
+    (перезапуск beat, долгий разбор очереди) подбираются следующим запуском: next_due_at переносит
+    только постановка в очередь, без нее привычка осталась бы в прошлом навсегда.
+    :param slot: datetime начала минуты.
+    """
+    start = slot.replace(second=0, microsecond=0)
+
+    return UsefulHabit.objects.filter(next_due_at__lt=start + timedelta(minutes=1))
+
+
+def get_due_habit_ids(slot):
+    """Идентификаторы привычек минуты slot и пропущенных минут"""
+    return get_due_habits(slot).order_by('id').values_list('id', flat=True)
+
+
+def get_due_digest_habit_ids(slot):
+    """
+    Привычки минуты slot у пользователей со сводкой, сгруппированные по владельцу одним запросом.
+    :return: списки идентификаторов привычек, по одному на пользователя.
+    """
+    return (get_due_habits(slot)
+            .filter(owner__digest=True)
+            .order_by()
+            .values('owner')
+            .annotate(habit_ids=ArrayAgg('id', ordering='id'))
+            .values_list('habit_ids', flat=True))
+
+
+# функции для работы с очередью напоминаний
+def enqueue_due_reminders(slot):
+    """
+    Постановка напоминаний минуты slot в очередь с переносом next_due_at.
+    Просроченные привычки ставятся одним напоминанием на минуту slot, пропущенные периоды пропускаются.
+    Вставка идет через ON CONFLICT DO NOTHING, повторный запуск по той же минуте ничего не добавляет.
+    Привычки пользователя со сводкой попадают в одну запись, ключом служит первая из них.
+    :return: количество привычек этой минуты.
+    """
+    start = slot.replace(second=0, microsecond=0)
+    groups = [[habit_id] for habit_id in get_due_habit_ids(slot).filter(owner__digest=False)]
+    groups += get_due_digest_habit_ids(slot)
+    batch_size = settings.HABIT_DISPATCH_BATCH_SIZE
+
+    for offset in range(0, len(groups), batch_size):
+        chunk = groups[offset:offset + batch_size]
+        with transaction.atomic():
+            now = timezone.now()
+
+            ReminderOutbox.objects.bulk_create(
+                [ReminderOutbox(habit_id=group[0], scheduled_for=start, next_attempt_at=now,
+                                digest_habit_ids=group if len(group) > 1 else None)
+                 for group in chunk],
+                ignore_conflicts=True,
+            )
+
+            habit_ids = [habit_id for group in chunk for habit_id in group]
+            advance_due_habits(UsefulHabit.objects.filter(id__in=habit_ids), max(now, start))
+
+    return sum(len(group) for group in groups)
+
+
+def claim_reminder_outbox(limit):
+    """
+    Захват пачки напоминаний для отправки. Строки, занятые другими воркерами, пропускаются
+    (SELECT ... FOR UPDATE SKIP LOCKED). Захваченные записи получают аренду HABIT_OUTBOX_LEASE:
+    если воркер упадет, по ее истечении записи снова станут доступны.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        entry_ids = list(ReminderOutbox.objects
+                         .select_for_update(skip_locked=True)
+                         .filter(status__in=[ReminderOutbox.STATUS_PENDING, ReminderOutbox.STATUS_PROCESSING],
+                                 next_attempt_at__lte=now)
+                         .order_by('next_attempt_at')
+                         .values_list('id', flat=True)[:limit])
+        ReminderOutbox.objects.filter(id__in=entry_ids).update(
+            status=ReminderOutbox.STATUS_PROCESSING,
+            next_attempt_at=now + settings.HABIT_OUTBOX_LEASE,
+        )
+
+    return list(ReminderOutbox.objects
+                .filter(id__in=entry_ids)
+                .only('id', 'habit_id', 'digest_habit_ids', 'attempts'))
+
+
+def load_digest_habits(entries):
+    """Привычки сводок из пачки записей очереди одним запросом"""
+    habit_ids = [habit_id for entry in entries for habit_id in entry.digest_habit_ids or ()]
+    return UsefulHabit.objects.select_related('related_habit').in_bulk(habit_ids)
+
+
+def complete_reminder_outbox(entries, sent_ids, errors, missing_ids=()):
+    """
+    Отметка результатов отправки. Отправленные помечаются одним UPDATE,
+    неотправленные откладываются с экспоненциальной паузой или, после
+    HABIT_OUTBOX_MAX_ATTEMPTS попыток, помечаются как не отправленные.
+    :param errors: словарь идентификатор записи - текст ошибки.
+    :param missing_ids: записи, напоминание по которым не найдено: привычка удалена после захвата записи.
+        Повтор не поможет, они сразу помечаются как не отправленные.
+    """
+    now = timezone.now()
+    ReminderOutbox.objects.filter(id__in=sent_ids).update(status=ReminderOutbox.STATUS_SENT, sent_at=now)
+
+    sent_ids, missing_ids = set(sent_ids), set(missing_ids)
+    failed = [entry for entry in entries if entry.id not in sent_ids]
+    for entry in failed:
+        entry.attempts += 1
+        if entry.id in missing_ids:
+            entry.last_error = OUTBOX_HABIT_MISSING_MESSAGE
+            entry.status = ReminderOutbox.STATUS_FAILED
+            continue
+        entry.last_error = errors.get(entry.id)
+        if entry.attempts >= settings.HABIT_OUTBOX_MAX_ATTEMPTS:
+            entry.status = ReminderOutbox.STATUS_FAILED
+        else:
+            entry.status = ReminderOutbox.STATUS_PENDING
+            entry.next_attempt_at = now + settings.HABIT_OUTBOX_RETRY_BACKOFF * 2 ** (entry.attempts - 1)
+    ReminderOutbox.objects.bulk_update(failed, ['status', 'attempts', 'next_attempt_at', 'last_error'])
+
+
+def prune_reminder_outbox(now=None):
+    """
+    Удаление отправленных и не отправленных записей очереди старше HABIT_OUTBOX_RETENTION.
+    Ожидающие и захваченные записи не удаляются.
+    :return: количество удаленных записей.
+    """
+    before = (now or timezone.now()) - settings.HABIT_OUTBOX_RETENTION
+    return ReminderOutbox.objects.filter(status__in=[ReminderOutbox.STATUS_SENT, ReminderOutbox.STATUS_FAILED],
+                                         scheduled_for__lt=before).delete()[0]
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django_celery_beat.models import CrontabSchedule
+
+from main.changes import habit_changed
+from main.models import UsefulHabit
+from main.reminders import invalidate_habit_reminders
+from main.schedules import schedule_registry
+
+
+@receiver(post_save, sender=UsefulHabit)
+def habit_saved(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Сброс кэшей напоминания и ленты, новая версия привычек владельца и синхронизация расписания
+    после фиксации транзакции, вне запроса. См. main.changes.
+    """
+    habit_changed(instance, created, update_fields)
+
+
+@receiver(post_delete, sender=UsefulHabit)
+def habit_deleted(sender, instance, **kwargs):
+    """Удаление привычки: те же последствия, задача напоминания удаляется"""
+    habit_changed(instance)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_owner_reminders(sender, instance, created, update_fields=None, **kwargs):
+    """Сброс кэша напоминаний пользователя: в них записан его chat_id"""
+    if created or (update_fields is not None and 'chat_id' not in update_fields):
+        return
+    invalidate_habit_reminders(list(UsefulHabit.objects.filter(owner=instance).values_list('id', flat=True)))
+
+
+@receiver(post_delete, sender=CrontabSchedule)
+def discard_crontab_schedule(sender, instance, **kwargs):
+    """Удаленное расписание больше не выдается из реестра этого процесса"""
+    schedule_registry.discard(instance.id)
@@ -0,0 +1,255 @@
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from main.models import HabitCompletion, HabitPeriodCount, HabitStats, UsefulHabit
+
+STATS_FIELDS = ('period', 'total', 'current_streak', 'longest_streak', 'first_period', 'last_period')
+
+
+def stats_timezone():
+    """Дни отметок считаются в часовом поясе проекта, а не в активном часовом поясе запроса"""
+    return timezone.get_default_timezone()
+
+
+def period_start(day, period):
+    """Начало периода привычки, в который попадает день. Периоды отсчитываются от понедельника 1.01.0001."""
+    return date.fromordinal((day.toordinal() - 1) // period * period + 1)
+
+
+def count_streaks(starts, period):
+    """
+    Серии подряд идущих периодов с отметками.
+    :param starts: начала периодов с отметками по возрастанию.
+    :return: серия, заканчивающаяся последним периодом, и самая длинная серия.
+    """
+    current = longest = 0
+    previous = None
+    for start in starts:
+        current = current + 1 if previous is not None and (start - previous).days == period else 1
+        longest = max(longest, current)
+        previous = start
+    return current, longest
+
+
+def summarize_habit(period, day_counts):
+    """
+    Сводка привычки по количествам отметок за дни.
+    :return: количества отметок по началам периодов и значения полей HabitStats.
+    """
+    counts = Counter()
+    for day, count in day_counts:
+        counts[period_start(day, period)] += count
+
+    starts = sorted(counts)
+    current, longest = count_streaks(starts, period)
+    return counts, {
+        'period': period,
+        'total': sum(counts.values()),
+        'current_streak': current,
+        'longest_streak': longest,
+        'first_period': starts[0] if starts else None,
+        'last_period': starts[-1] if starts else None,
+    }
+
+
+def lock_habit_stats(periods):
+    """
+    Сводки привычек, заблокированные до конца транзакции. Недостающие сводки создаются пустыми.
+    Строки блокируются по возрастанию привычки, чтобы параллельные пачки не ждали друг друга по кругу.
+    :param periods: периодичность по идентификатору привычки.
+    """
+    habit_ids = sorted(periods)
+    HabitStats.objects.bulk_create([HabitStats(habit_id=habit_id, period=periods[habit_id]) for habit_id in habit_ids],
+                                   ignore_conflicts=True)
+    return {stats.habit_id: stats
+            for stats in HabitStats.objects.select_for_update().filter(habit_id__in=habit_ids).order_by('habit_id')}
+
+
+def save_habit_stats(stats):
+    """
+    Запись сводок и количеств вставкой с ON CONFLICT: в отличие от bulk_update, без CASE по каждой строке.
+    Строки заблокированы вызывающим кодом, поэтому записываются посчитанные значения, а не приращения.
+    """
+    HabitStats.objects.bulk_create(stats, update_conflicts=True, unique_fields=['habit'], update_fields=STATS_FIELDS)
+
+
+def save_period_counts(rows):
+    HabitPeriodCount.objects.bulk_create(rows, update_conflicts=True, unique_fields=['habit', 'period_start'],
+                                         update_fields=['count'])
+
+
+def load_period_counts(habit_ids):
+    """Количества отметок по периодам привычек: {привычка: {начало периода: количество}}"""
+    counts = defaultdict(dict)
+    for habit_id, start, count in HabitPeriodCount.objects.filter(habit_id__in=habit_ids) \
+            .values_list('habit_id', 'period_start', 'count'):
+        counts[habit_id][start] = count
+    return counts
+
+
+def update_habit_stats(completions):
+    """
+    Учет новых отметок в сводках. Вызывается в транзакции их вставки: сводки заблокированы,
+    поэтому параллельные пачки по одной привычке учитываются по очереди.
+    Сводки, посчитанные по прежней периодичности привычки, пересчитываются по всей истории.
+    """
+    days = defaultdict(Counter)
+    for completion in completions:
+        days[completion.habit_id][timezone.localdate(completion.completed_at, stats_timezone())] += 1
+
+    periods = dict(UsefulHabit.objects.filter(id__in=days).values_list('id', 'period'))
+    if not periods:
+        return
+
+    stats = lock_habit_stats(periods)
+    # периодичность читается заново после блокировки: ее изменение могло зафиксироваться, пока сводки были заняты
+    periods = dict(UsefulHabit.objects.filter(id__in=stats).values_list('id', 'period'))
+    stats = {habit_id: habit_stats for habit_id, habit_stats in stats.items() if habit_id in periods}
+    stale = [habit_id for habit_id, habit_stats in stats.items() if habit_stats.period != periods[habit_id]]
+    if stale:
+        rebuild_habit_stats(stale, locked=stats)
+
+    counts = {habit_id: Counter() for habit_id in stats if habit_id not in stale}
+    for habit_id, counter in counts.items():
+        for day, count in days[habit_id].items():
+            counter[period_start(day, periods[habit_id])] += count
+    if not counts:
+        return
+
+    existing = {(habit_id, start): count for habit_id, start, count in HabitPeriodCount.objects.filter(
+        habit_id__in=counts, period_start__in={start for counter in counts.values() for start in counter},
+    ).values_list('habit_id', 'period_start', 'count')}
+    rows, backfilled = [], []
+    for habit_id, counter in counts.items():
+        habit_stats, period = stats[habit_id], periods[habit_id]
+        habit_stats.total += sum(counter.values())
+        for start in sorted(counter):
+            stored = existing.get((habit_id, start))
+            rows.append(HabitPeriodCount(habit_id=habit_id, period_start=start, count=counter[start] + (stored or 0)))
+            if stored is not None:
+                continue
+
+            if habit_stats.last_period is None or start > habit_stats.last_period:
+                if habit_stats.last_period is not None and (start - habit_stats.last_period).days == period:
+                    habit_stats.current_streak += 1
+                else:
+                    habit_stats.current_streak = 1
+                habit_stats.longest_streak = max(habit_stats.longest_streak, habit_stats.current_streak)
+                habit_stats.last_period = start
+            else:
+                # отметка задним числом может соединить две серии: серии пересчитываются по периодам
+                backfilled.append(habit_id)
+            if habit_stats.first_period is None or start < habit_stats.first_period:
+                habit_stats.first_period = start
+
+    save_period_counts(rows)
+    if backfilled:
+        for habit_id, starts in load_period_counts(backfilled).items():
+            stats[habit_id].current_streak, stats[habit_id].longest_streak = count_streaks(
+                sorted(starts), periods[habit_id])
+    save_habit_stats([stats[habit_id] for habit_id in counts])
+
+
+def rebuild_habit_stats(habit_ids, dry_run=False, locked=None):
+    """
+    Пересчет сводок привычек по всей истории отметок. Сводки блокируются до чтения отметок,
+    поэтому отметки, добавленные параллельно, учитываются после пересчета.
+    Переписываются только сводки, разошедшиеся с пересчитанными.
+    :param locked: сводки, уже заблокированные вызывающим кодом.
+    :return: идентификаторы привычек с разошедшимися сводками.
+    """
+    with transaction.atomic():
+        periods = dict(UsefulHabit.objects.filter(id__in=habit_ids).values_list('id', 'period'))
+        if dry_run:
+            stats = HabitStats.objects.in_bulk(list(periods))
+        elif locked is not None:
+            stats = {habit_id: locked[habit_id] for habit_id in periods}
+        else:
+            stats = lock_habit_stats(periods)
+
+        days = defaultdict(list)
+        for habit_id, day, count in (HabitCompletion.objects
+                                     .filter(habit_id__in=periods)
+                                     .annotate(day=TruncDate('completed_at', tzinfo=stats_timezone()))
+                                     .values_list('habit_id', 'day')
+                                     .annotate(count=Count('id'))
+                                     .order_by()):
+            days[habit_id].append((day, count))
+        stored_counts = load_period_counts(periods)
+
+        mismatched, created, changed = [], [], []
+        for habit_id, period in sorted(periods.items()):
+            counts, values = summarize_habit(period, days[habit_id])
+            habit_stats = stats.get(habit_id) or HabitStats(habit_id=habit_id, period=period)
+            if counts == stored_counts.get(habit_id, {}) and all(
+                    getattr(habit_stats, name) == value for name, value in values.items()):
+                continue
+
+            mismatched.append(habit_id)
+            for name, value in values.items():
+                setattr(habit_stats, name, value)
+            changed.append(habit_stats)
+            created.extend(HabitPeriodCount(habit_id=habit_id, period_start=start, count=count)
+                           for start, count in counts.items())
+
+        if not dry_run and mismatched:
+            HabitPeriodCount.objects.filter(habit_id__in=mismatched).delete()
+            HabitPeriodCount.objects.bulk_create(created)
+            save_habit_stats(changed)
+    return mismatched
+
+
+def refresh_habit_stats(habit_ids):
+    """
+    Пересчет сводок, посчитанных по прежней периодичности привычек: после ее изменения серии другие.
+    Вызывается при изменении привычек в той же транзакции, см. main.changes. Привычки без сводок пропускаются.
+    """
+    stale = list(HabitStats.objects.filter(habit_id__in=habit_ids).exclude(period=F('habit__period'))
+                 .values_list('habit_id', flat=True))
+    if stale:
+        rebuild_habit_stats(stale)
+
+
+def habit_stats_rows(habits, days, today=None):
+    """
+    Сводки привычек для вывода: серии, количества отметок по периодам за последние days дней
+    и доля периодов с отметками среди них. Количества загружаются одним запросом на все привычки.
+    Текущая серия прерывается, если в прошлом периоде отметок не было: текущий период еще не закончился.
+    :param habits: привычки с загруженными сводками (select_related('stats')).
+    """
+    today = today or timezone.localdate(timezone.now(), stats_timezone())
+    first_day = today - timedelta(days=days - 1)
+    recent = defaultdict(list)
+    for habit_id, start, count in (HabitPeriodCount.objects
+                                   .filter(habit_id__in=[habit.id for habit in habits],
+                                           period_start__gt=first_day - timedelta(days=UsefulHabit.PERIOD_DAY07),
+                                           period_start__lte=today)
+                                   .order_by('habit_id', 'period_start')
+                                   .values_list('habit_id', 'period_start', 'count')):
+        recent[habit_id].append((start, count))
+
+    rows = []
+    for habit in habits:
+        habit_stats = getattr(habit, 'stats', None) or HabitStats(habit=habit, period=habit.period)
+        first_start, current_start = period_start(first_day, habit.period), period_start(today, habit.period)
+        periods = [{'start': start, 'count': count} for start, count in recent[habit.id] if start >= first_start]
+        current_streak = habit_stats.current_streak
+        if habit_stats.last_period is None or (current_start - habit_stats.last_period).days > habit.period:
+            current_streak = 0
+        rows.append({
+            'habit': habit.id,
+            'title': habit.title,
+            'period': habit.period,
+            'total': habit_stats.total,
+            'current_streak': current_streak,
+            'longest_streak': habit_stats.longest_streak,
+            'last_period': habit_stats.last_period,
+            'adherence': round(len(periods) / ((current_start - first_start).days // habit.period + 1), 4),
+            'periods': periods,
+        })
+    return rows
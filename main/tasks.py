@@ -1,18 +1,201 @@
+import logging
+import time
+
 from celery import shared_task
-from requests import post
 from django.conf import settings
+from django_celery_beat.models import PeriodicTask, PeriodicTasks
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from requests import RequestException
 
+from main import completions, services
+from main.delivery import DeliveryEngine, DeliveryStats, outbox_reminder
 from main.models import UsefulHabit
+from main.reminders import load_habit_reminders
+from main.services import (advance_due_habits, enqueue_due_reminders, claim_reminder_outbox,
+                           complete_reminder_outbox, load_digest_habits, update_habit_periodic_task,
+                           delete_habit_periodic_task, delete_periodic_tasks, habit_task_name,
+                           sync_habit_periodic_tasks)
+from main.telegram import send_message
+
+logger = logging.getLogger(__name__)
 
 
 @shared_task
 def send_message_bot(habit_id):
-    """отправка сообщений в телеграм"""
-    habit = UsefulHabit.objects.get(id=habit_id)
-    post(
-        url=f"https://api.telegram.org/bot{settings.TELEGRAM_BOT_TOKEN}/sendMessage",
-        data={
-            'chat_id': habit.owner.chat_id,
-            'text': f'Я буду [{habit.action}] в [{habit.time}] в [{habit.location}] !'
-        }
-    )
+    """
+    отправка сообщений в телеграм по задаче привычки без диспетчера. Очереди здесь нет:
+    ошибка отправки не повторяется, повторный запуск задачи beat отправит напоминание еще раз.
+    """
+    reminder = load_habit_reminders([habit_id]).get(habit_id)
+    if reminder is None:
+        return
+
+    send_message(reminder.chat_id, reminder.text)
+    advance_due_habits(UsefulHabit.objects.filter(id=habit_id))
+
+
+def send_reminders_sync(reminders):
+    """
+    последовательная отправка напоминаний через общую сессию воркера.
+    Ошибка отправки одного напоминания не прерывает остальные.
+    """
+    stats = DeliveryStats()
+    for reminder in reminders:
+        try:
+            send_message(reminder.chat_id, reminder.text)
+        except RequestException as exc:
+            logger.exception('Не удалось отправить напоминание %s', reminder.id)
+            stats.failed.append(reminder.id)
+            stats.errors[reminder.id] = repr(exc)
+        else:
+            stats.sent.append(reminder.id)
+
+    stats.finished = time.perf_counter()
+    return stats
+
+
+def send_reminders(reminders):
+    """отправка напоминаний способом из HABIT_DELIVERY_ENGINE"""
+    if settings.HABIT_DELIVERY_ENGINE == 'async':
+        return DeliveryEngine().run(reminders)
+    return send_reminders_sync(reminders)
+
+
+@shared_task
+def send_messages_bot(habit_ids):
+    """отправка пачки сообщений в телеграм через общую сессию воркера"""
+    send_reminders_sync(load_habit_reminders(habit_ids).values())
+    advance_due_habits(UsefulHabit.objects.filter(id__in=habit_ids))
+
+
+@shared_task
+def deliver_reminders_async(habit_ids):
+    """
+    отправка пачки сообщений асинхронным движком доставки.
+    :return: количество отправленных и неотправленных, пропускная способность и перцентили задержки.
+    """
+    stats = DeliveryEngine().run(load_habit_reminders(habit_ids).values())
+    if stats.failed:
+        logger.warning('Не удалось отправить напоминания по привычкам %s', stats.failed)
+
+    advance_due_habits(UsefulHabit.objects.filter(id__in=habit_ids))
+    return stats.report()
+
+
+def drain_outbox(send):
+    """
+    разбор очереди напоминаний пачками, пока есть записи к отправке.
+    :param send: функция отправки списка Reminder, возвращает DeliveryStats.
+    :return: количество отправленных напоминаний.
+    """
+    sent = 0
+    while entries := claim_reminder_outbox(settings.HABIT_OUTBOX_BATCH_SIZE):
+        reminders = load_habit_reminders([entry.habit_id for entry in entries])
+        digest_habits = load_digest_habits(entries)
+        stats = send([outbox_reminder(entry, reminders, digest_habits) for entry in entries
+                      if entry.habit_id in reminders])
+        complete_reminder_outbox(entries, stats.sent, stats.errors,
+                                 [entry.id for entry in entries if entry.habit_id not in reminders])
+        sent += len(stats.sent)
+    return sent
+
+
+@shared_task
+def drain_reminder_outbox():
+    """воркер очереди напоминаний, несколько таких задач разбирают очередь параллельно"""
+    return drain_outbox(send_reminders)
+
+
+@shared_task
+def dispatch_due_habits(slot=None):
+    """
+    Диспетчер напоминаний. Запускается beat раз в минуту, ставит напоминания
+    этой минуты в очередь и запускает воркеры очереди. Воркеры заодно
+    подбирают повторы, время которых подошло.
+    :param slot: минута в формате ISO, по умолчанию текущая.
+    """
+    slot = timezone.localtime(parse_datetime(slot) if slot else None)
+    enqueue_due_reminders(slot)
+
+    for _ in range(settings.HABIT_OUTBOX_WORKERS):
+        drain_reminder_outbox.delay()
+
+
+def habit_sync_key(habit_id):
+    return f'habit:schedule-sync:{habit_id}'
+
+
+def schedule_habit_sync(habit_id):
+    """
+    постановка синхронизации расписания привычки в очередь с задержкой HABIT_SCHEDULE_SYNC_DELAY.
+    Пока задача ждет запуска, повторные изменения той же привычки новых задач не создают:
+    задача прочитает состояние привычки на момент выполнения. Без общего кэша каждое изменение ставит задачу.
+    """
+    coalesce = settings.HABIT_SCHEDULE_SYNC_COALESCE
+    if coalesce and not cache.add(habit_sync_key(habit_id), True, timeout=settings.HABIT_SCHEDULE_SYNC_DELAY + 60):
+        return
+
+    try:
+        sync_habit_schedule.apply_async((habit_id,), countdown=settings.HABIT_SCHEDULE_SYNC_DELAY)
+    except Exception:
+        # изменение привычки уже сохранено, расписание поправит reconcile_habit_tasks
+        if coalesce:
+            cache.delete(habit_sync_key(habit_id))
+        logger.exception('Не удалось поставить синхронизацию расписания привычки %s', habit_id)
+
+
+@shared_task
+def sync_habit_schedule(habit_id):
+    """синхронизация задачи напоминания с текущим состоянием привычки"""
+    # снимаем отметку до чтения привычки, чтобы изменения во время синхронизации поставили новую задачу
+    if settings.HABIT_SCHEDULE_SYNC_COALESCE:
+        cache.delete(habit_sync_key(habit_id))
+
+    habit = UsefulHabit.objects.filter(id=habit_id).only('id', 'time', 'period').first()
+    if habit is None:
+        delete_habit_periodic_task(habit_id)
+    else:
+        update_habit_periodic_task(habit)
+
+
+def schedule_habits_sync(habit_ids):
+    """Синхронизация расписаний после изменения привычек: одной привычки - с объединением, пачки - одной задачей"""
+    habit_ids = sorted(habit_ids)
+    if len(habit_ids) == 1:
+        schedule_habit_sync(habit_ids[0])
+        return
+
+    try:
+        sync_habit_schedules.delay(habit_ids)
+    except Exception:
+        logger.exception('Не удалось поставить синхронизацию расписаний %s привычек', len(habit_ids))
+
+
+@shared_task
+def sync_habit_schedules(habit_ids):
+    """синхронизация задач напоминаний пачки привычек массовыми запросами"""
+    habits = list(UsefulHabit.objects.filter(id__in=habit_ids).only('id', 'time', 'period'))
+    changed = any(sync_habit_periodic_tasks(habits))
+
+    # задачи удаленных привычек
+    deleted_names = [habit_task_name(habit_id) for habit_id in set(habit_ids) - {habit.id for habit in habits}]
+    if deleted_names:
+        task_ids = PeriodicTask.objects.filter(name__in=deleted_names).values_list('id', flat=True)
+        changed = delete_periodic_tasks(list(task_ids)) > 0 or changed
+
+    if changed:
+        PeriodicTasks.update_changed()
+
+
+@shared_task
+def prune_reminder_outbox():
+    """удаление обработанных записей очереди напоминаний старше HABIT_OUTBOX_RETENTION"""
+    return services.prune_reminder_outbox()
+
+
+@shared_task
+def ensure_completion_partitions():
+    """Заблаговременное создание секций отметок о выполнении на следующие месяцы"""
+    completions.ensure_completion_partitions()
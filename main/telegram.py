@@ -0,0 +1,49 @@
+import os
+import time
+
+from django.conf import settings
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+from main.ratelimit import wait_telegram_rate_limit
+
+_session = None
+_session_pid = None
+
+
+def get_session():
+    """
+    Сессия с пулом keep-alive соединений, одна на процесс воркера.
+    После fork дочерний процесс создает свою сессию, чтобы не делить сокеты с родителем.
+    """
+    global _session, _session_pid
+
+    if _session is None or _session_pid != os.getpid():
+        session = Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.TELEGRAM_POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _session, _session_pid = session, os.getpid()
+    return _session
+
+
+def send_message(chat_id, text):
+    """
+    Отправка сообщения через Bot API с учетом общих лимитов.
+    При ответе 429 ждет указанное телеграмом время и повторяет запрос.
+    """
+    url = f'{settings.TELEGRAM_API_URL}/bot{settings.TELEGRAM_BOT_TOKEN}/sendMessage'
+
+    for attempt in range(settings.TELEGRAM_MAX_ATTEMPTS):
+        wait_telegram_rate_limit(chat_id)
+        response = get_session().post(
+            url=url,
+            data={'chat_id': chat_id, 'text': text},
+            timeout=settings.TELEGRAM_REQUEST_TIMEOUT,
+        )
+        if response.status_code != 429 or attempt == settings.TELEGRAM_MAX_ATTEMPTS - 1:
+            break
+        time.sleep(response.json().get('parameters', {}).get('retry_after', 1))
+
+    response.raise_for_status()
+    return response
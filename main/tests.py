@@ -1,15 +1,61 @@
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APITestCase, APIClient
-from datetime import time, timedelta
-
-from main.models import UsefulHabit
+import json
+import tempfile
+from contextlib import contextmanager
+from io import StringIO
+from pathlib import Path
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from unittest import mock
+from threading import Thread
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import NotSupportedError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from main.delivery import DeliveryEngine, Reminder
+from main.changes import deferred_habit_changes
+from main.feed_cache import public_feed_stats, public_feed_version
+from main.fake_telegram import FakeTelegramServer
+from main.imports import HabitImport, read_habit_rows
+from main.completions import (add_months, completion_partitions, drop_completion_partitions,
+                              ensure_completion_partitions, list_completion_partitions, month_start,
+                              record_habit_completions)
+from main.models import (UsefulHabit, ReminderOutbox, HabitCompletion, HabitStats, HabitPeriodCount,
+                         HabitImportCheckpoint)
+from main.serializers import UsefulHabitSerializer, HabitRowSerializer
+from main.ratelimit import MemoryTokenBucket
+from main.stats import period_start, rebuild_habit_stats
+from main.services import (get_due_habit_ids, create_schedule_and_habit_periodic_task, claim_reminder_outbox,
+                           get_due_digest_habit_ids, sync_habit_periodic_tasks, prune_reminder_outbox,
+                           OUTBOX_HABIT_MISSING_MESSAGE)
+from main.reminders import load_habit_reminders, reminder_cache, reminder_version_key
+from main.schedules import schedule_registry
+from main.tasks import (dispatch_due_habits, send_message_bot, send_messages_bot, deliver_reminders_async,
+                        drain_reminder_outbox, sync_habit_schedule, sync_habit_schedules)
 from users.models import User
-from django_celery_beat.models import PeriodicTask
+from django_celery_beat.models import CrontabSchedule, PeriodicTask
+
+
+@contextmanager
+def run_schedule_sync():
+    """Синхронизация расписаний выполняется сразу, без брокера"""
+    with mock.patch('main.tasks.sync_habit_schedule.apply_async',
+                    side_effect=lambda args, **kwargs: sync_habit_schedule(*args)), \
+            mock.patch('main.tasks.sync_habit_schedules.delay', side_effect=sync_habit_schedules):
+        yield
 
 
 class UsefulHabitTestCase(APITestCase):
 
     def setUp(self):
+        schedule_registry.clear()
         self.user = User.objects.create(email='test@test.ru', password='test', chat_id='1234567890')
         self.client = APIClient()
         self.client.force_authenticate(user=self.user)
@@ -59,10 +105,11 @@ class UsefulHabitTestCase(APITestCase):
                       'is_good': 'False', 'is_public': 'True', 'period': 1, 'time_to_complete': 60,
                       'time': '18:00'}
 
-        self.client.post(
-            '/create/',
-            data=data_habit
-        )
+        with run_schedule_sync(), self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                '/create/',
+                data=data_habit
+            )
 
         self.assertEquals(
             PeriodicTask.objects.filter(name=f'HabitTask{self.course_id_03.id + 1}').exists(),
@@ -200,7 +247,7 @@ class UsefulHabitTestCase(APITestCase):
             response.json(),
             {'id': self.course_id_03.id + 1, 'title': 'Привычка №4', 'location': 'Марс', 'action': 'Работа с дыханием',
              'is_good': False, 'award': None, 'is_public': True, 'period': 1,
-             'time_to_complete': '00:01:00', 'time': '18:00:00', 'owner': 1, 'related_habit': None}
+             'time_to_complete': '00:01:00', 'time': '18:00:00', 'owner': self.user.id, 'related_habit': None}
         )
 
     def test_create_habit_periodic_task(self):
@@ -210,10 +257,11 @@ class UsefulHabitTestCase(APITestCase):
                       'is_good': 'False', 'is_public': 'True', 'period': 1, 'time_to_complete': 60,
                       'time': '18:00'}
 
-        self.client.post(
-            '/create/',
-            data=data_habit
-        )
+        with run_schedule_sync(), self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                '/create/',
+                data=data_habit
+            )
 
         self.assertEquals(
             PeriodicTask.objects.filter(name=f'HabitTask{self.course_id_03.id + 1}').exists(),
@@ -316,9 +364,1517 @@ class UsefulHabitTestCase(APITestCase):
         )
 
         self.assertEquals(
-            response.json()[0].get('id') is not None and response.json()[0].get('id') == self.course_id_03.id,
+            response.json()['results'][0].get('id') == self.course_id_03.id,
             True
         )
 
     def tearDown(self):
         UsefulHabit.objects.all().delete()
+
+
+class HabitCursorPaginationTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='cursor@test.ru', password='test', chat_id=6200)
+        self.client.force_authenticate(user=self.user)
+        # одинаковые названия проверяют переход между страницами по id
+        self.habits = [
+            UsefulHabit.objects.create(title=title, location='Дом', action='Зарядка', is_public=True, owner=self.user)
+            for title in ('Б', 'А', 'Б', 'В', 'А', 'Б', 'А')
+        ]
+        self.ordered = [habit.id for habit in sorted(self.habits, key=lambda habit: (habit.title, habit.id))]
+
+    def test_cursor_pages_forward_and_back(self):
+        """Курсор проходит все привычки по (title, id) вперед и назад без пропусков и повторов."""
+
+        for url in ('/list/', '/list_public/'):
+            pages = []
+            response = self.client.get(url, {'cursor': '', 'limit': 3}).json()
+            pages.append([habit['id'] for habit in response['results']])
+            self.assertIsNone(response['previous'])
+            while response['next']:
+                response = self.client.get(response['next']).json()
+                pages.append([habit['id'] for habit in response['results']])
+
+            self.assertEqual(sum(pages, []), self.ordered)
+            self.assertEqual([len(page) for page in pages], [3, 3, 1])
+
+            response = self.client.get(response['previous']).json()
+            self.assertEqual([habit['id'] for habit in response['results']], pages[1])
+            response = self.client.get(response['previous']).json()
+            self.assertEqual([habit['id'] for habit in response['results']], pages[0])
+            self.assertIsNone(response['previous'])
+
+    def test_cursor_page_without_offset(self):
+        """Страница по курсору выбирается условием по ключу, без OFFSET и подсчета строк."""
+
+        response = self.client.get('/list/', {'cursor': '', 'limit': 2}).json()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(response['next'])
+
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('OFFSET', queries[0]['sql'])
+
+    def test_page_mode_by_default(self):
+        """Без параметра cursor остается вывод по номеру страницы."""
+
+        response = self.client.get('/list/', {'page_size': 2}).json()
+
+        self.assertEqual(response['count'], 7)
+        self.assertEqual([habit['id'] for habit in response['results']], self.ordered[5:7])
+
+    def test_invalid_cursor(self):
+        """Испорченный курсор - ответ 404."""
+
+        response = self.client.get('/list/', {'cursor': 'испорчен'})
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(HABIT_PUBLIC_FEED_CACHE_TIMEOUT=60)
+class PublicFeedCacheTestCase(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(email='feed@test.ru', password='test', chat_id=6300)
+        self.client.force_authenticate(user=self.user)
+        self.public = UsefulHabit.objects.create(title='Публичная', location='Дом', action='Зарядка',
+                                                 is_public=True, owner=self.user)
+        self.private = UsefulHabit.objects.create(title='Личная', location='Дом', action='Чтение',
+                                                  owner=self.user)
+
+    def feed_titles(self):
+        return [habit['title'] for habit in self.client.get('/list_public/').json()['results']]
+
+    def test_repeated_request_served_from_cache(self):
+        """Повторный запрос страницы ленты не обращается к базе."""
+
+        self.assertEqual(self.client.get('/list_public/')['X-Cache'], 'MISS')
+        with self.assertNumQueries(0):
+            response = self.client.get('/list_public/')
+
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response.json()['results'][0]['id'], self.public.id)
+        self.assertEqual(public_feed_stats(), {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+
+    def test_invalidated_by_public_changes_only(self):
+        """Лента сбрасывается при изменении публичных привычек, личные привычки ее не трогают."""
+
+        self.feed_titles()
+        self.private.title = 'Личная, переименована'
+        self.private.save()
+        self.assertEqual(self.client.get('/list_public/')['X-Cache'], 'HIT')
+
+        self.private.is_public = True
+        self.private.save()
+        self.assertEqual(self.feed_titles(), ['Личная, переименована', 'Публичная'])
+
+        habit = UsefulHabit.objects.get(id=self.public.id)
+        habit.title = 'Публичная, переименована'
+        habit.save()
+        self.assertEqual(self.feed_titles(), ['Личная, переименована', 'Публичная, переименована'])
+
+        habit = UsefulHabit.objects.get(id=self.private.id)
+        habit.is_public = False
+        habit.save()
+        self.assertEqual(self.feed_titles(), ['Публичная, переименована'])
+
+        self.public.delete()
+        self.assertEqual(self.feed_titles(), [])
+
+    def test_invalidated_again_after_commit(self):
+        """Страницы, собранные другими процессами до фиксации изменения, сбрасываются после нее."""
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic(), deferred_habit_changes():
+                self.public.title = 'Публичная, переименована'
+                self.public.save()
+            version = public_feed_version()
+
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(public_feed_version(), version)
+
+
+class ConditionalGetTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='etag@test.ru', password='test', chat_id=6400)
+        self.habit = UsefulHabit.objects.create(title='Привычка', location='Дом', action='Зарядка', owner=self.user)
+        self.authenticate()
+
+    def authenticate(self):
+        """Пользователь загружается заново, как при аутентификации по токену"""
+        self.client.force_authenticate(user=User.objects.get(id=self.user.id))
+
+    def test_list_not_modified(self):
+        """Совпавший ETag списка дает 304 без запросов к базе, изменение привычки - новый ETag."""
+
+        etag = self.client.get('/list/')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get('/list/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.assertNotEqual(self.client.get('/list/', {'cursor': ''})['ETag'], etag)
+
+        self.habit.title = 'Новое название'
+        self.habit.save()
+        self.authenticate()
+        response = self.client.get('/list/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['results'][0]['title'], 'Новое название')
+
+    def test_list_version_ignores_next_due_at(self):
+        """Перенос времени напоминания не меняет ETag списка."""
+
+        etag = self.client.get('/list/')['ETag']
+        self.habit.save(update_fields=['next_due_at'])
+        self.authenticate()
+
+        self.assertEqual(self.client.get('/list/', HTTP_IF_NONE_MATCH=etag).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+
+    def test_detail_not_modified(self):
+        """Привычка отдается ответом 304 по ETag и по If-Modified-Since, изменение - новый ответ."""
+
+        response = self.client.get(f'/view/{self.habit.id}/')
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        with mock.patch.object(UsefulHabitSerializer, 'to_representation') as to_representation:
+            response = self.client.get(f'/view/{self.habit.id}/', HTTP_IF_NONE_MATCH=etag)
+            to_representation.assert_not_called()
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(self.client.get(f'/view/{self.habit.id}/', HTTP_IF_MODIFIED_SINCE=last_modified).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+
+        self.habit.award = 'Кофе'
+        self.habit.save()
+        response = self.client.get(f'/view/{self.habit.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class HabitObjectQueryCountTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='owner@test.ru', password='test', chat_id=6500)
+        self.other = User.objects.create(email='other@test.ru', password='test', chat_id=6501)
+        self.client.force_authenticate(user=self.user)
+        self.habit = UsefulHabit.objects.create(title='Привычка', location='Дом', action='Зарядка', owner=self.user)
+        self.foreign = UsefulHabit.objects.create(title='Чужая', location='Дом', action='Чтение', owner=self.other)
+
+    def test_view_single_fetch(self):
+        """Просмотр загружает привычку одним запросом."""
+
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/view/{self.habit.id}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_update_single_fetch(self):
+        """Редактирование: загрузка привычки, ее сохранение и новая версия привычек владельца."""
+
+        with self.assertNumQueries(3):
+            response = self.client.patch(f'/edit/{self.habit.id}/', data={'title': 'Новое название',
+                                                                          'time_to_complete': 60, 'is_good': False})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_delete_single_fetch(self):
+        """Удаление: загрузка привычки, каскад по связанным привычкам и очереди, удаление и версия владельца."""
+
+        with self.assertNumQueries(5):
+            response = self.client.delete(f'/delete/{self.habit.id}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_foreign_habit_not_found(self):
+        """Чужая привычка не находится ни одним запросом к ней."""
+
+        for method, url in (('get', 'view'), ('patch', 'edit'), ('delete', 'delete')):
+            with self.assertNumQueries(1):
+                response = getattr(self.client, method)(f'/{url}/{self.foreign.id}/')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertTrue(UsefulHabit.objects.filter(id=self.foreign.id).exists())
+
+
+class HabitBatchTestCase(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        schedule_registry.clear()
+        self.user = User.objects.create(email='batch@test.ru', password='test', chat_id=6600)
+        self.other = User.objects.create(email='batch-other@test.ru', password='test', chat_id=6601)
+        self.client.force_authenticate(user=self.user)
+
+    def habit_data(self, index, **fields):
+        return {'title': f'Привычка {index}', 'location': 'Дом', 'action': 'Зарядка', 'is_good': False,
+                'period': 1, 'time_to_complete': 60, 'time': f'{7 + index:02}:00', **fields}
+
+    def task_hours(self):
+        tasks = PeriodicTask.objects.filter(name__startswith='HabitTask').select_related('crontab')
+        return {int(task.name[len('HabitTask'):]): int(task.crontab.hour) for task in tasks}
+
+    def test_batch_create(self):
+        """Пачка создается постоянным числом запросов, расписания - одной задачей после фиксации."""
+
+        with run_schedule_sync(), self.captureOnCommitCallbacks(execute=True):
+            with self.assertNumQueries(4):
+                response = self.client.post('/batch/create/', [self.habit_data(i) for i in range(10)], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        ids = [habit['id'] for habit in response.json()]
+        self.assertEqual(UsefulHabit.objects.filter(owner=self.user, id__in=ids).count(), 10)
+        self.assertEqual(self.task_hours(), {habit_id: 7 + i for i, habit_id in enumerate(ids)})
+        self.assertEqual(User.objects.get(id=self.user.id).habits_version, 1)
+
+    def test_batch_create_errors_per_item(self):
+        """Ошибки возвращаются по элементам, при ошибке ничего не создается."""
+
+        response = self.client.post('/batch/create/', [
+            self.habit_data(0),
+            self.habit_data(1, time_to_complete=300),
+            self.habit_data(2, title=''),
+        ], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = response.json()
+        self.assertEqual(errors[0], {})
+        self.assertEqual(errors[1], {'non_field_errors': ['Время выполнения должно быть не больше 120 секунд.']})
+        self.assertIn('title', errors[2])
+        self.assertFalse(UsefulHabit.objects.filter(owner=self.user).exists())
+
+    def test_batch_related_habits_in_one_query(self):
+        """Связанные привычки всей пачки загружаются одним запросом, ошибки цепочки - по элементам."""
+
+        good = [UsefulHabit.objects.create(title=f'Приятная {i}', location='Дом', action='Кофе', is_good=True,
+                                           owner=self.user) for i in range(10)]
+        with self.assertNumQueries(5):
+            response = self.client.post('/batch/create/', [self.habit_data(i, related_habit=habit.id)
+                                                           for i, habit in enumerate(good)], format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([habit['related_habit'] for habit in response.json()], [habit.id for habit in good])
+
+        useful = UsefulHabit.objects.create(title='Полезная', location='Дом', action='Зарядка', owner=self.user)
+        foreign = UsefulHabit.objects.create(title='Чужая', location='Дом', action='Кофе', is_good=True,
+                                             owner=self.other)
+        response = self.client.post('/batch/create/', [
+            self.habit_data(0, related_habit=good[0].id),
+            self.habit_data(1, related_habit=useful.id),
+            self.habit_data(2, related_habit=foreign.id),
+            self.habit_data(3, related_habit=good[0].id, award='Кино'),
+            self.habit_data(4, related_habit=10 ** 9),
+        ], format='json')
+
+        errors = response.json()
+        self.assertEqual(errors[0], {})
+        self.assertEqual(errors[1], {'non_field_errors': ['Ошибка. Привычка должна быть приятной']})
+        self.assertEqual(errors[2], {'non_field_errors': ['Ошибка. Связанная привычка должна принадлежать вам']})
+        self.assertEqual(errors[3], {'non_field_errors': ['Ошибка. Нельзя связать эту привычку и вознаграждение']})
+        self.assertEqual(list(errors[4]), ['related_habit'])
+
+    def test_single_habit_foreign_related_habit(self):
+        """Одиночное создание проверяет владельца связанной привычки той же цепочкой."""
+
+        foreign = UsefulHabit.objects.create(title='Чужая', location='Дом', action='Кофе', is_good=True,
+                                             owner=self.other)
+        response = self.client.post('/create/', self.habit_data(0, related_habit=foreign.id), format='json')
+
+        self.assertEqual(response.json(), {'non_field_errors': ['Ошибка. Связанная привычка должна принадлежать вам']})
+
+    def test_batch_update(self):
+        """Пачка обновляется одним bulk_update, чужая привычка - ошибка своего элемента."""
+
+        habits = [UsefulHabit.objects.create(title=f'Привычка {i}', location='Дом', action='Зарядка',
+                                             time=time(6, 0), owner=self.user) for i in range(3)]
+        foreign = UsefulHabit.objects.create(title='Чужая', location='Дом', action='Чтение', owner=self.other)
+
+        response = self.client.patch('/batch/edit/', [{'id': habits[0].id, 'time': '09:00'},
+                                                      {'id': foreign.id, 'time': '09:00'}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), [{}, {'id': ['Привычка не найдена.']}])
+
+        with run_schedule_sync(), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch('/batch/edit/', [{'id': habit.id, 'time': f'{9 + i:02}:00'}
+                                                          for i, habit in enumerate(habits)], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([habit['title'] for habit in response.json()], ['Привычка 0', 'Привычка 1', 'Привычка 2'])
+        self.assertEqual(self.task_hours(), {habit.id: 9 + i for i, habit in enumerate(habits)})
+        habit = UsefulHabit.objects.get(id=habits[2].id)
+        self.assertEqual(habit.time, time(11, 0))
+        self.assertEqual(habit.next_due_at.astimezone(timezone.get_current_timezone()).hour, 11)
+
+    def test_batch_delete(self):
+        """Пачка удаляется вместе с задачами, ненайденная привычка отменяет удаление."""
+
+        with run_schedule_sync(), self.captureOnCommitCallbacks(execute=True):
+            ids = [habit['id'] for habit in self.client.post(
+                '/batch/create/', [self.habit_data(i) for i in range(3)], format='json').json()]
+
+        response = self.client.post('/batch/delete/', [ids[0], ids[0]], format='json')
+        self.assertEqual(response.json(), [{}, {'id': ['Привычка повторяется в запросе.']}])
+
+        with run_schedule_sync(), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/batch/delete/', ids, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(UsefulHabit.objects.filter(id__in=ids).exists())
+        self.assertEqual(self.task_hours(), {})
+        self.assertEqual(User.objects.get(id=self.user.id).habits_version, 2)
+
+
+class HabitChainTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='owner@test.ru', password='test', chat_id=6600)
+        self.other = User.objects.create(email='other@test.ru', password='test', chat_id=6601)
+        self.client.force_authenticate(user=self.user)
+        # цепочка first -> second -> third
+        self.third = UsefulHabit.objects.create(title='Третья', location='Дом', action='Кофе', owner=self.user)
+        self.second = UsefulHabit.objects.create(title='Вторая', location='Дом', action='Чай', owner=self.user,
+                                                 related_habit=self.third)
+        self.first = UsefulHabit.objects.create(title='Первая', location='Дом', action='Зарядка', owner=self.user,
+                                                related_habit=self.second)
+
+    def test_chain_single_query(self):
+        """Цепочка связанных привычек загружается одним запросом."""
+
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/chain/{self.first.id}/')
+
+        data = response.json()
+        self.assertEqual(data['habit']['id'], self.first.id)
+        self.assertEqual([habit['id'] for habit in data['related']], [self.second.id, self.third.id])
+        self.assertEqual((data['cycle'], data['truncated']), (False, False))
+        self.assertNotIn('dependents', data)
+
+    def test_chain_reverse_and_depth(self):
+        """reverse добавляет ссылающиеся привычки, depth обрезает цепочку."""
+
+        response = self.client.get(f'/chain/{self.third.id}/', {'reverse': 1})
+        self.assertEqual([habit['id'] for habit in response.json()['dependents']], [self.second.id, self.first.id])
+
+        response = self.client.get(f'/chain/{self.first.id}/', {'depth': 1})
+        self.assertEqual([habit['id'] for habit in response.json()['related']], [self.second.id])
+        self.assertTrue(response.json()['truncated'])
+
+        response = self.client.get(f'/chain/{self.first.id}/', {'depth': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_chain_cycle(self):
+        """Цикл в цепочке отмечается и не обходится повторно."""
+
+        UsefulHabit.objects.filter(id=self.third.id).update(related_habit=self.first)
+        response = self.client.get(f'/chain/{self.first.id}/', {'reverse': 1})
+
+        data = response.json()
+        self.assertTrue(data['cycle'])
+        self.assertEqual([habit['id'] for habit in data['related']], [self.second.id, self.third.id])
+        self.assertEqual([habit['id'] for habit in data['dependents']], [self.third.id, self.second.id])
+
+    def test_chain_foreign(self):
+        """Чужие привычки не попадают в цепочку, чужая исходная привычка не находится."""
+
+        foreign = UsefulHabit.objects.create(title='Чужая', location='Дом', action='Кофе', owner=self.other,
+                                             related_habit=self.first)
+        UsefulHabit.objects.filter(id=self.third.id).update(related_habit=foreign)
+
+        response = self.client.get(f'/chain/{self.first.id}/')
+        self.assertEqual([habit['id'] for habit in response.json()['related']], [self.second.id, self.third.id])
+
+        response = self.client.get(f'/chain/{foreign.id}/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class HabitRowSerializerTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='owner@test.ru', password='test', chat_id=6700)
+        self.client.force_authenticate(user=self.user)
+        good = UsefulHabit.objects.create(title='Кофе "утром"', location='Дом', action='Кофе', is_good=True,
+                                          is_public=True, owner=self.user, time=None)
+        UsefulHabit.objects.create(title='Зарядка', location='Парк', action='Бег', award=None, period=7,
+                                   time=time(6, 30, 15, 500), time_to_complete=timedelta(days=1, seconds=5),
+                                   related_habit=good, is_public=True, owner=self.user)
+        UsefulHabit.objects.create(title='Чтение', location='Дом', action='Книга', award='Кино', owner=self.user)
+
+    def test_same_json(self):
+        """Быстрый путь выводит тот же JSON байт в байт, что и UsefulHabitSerializer."""
+
+        queryset = UsefulHabit.objects.order_by('title', 'id')
+        serializer = HabitRowSerializer()
+        expected = JSONRenderer().render(UsefulHabitSerializer(queryset, many=True).data)
+
+        self.assertEqual(JSONRenderer().render(serializer.to_representation(serializer.values(queryset))), expected)
+
+    def test_list_endpoints(self):
+        """list/ и list_public/ в обоих режимах постраничного вывода отдают тот же JSON."""
+
+        for url, queryset in (('/list/', UsefulHabit.objects.filter(owner=self.user)),
+                              ('/list_public/', UsefulHabit.objects.filter(is_public=True))):
+            expected = UsefulHabitSerializer(queryset.order_by('title', 'id'), many=True).data
+            for params in ({}, {'cursor': ''}):
+                response = self.client.get(url, params)
+                self.assertEqual(JSONRenderer().render(response.data['results']), JSONRenderer().render(expected))
+
+
+class SparseFieldsTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='owner@test.ru', password='test', chat_id=6800)
+        self.client.force_authenticate(user=self.user)
+        self.good = UsefulHabit.objects.create(title='Кофе', location='Дом', action='Кофе', is_good=True,
+                                               is_public=True, owner=self.user)
+        self.habit = UsefulHabit.objects.create(title='Зарядка', location='Парк', action='Бег', owner=self.user,
+                                                related_habit=self.good, time=time(7, 0))
+
+    def test_fields_prune_json_and_sql(self):
+        """fields оставляет в ответе и в запросе только выбранные поля."""
+
+        for url in ('/list/', '/list_public/'):
+            for params in ({'fields': 'title,time'}, {'fields': 'time, title', 'cursor': ''}):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url, params)
+                self.assertEqual(list(response.data['results'][0]), ['title', 'time'])
+                select = queries.captured_queries[-1]['sql'].split(' FROM ')[0]
+                self.assertNotIn('"location"', select)
+                self.assertNotIn('"owner_id"', select)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/view/{self.habit.id}/', {'fields': 'title,time'})
+        self.assertEqual(response.json(), {'title': 'Зарядка', 'time': '07:00:00'})
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('"location"', queries[0]['sql'].split(' FROM ')[0])
+
+        response = self.client.get(f'/chain/{self.habit.id}/', {'fields': 'id,title'})
+        self.assertEqual(response.json()['related'], [{'id': self.good.id, 'title': 'Кофе'}])
+
+    def test_exclude(self):
+        """exclude убирает поля из полного набора."""
+
+        response = self.client.get(f'/view/{self.habit.id}/', {'exclude': 'owner,award,location'})
+        self.assertNotIn('owner', response.json())
+        self.assertNotIn('location', response.json())
+        self.assertIn('related_habit', response.json())
+
+        response = self.client.get('/list/', {'fields': 'title,owner', 'exclude': 'owner'})
+        self.assertEqual(list(response.data['results'][0]), ['title'])
+
+    def test_unknown_fields(self):
+        """Поля вне списка разрешенных и пустой набор отклоняются."""
+
+        response = self.client.get('/list/', {'fields': 'title,next_due_at'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('next_due_at', response.json()['fields'][0])
+
+        response = self.client.get(f'/view/{self.habit.id}/', {'exclude': 'nope'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get('/list/', {'fields': 'title', 'exclude': 'title'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_view_etag_depends_on_fields(self):
+        """ETag привычки зависит от набора полей."""
+
+        full = self.client.get(f'/view/{self.habit.id}/')
+        response = self.client.get(f'/view/{self.habit.id}/', {'fields': 'title'}, HTTP_IF_NONE_MATCH=full['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class HabitExportTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='owner@test.ru', password='test', chat_id=6900)
+        self.other = User.objects.create(email='other@test.ru', password='test', chat_id=6901)
+        self.client.force_authenticate(user=self.user)
+        for i in range(5):
+            UsefulHabit.objects.create(title=f'Привычка, {i}', location='Дом', action='Зарядка', owner=self.user,
+                                       award=None if i % 2 else 'Кино', time=time(7, i))
+        UsefulHabit.objects.create(title='Чужая', location='Дом', action='Чтение', owner=self.other)
+
+    @override_settings(HABIT_EXPORT_CHUNK_SIZE=2)
+    def test_export_jsonl(self):
+        """JSONL выгружается потоком, строки совпадают с ответом API."""
+
+        response = self.client.get('/export/jsonl/')
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="habits.jsonl"')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        expected = UsefulHabitSerializer(UsefulHabit.objects.filter(owner=self.user).order_by('id'), many=True).data
+        self.assertEqual(lines, [JSONRenderer().render(habit).decode() for habit in expected])
+
+    def test_export_csv(self):
+        """CSV с заголовком и выбранными полями, пустые значения - пустые ячейки."""
+
+        response = self.client.get('/export/csv/', {'fields': 'title,award,time'})
+
+        content = b''.join(response.streaming_content).decode()
+        self.assertEqual(content.splitlines()[:3], ['title,award,time', '"Привычка, 0",Кино,07:00:00',
+                                                    '"Привычка, 1",,07:01:00'])
+        self.assertEqual(len(content.splitlines()), 6)
+
+        response = self.client.get('/export/xml/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_export_command(self):
+        """Команда выгружает всю таблицу или привычки одного Владельца."""
+
+        output = StringIO()
+        call_command('export_habits', stdout=output, stderr=StringIO())
+        self.assertEqual(len(output.getvalue().splitlines()), 6)
+
+        output = StringIO()
+        call_command('export_habits', '--format', 'csv', '--owner', self.other.email, stdout=output,
+                     stderr=StringIO())
+        self.assertEqual(output.getvalue().splitlines()[1].split(',')[2], 'Чужая')
+
+
+class HabitImportTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='owner@test.ru', password='test', chat_id=7000)
+        self.client.force_authenticate(user=self.user)
+        schedule_registry.clear()
+        # строка 1 ссылается на строку 3 ниже по файлу, строка 4 - на строку 3 выше
+        self.rows = [
+            {'id': 10, 'title': 'Зарядка', 'location': 'Дом', 'action': 'Бег', 'related_habit': 30, 'time': '07:00'},
+            {'id': 20, 'title': 'Без названия места', 'action': 'Бег'},
+            {'id': 30, 'title': 'Кофе', 'location': 'Дом', 'action': 'Кофе', 'is_good': True, 'is_public': True},
+            {'id': 40, 'title': 'Чтение', 'location': 'Дом', 'action': 'Книга', 'related_habit': 30, 'period': 2},
+            {'id': 50, 'title': 'Прогулка', 'location': 'Парк', 'action': 'Шаги', 'related_habit': 10},
+        ]
+
+    def jsonl(self):
+        return '\n'.join(json.dumps(row, ensure_ascii=False) for row in self.rows) + '\nне json\n'
+
+    def test_import_jsonl(self):
+        """Строки пишутся пачками, ссылки разрешаются внутри файла, ошибки возвращаются по строкам."""
+
+        upload = SimpleUploadedFile('habits.jsonl', self.jsonl().encode())
+        with self.settings(HABIT_IMPORT_CHUNK_SIZE=2):
+            response = self.client.post('/import/jsonl/', {'file': upload}, format='multipart')
+
+        report = response.json()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((report['rows'], report['imported'], report['failed']), (6, 3, 3))
+        self.assertEqual(sorted(error['row'] for error in report['errors']), [2, 5, 6])
+
+        habits = {habit.title: habit for habit in UsefulHabit.objects.filter(owner=self.user)}
+        self.assertEqual(habits['Зарядка'].related_habit_id, habits['Кофе'].id)
+        self.assertEqual(habits['Чтение'].related_habit_id, habits['Кофе'].id)
+        self.assertIsNotNone(habits['Зарядка'].next_due_at)
+        self.assertEqual(PeriodicTask.objects.filter(
+            name__in=[f'HabitTask{habit.id}' for habit in habits.values()]).count(), 3)
+
+    def test_import_csv(self):
+        """CSV: пустые ячейки - отсутствующие значения."""
+
+        content = 'id,title,location,action,is_good,award,related_habit\n' \
+                  '1,Кофе,Дом,Кофе,true,,\n' \
+                  '2,Зарядка,Дом,Бег,false,,1\n'
+        upload = SimpleUploadedFile('habits.csv', content.encode())
+        response = self.client.post('/import/csv/', {'file': upload}, format='multipart')
+
+        self.assertEqual(response.json()['imported'], 2)
+        habit = UsefulHabit.objects.get(owner=self.user, title='Зарядка')
+        self.assertEqual((habit.award, habit.related_habit.title), (None, 'Кофе'))
+
+    def test_resume_from_checkpoint(self):
+        """Прерванная загрузка продолжается с сохраненного состояния без повторной записи строк."""
+
+        path = Path(tempfile.mkdtemp()) / 'habits.jsonl'
+        path.write_text(self.jsonl(), encoding='utf-8')
+
+        def checkpoint(habit_import):
+            HabitImportCheckpoint.objects.update_or_create(name='habits', defaults={
+                'owner': self.user, 'source': str(path.resolve()), 'state': habit_import.state})
+
+        def interrupt(habit_import):
+            raise KeyboardInterrupt
+
+        with path.open(encoding='utf-8') as lines, self.assertRaises(KeyboardInterrupt):
+            HabitImport(self.user, chunk_size=3).run(read_habit_rows(lines, 'jsonl'), checkpoint, interrupt)
+        self.assertEqual(HabitImportCheckpoint.objects.get(name='habits').state['rows'], 3)
+
+        call_command('import_habits', str(path), '--owner', self.user.email, '--checkpoint', 'habits',
+                     stdout=StringIO(), stderr=StringIO())
+
+        self.assertEqual(sorted(UsefulHabit.objects.filter(owner=self.user).values_list('title', flat=True)),
+                         ['Зарядка', 'Кофе', 'Чтение'])
+        self.assertFalse(HabitImportCheckpoint.objects.exists())
+
+    def test_checkpoint_in_chunk_transaction(self):
+        """Сбой при сохранении состояния откатывает пачку: при продолжении строки не записываются дважды."""
+
+        path = Path(tempfile.mkdtemp()) / 'habits.jsonl'
+        path.write_text(self.jsonl(), encoding='utf-8')
+
+        def checkpoint(habit_import):
+            if habit_import.rows > 3:
+                raise KeyboardInterrupt
+            HabitImportCheckpoint.objects.create(name='habits', owner=self.user, source=str(path.resolve()),
+                                                 state=habit_import.state)
+
+        with path.open(encoding='utf-8') as lines, self.assertRaises(KeyboardInterrupt):
+            HabitImport(self.user, chunk_size=3).run(read_habit_rows(lines, 'jsonl'), checkpoint)
+        self.assertEqual(sorted(UsefulHabit.objects.filter(owner=self.user).values_list('title', flat=True)),
+                         ['Зарядка', 'Кофе'])
+
+        call_command('import_habits', str(path), '--owner', self.user.email, '--checkpoint', 'habits',
+                     stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(sorted(UsefulHabit.objects.filter(owner=self.user).values_list('title', flat=True)),
+                         ['Зарядка', 'Кофе', 'Чтение'])
+
+    def test_import_upload_size(self):
+        """Большой файл не загружается в запросе."""
+
+        upload = SimpleUploadedFile('habits.jsonl', self.jsonl().encode())
+        with self.settings(HABIT_IMPORT_MAX_UPLOAD_SIZE=100):
+            response = self.client.post('/import/jsonl/', {'file': upload}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('import_habits', response.json()['file'][0])
+        self.assertFalse(UsefulHabit.objects.filter(owner=self.user).exists())
+
+
+class CompletionPartitionMigrationTestCase(TestCase):
+
+    def test_partitions_created_by_migration(self):
+        """Секции текущего и следующих месяцев создает миграция, без ночной задачи."""
+
+        current = month_start(timezone.now())
+        months = list_completion_partitions()
+        self.assertIn(current, months)
+        self.assertIn(add_months(current, settings.HABIT_COMPLETION_PARTITIONS_AHEAD), months)
+
+
+class HabitCompletionTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='owner@test.ru', password='test', chat_id=7600)
+        self.other = User.objects.create(email='other@test.ru', password='test', chat_id=7601)
+        self.client.force_authenticate(user=self.user)
+        self.habit = UsefulHabit.objects.create(title='Зарядка', location='Дом', action='Бег', owner=self.user)
+        self.foreign = UsefulHabit.objects.create(title='Чужая', location='Дом', action='Бег', owner=self.other)
+        ensure_completion_partitions(since=timezone.now() - timedelta(days=100))
+
+    def test_record_batch(self):
+        """Пачка отметок записывается одной вставкой в секции своих месяцев."""
+
+        now = timezone.now()
+        items = [{'habit': self.habit.id, 'completed_at': (now - timedelta(days=40 * i)).isoformat()}
+                 for i in range(3)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/completions/', items, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.json()), 3)
+        self.assertEqual(len([query for query in queries
+                              if query['sql'].startswith('INSERT INTO "main_habitcompletion"')]), 1)
+
+        response = self.client.get('/completions/', {'habit': self.habit.id})
+        self.assertEqual(len(response.json()), 1)
+        response = self.client.get('/completions/', {'since': (now - timedelta(days=100)).isoformat()})
+        self.assertEqual(len(response.json()), 3)
+
+    def test_record_errors(self):
+        """Чужая привычка и время в будущем - ошибки по элементам."""
+
+        response = self.client.post('/completions/', [
+            {'habit': self.foreign.id},
+            {'habit': self.habit.id, 'completed_at': (timezone.now() + timedelta(days=1)).isoformat()},
+            {'habit': self.habit.id},
+        ], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = response.json()
+        self.assertEqual(list(errors[0]), ['habit'])
+        self.assertEqual(errors[1], {'completed_at': ['Время выполнения не может быть в будущем.']})
+        self.assertEqual(errors[2], {})
+        self.assertFalse(HabitCompletion.objects.exists())
+
+    def test_record_invalid_habit_and_old_months(self):
+        """Неверный habit - ошибка 400, а не 500. Месяцы без секций отклоняются, секции по ним не создаются."""
+
+        partitions = list_completion_partitions()
+        response = self.client.post('/completions/', [
+            {'habit': [self.habit.id]},
+            {'habit': {}},
+            *({'habit': self.habit.id, 'completed_at': f'{year}-01-15T12:00:00Z'} for year in (1900, 1950)),
+        ], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = response.json()
+        self.assertEqual([list(item) for item in errors[:2]], [['habit'], ['habit']])
+        self.assertEqual(errors[2], {'completed_at': ['Отметки за этот месяц не хранятся.']})
+        self.assertEqual(list_completion_partitions(), partitions)
+
+    def test_append_only(self):
+        """Отметки не изменяются и не удаляются построчно, удаление привычки удаляет их в базе."""
+
+        completion = record_habit_completions([HabitCompletion(habit=self.habit, user=self.user,
+                                                               completed_at=timezone.now())])[0]
+        with self.assertRaises(NotSupportedError):
+            HabitCompletion.objects.filter(id=completion.id).update(completed_at=timezone.now())
+        with self.assertRaises(NotSupportedError):
+            HabitCompletion.objects.all().delete()
+        with self.assertRaises(NotSupportedError):
+            completion.save()
+
+        self.habit.delete()
+        self.assertFalse(HabitCompletion.objects.exists())
+
+    def test_drop_partitions(self):
+        """Старые месяцы удаляются секциями целиком."""
+
+        old = datetime(2020, 1, 15, tzinfo=dt_timezone.utc)
+        completion_partitions.ensure([month_start(old), month_start(old + timedelta(days=31))])
+        record_habit_completions([
+            HabitCompletion(habit=self.habit, user=self.user, completed_at=old),
+            HabitCompletion(habit=self.habit, user=self.user, completed_at=old + timedelta(days=31)),
+        ])
+        # отложенные проверки внешних ключей тестовой транзакции не дают удалить секцию
+        connection.check_constraints()
+
+        self.assertEqual(drop_completion_partitions(datetime(2020, 2, 1, tzinfo=dt_timezone.utc)),
+                         [datetime(2020, 1, 1, tzinfo=dt_timezone.utc)])
+        self.assertEqual([completion.completed_at for completion in HabitCompletion.objects.all()],
+                         [old + timedelta(days=31)])
+
+
+class HabitStatsTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='owner@test.ru', password='test', chat_id=7700)
+        self.client.force_authenticate(user=self.user)
+        self.habit = UsefulHabit.objects.create(title='Зарядка', location='Дом', action='Бег', owner=self.user)
+        self.weekly = UsefulHabit.objects.create(title='Уборка', location='Дом', action='Уборка', owner=self.user,
+                                                 period=UsefulHabit.PERIOD_DAY07)
+        self.today = timezone.localdate(timezone.now(), timezone.get_default_timezone())
+        ensure_completion_partitions(since=timezone.now() - timedelta(days=40))
+
+    def complete(self, habit, *days_ago):
+        record_habit_completions(HabitCompletion(
+            habit=habit, user=self.user,
+            completed_at=datetime.combine(self.today - timedelta(days=days), time(12),
+                                          tzinfo=timezone.get_default_timezone()),
+        ) for days in days_ago)
+        return HabitStats.objects.get(habit=habit)
+
+    def test_incremental_streaks(self):
+        """Серии обновляются при добавлении отметок, в том числе задним числом"""
+
+        stats = self.complete(self.habit, 6, 5, 5)
+        self.assertEqual((stats.total, stats.current_streak, stats.longest_streak), (3, 2, 2))
+
+        stats = self.complete(self.habit, 2, 1)
+        self.assertEqual((stats.current_streak, stats.longest_streak), (2, 2))
+        self.assertEqual(stats.last_period, self.today - timedelta(days=1))
+
+        # пропущенные дни соединяют две серии
+        stats = self.complete(self.habit, 4, 3)
+        self.assertEqual((stats.total, stats.current_streak, stats.longest_streak), (7, 6, 6))
+        self.assertEqual(HabitPeriodCount.objects.get(habit=self.habit, period_start=self.today - timedelta(days=5))
+                         .count, 2)
+        self.assertEqual(rebuild_habit_stats([self.habit.id], dry_run=True), [])
+
+    def test_weekly_period(self):
+        """Отметки одной недели - один период, серия считается неделями"""
+
+        monday = period_start(self.today, UsefulHabit.PERIOD_DAY07)
+        self.assertEqual(monday.weekday(), 0)
+        days = (self.today - monday).days
+        stats = self.complete(self.weekly, days, days + 7, days + 6, days + 21)
+        self.assertEqual((stats.total, stats.current_streak, stats.longest_streak), (4, 2, 2))
+        self.assertEqual(HabitPeriodCount.objects.filter(habit=self.weekly).count(), 3)
+
+    def test_rebuild(self):
+        """Пересчет находит и исправляет разошедшиеся сводки, в том числе после смены периодичности"""
+
+        self.complete(self.habit, 3, 2, 1)
+        HabitStats.objects.filter(habit=self.habit).update(longest_streak=10)
+
+        self.assertEqual(rebuild_habit_stats([self.habit.id, self.weekly.id], dry_run=True), [self.habit.id])
+        output = StringIO()
+        call_command('rebuild_habit_stats', stdout=output)
+        self.assertIn('Расхождений: 1', output.getvalue())
+        self.assertEqual(HabitStats.objects.get(habit=self.habit).longest_streak, 3)
+
+        UsefulHabit.objects.filter(id=self.habit.id).update(period=UsefulHabit.PERIOD_DAY02)
+        stats = self.complete(self.habit, 0)
+        self.assertEqual((stats.period, stats.total), (UsefulHabit.PERIOD_DAY02, 4))
+        self.assertEqual(rebuild_habit_stats([self.habit.id], dry_run=True), [])
+
+    def test_stats_endpoint(self):
+        """Сводки выводятся без чтения истории отметок, серия прерывается после пропущенного периода"""
+
+        self.complete(self.habit, 12, 11, 10)
+        self.complete(self.weekly, 0)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/stats/', {'days': 10})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse([query for query in queries if 'main_habitcompletion' in query['sql']])
+
+        habit, weekly = response.json()['results']
+        self.assertEqual((habit['habit'], habit['total'], habit['current_streak'], habit['longest_streak']),
+                         (self.habit.id, 3, 0, 3))
+        self.assertEqual((habit['adherence'], habit['periods']), (0.0, []))
+        self.assertEqual((weekly['current_streak'], weekly['adherence']), (1, 0.5))
+        self.assertEqual(weekly['periods'], [{'start': period_start(self.today, 7).isoformat(), 'count': 1}])
+
+        response = self.client.get('/stats/', {'days': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_period_change_rebuilds_stats(self):
+        """Смена периодичности пересчитывает сводку при сохранении привычки, вывод сводок только читает"""
+
+        self.complete(self.habit, 3, 1)
+        with run_schedule_sync(), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(f'/edit/{self.habit.id}/', {'period': UsefulHabit.PERIOD_DAY02})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        stats = HabitStats.objects.get(habit=self.habit)
+        self.assertEqual(stats.period, UsefulHabit.PERIOD_DAY02)
+        self.assertEqual(rebuild_habit_stats([self.habit.id], dry_run=True), [])
+
+        with CaptureQueriesContext(connection) as queries:
+            row = self.client.get('/stats/').json()['results'][0]
+        self.assertFalse([query for query in queries if 'FOR UPDATE' in query['sql']])
+        self.assertEqual((row['period'], row['longest_streak']), (UsefulHabit.PERIOD_DAY02, stats.longest_streak))
+
+
+class DueHabitDispatcherTestCase(TestCase):
+
+    def setUp(self):
+        schedule_registry.clear()
+        self.user = User.objects.create(email='dispatcher@test.ru', password='test', chat_id='1234567891')
+        self.slot = timezone.make_aware(datetime(2024, 3, 17, 7, 0))
+
+        self.daily_habit = UsefulHabit.objects.create(
+            title='Ежедневная', location='Дом', action='Зарядка', period=1,
+            time=time(7, 0, 15), next_due_at=self.slot, owner=self.user
+        )
+        self.weekly_habit = UsefulHabit.objects.create(
+            title='Еженедельная', location='Дом', action='Уборка', period=7,
+            time=time(7, 0), next_due_at=self.slot, owner=self.user
+        )
+        self.other_time_habit = UsefulHabit.objects.create(
+            title='Вечерняя', location='Дом', action='Чтение', period=1,
+            time=time(21, 0), next_due_at=self.slot.replace(hour=21), owner=self.user
+        )
+
+    def test_due_habits_in_slot(self):
+        """Выборка привычек минуты по времени следующего напоминания, просроченные тоже выбираются."""
+
+        self.assertEqual(list(get_due_habit_ids(self.slot - timedelta(minutes=1))), [])
+        self.assertEqual(
+            list(get_due_habit_ids(self.slot + timedelta(seconds=30))),
+            [self.daily_habit.id, self.weekly_habit.id]
+        )
+        self.assertEqual(
+            list(get_due_habit_ids(self.slot + timedelta(minutes=1))),
+            [self.daily_habit.id, self.weekly_habit.id]
+        )
+
+    def test_dispatch_after_skipped_minute(self):
+        """Привычки пропущенной минуты ставятся в очередь следующим запуском, пропущенные периоды пропускаются."""
+
+        later = self.slot + timedelta(minutes=1)
+        now = later + timedelta(seconds=5)
+        with mock.patch('main.tasks.drain_reminder_outbox.delay'), \
+                mock.patch('main.services.timezone.now', return_value=now):
+            dispatch_due_habits(later.isoformat())
+
+        self.assertEqual(
+            sorted(ReminderOutbox.objects.filter(scheduled_for=later).values_list('habit_id', flat=True)),
+            [self.daily_habit.id, self.weekly_habit.id]
+        )
+        self.daily_habit.refresh_from_db()
+        self.assertEqual(self.daily_habit.next_due_at, self.slot + timedelta(days=1))
+
+        # следующим утром привычка снова ставится в очередь, вечерняя - за пропущенный вечер
+        next_day = self.slot + timedelta(days=1)
+        with mock.patch('main.tasks.drain_reminder_outbox.delay'), \
+                mock.patch('main.services.timezone.now', return_value=next_day + timedelta(seconds=5)):
+            dispatch_due_habits(next_day.isoformat())
+
+        self.assertEqual(
+            sorted(ReminderOutbox.objects.filter(scheduled_for=next_day).values_list('habit_id', flat=True)),
+            [self.daily_habit.id, self.other_time_habit.id]
+        )
+
+    def test_create_habit_sets_next_due_at(self):
+        """При создании привычки через API заполняется время следующего напоминания."""
+
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        response = client.post('/create/', data={'title': 'Привычка', 'location': 'Марс', 'action': 'Дыхание',
+                                                 'period': 1, 'time_to_complete': 60, 'time': '18:00'})
+
+        next_due_at = timezone.localtime(UsefulHabit.objects.get(id=response.json()['id']).next_due_at)
+        self.assertEqual((next_due_at.hour, next_due_at.minute), (18, 0))
+        self.assertTrue(timezone.now() <= next_due_at < timezone.now() + timedelta(days=1))
+
+    def test_send_advances_next_due_at(self):
+        """После отправки напоминание переносится на period дней."""
+
+        with mock.patch('main.tasks.send_message'), \
+                mock.patch('main.tasks.timezone.now', return_value=self.slot + timedelta(seconds=5)):
+            send_messages_bot([self.weekly_habit.id])
+
+        self.weekly_habit.refresh_from_db()
+        self.assertEqual(self.weekly_habit.next_due_at, self.slot + timedelta(days=7))
+
+    def test_next_due_at_set_by_model(self):
+        """next_due_at задает модель: при создании без API, изменении времени и массовой вставке."""
+
+        habit = UsefulHabit.objects.create(title='Из админки', location='Дом', action='Зарядка', time=time(18, 0),
+                                           period=3, owner=self.user)
+        self.assertEqual(timezone.localtime(habit.next_due_at).time(), time(18, 0))
+        self.assertTrue(timezone.now() <= habit.next_due_at < timezone.now() + timedelta(days=1))
+
+        habit = UsefulHabit.objects.get(id=habit.id)
+        habit.title = 'Без смены расписания'
+        habit.save()
+        self.assertEqual(timezone.localtime(habit.next_due_at).time(), time(18, 0))
+
+        habit.time = time(19, 30)
+        habit.save(update_fields=['time'])
+        self.assertEqual(timezone.localtime(UsefulHabit.objects.get(id=habit.id).next_due_at).time(), time(19, 30))
+
+        created, = UsefulHabit.objects.bulk_create([UsefulHabit(title='Пачка', location='Дом', action='Зарядка',
+                                                                time=time(20, 0), owner=self.user)])
+        self.assertEqual(timezone.localtime(UsefulHabit.objects.get(id=created.id).next_due_at).time(), time(20, 0))
+
+        created = UsefulHabit.objects.get(id=created.id)
+        created.time = time(21, 0)
+        UsefulHabit.objects.bulk_update([created], ['time'])
+        self.assertEqual(timezone.localtime(UsefulHabit.objects.get(id=created.id).next_due_at).time(), time(21, 0))
+
+    def test_backfill_next_due_at(self):
+        """Команда пересчитывает прошедшие и незаполненные значения."""
+
+        UsefulHabit.objects.filter(id=self.daily_habit.id).update(next_due_at=None)
+
+        call_command('backfill_next_due_at', stdout=mock.Mock())
+
+        for habit in UsefulHabit.objects.all():
+            self.assertGreaterEqual(habit.next_due_at, timezone.now())
+            self.assertEqual(timezone.localtime(habit.next_due_at).time(), habit.time.replace(second=0))
+
+    @override_settings(HABIT_DISPATCH_BATCH_SIZE=1, HABIT_OUTBOX_WORKERS=3)
+    def test_dispatch_due_habits_into_outbox(self):
+        """Диспетчер ставит привычки минуты в очередь без дублей и запускает воркеры очереди."""
+
+        with mock.patch('main.tasks.drain_reminder_outbox.delay') as delay:
+            dispatch_due_habits(self.slot.isoformat())
+            # повтор минуты после переключения beat
+            UsefulHabit.objects.filter(id=self.daily_habit.id).update(next_due_at=self.slot)
+            dispatch_due_habits(self.slot.isoformat())
+
+        self.assertEqual(
+            sorted(ReminderOutbox.objects.filter(scheduled_for=self.slot).values_list('habit_id', flat=True)),
+            [self.daily_habit.id, self.weekly_habit.id]
+        )
+        self.assertEqual(delay.call_count, 6)
+
+        self.weekly_habit.refresh_from_db()
+        self.assertGreater(self.weekly_habit.next_due_at, timezone.now())
+        self.assertEqual((self.weekly_habit.next_due_at - self.slot) % timedelta(days=7), timedelta(0))
+
+    @override_settings(HABIT_DISPATCHER_ENABLED=True)
+    def test_create_habit_without_periodic_task(self):
+        """В режиме диспетчера задача на привычку не создается."""
+
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        response = client.post('/create/', data={'title': 'Привычка', 'location': 'Марс', 'action': 'Дыхание',
+                                                 'period': 1, 'time_to_complete': 60, 'time': '18:00'})
+
+        self.assertEqual(
+            PeriodicTask.objects.filter(name=f'HabitTask{response.json()["id"]}').exists(),
+            False
+        )
+
+    @override_settings(HABIT_DISPATCHER_ENABLED=True)
+    def test_migrate_habit_tasks(self):
+        """Команда переноса удаляет задачи HabitTask*."""
+
+        with override_settings(HABIT_DISPATCHER_ENABLED=False):
+            create_schedule_and_habit_periodic_task(self.daily_habit)
+
+        call_command('migrate_habit_tasks', stdout=mock.Mock())
+
+        self.assertEqual(
+            PeriodicTask.objects.filter(name__startswith='HabitTask').exists(),
+            False
+        )
+
+
+class HabitScheduleSyncTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        schedule_registry.clear()
+        self.user = User.objects.create(email='sync@test.ru', password='test', chat_id=6100)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_schedule_follows_habit(self):
+        """Задача создается, обновляется и удаляется вместе с привычкой после фиксации транзакции."""
+
+        with run_schedule_sync(), self.captureOnCommitCallbacks(execute=True):
+            habit_id = self.client.post('/create/', data={'title': 'Привычка', 'location': 'Дом',
+                                                          'action': 'Зарядка', 'period': 1,
+                                                          'time_to_complete': 60, 'time': '18:00'}).json()['id']
+        self.assertEqual(PeriodicTask.objects.get(name=f'HabitTask{habit_id}').crontab.hour, '18')
+
+        with run_schedule_sync(), self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/edit/{habit_id}/', data={'time': '07:15', 'time_to_complete': 60,
+                                                          'is_good': False})
+        self.assertEqual(PeriodicTask.objects.get(name=f'HabitTask{habit_id}').crontab.hour, '7')
+
+        with run_schedule_sync(), self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/delete/{habit_id}/')
+        self.assertFalse(PeriodicTask.objects.filter(name=f'HabitTask{habit_id}').exists())
+
+    @override_settings(HABIT_SCHEDULE_SYNC_COALESCE=True)
+    def test_repeated_edits_coalesced(self):
+        """Несколько изменений привычки до запуска синхронизации ставят одну задачу."""
+
+        habit = UsefulHabit.objects.create(title='Привычка', location='Дом', action='Зарядка', owner=self.user)
+        with mock.patch('main.tasks.sync_habit_schedule.apply_async') as apply_async:
+            for hour in (8, 9, 10):
+                with self.captureOnCommitCallbacks(execute=True):
+                    habit.time = time(hour, 0)
+                    habit.save()
+            self.assertEqual(apply_async.call_count, 1)
+
+            sync_habit_schedule(habit.id)
+            self.assertEqual(PeriodicTask.objects.get(name=f'HabitTask{habit.id}').crontab.hour, '10')
+
+            with self.captureOnCommitCallbacks(execute=True):
+                habit.save()
+            self.assertEqual(apply_async.call_count, 2)
+
+    @override_settings(HABIT_SCHEDULE_SYNC_COALESCE=False)
+    def test_edits_not_coalesced_without_shared_cache(self):
+        """Без общего кэша отметка не ставится: каждое изменение синхронизируется."""
+
+        habit = UsefulHabit.objects.create(title='Привычка', location='Дом', action='Зарядка', owner=self.user)
+        with mock.patch('main.tasks.sync_habit_schedule.apply_async') as apply_async:
+            for hour in (8, 9):
+                with self.captureOnCommitCallbacks(execute=True):
+                    habit.time = time(hour, 0)
+                    habit.save()
+            self.assertEqual(apply_async.call_count, 2)
+
+    def test_reconcile_habit_tasks(self):
+        """Сверка удаляет задачи без привычки, создает недостающие и исправляет устаревшие."""
+
+        habit = UsefulHabit.objects.create(title='Привычка', location='Дом', action='Зарядка',
+                                           time=time(9, 0), owner=self.user)
+        stale = UsefulHabit.objects.create(title='Привычка', location='Дом', action='Зарядка',
+                                           time=time(10, 0), owner=self.user)
+        create_schedule_and_habit_periodic_task(UsefulHabit(id=habit.id + 1000, time=time(9, 0), period=1))
+        create_schedule_and_habit_periodic_task(stale)
+        PeriodicTask.objects.filter(name=f'HabitTask{habit.id}').delete()
+        UsefulHabit.objects.filter(id=stale.id).update(time=time(10, 30))
+
+        call_command('reconcile_habit_tasks', stdout=mock.Mock())
+
+        tasks = PeriodicTask.objects.filter(name__startswith='HabitTask').select_related('crontab')
+        self.assertEqual(sorted(task.name for task in tasks), sorted([f'HabitTask{habit.id}', f'HabitTask{stale.id}']))
+        self.assertEqual(tasks.get(name=f'HabitTask{stale.id}').crontab.minute, '30')
+
+    def test_rebuild_habit_schedules(self):
+        """Пересборка создает недостающие задачи, исправляет расписания и удаляет лишние."""
+
+        stale, missing, untimed = [
+            UsefulHabit.objects.create(title='Привычка', location='Дом', action='Зарядка', time=habit_time,
+                                       owner=self.user)
+            for habit_time in (time(6, 0), time(7, 0), time(8, 0))
+        ]
+        create_schedule_and_habit_periodic_task(stale)
+        create_schedule_and_habit_periodic_task(untimed)
+        UsefulHabit.objects.filter(id=stale.id).update(time=time(6, 30))
+        UsefulHabit.objects.filter(id=untimed.id).update(time=None)
+
+        call_command('rebuild_habit_schedules', '--dry-run', stdout=mock.Mock())
+        self.assertEqual(PeriodicTask.objects.filter(name__startswith='HabitTask').count(), 2)
+
+        call_command('rebuild_habit_schedules', '--chunk-size', '2', stdout=mock.Mock())
+
+        tasks = PeriodicTask.objects.filter(name__startswith='HabitTask').select_related('crontab')
+        self.assertEqual(
+            {task.name: (task.crontab.hour, task.crontab.minute) for task in tasks},
+            {f'HabitTask{stale.id}': ('6', '30'), f'HabitTask{missing.id}': ('7', '0')}
+        )
+
+    def test_registry_skips_schedule_queries(self):
+        """Прогретый реестр подставляет расписание без запросов к таблице crontab."""
+
+        habit = UsefulHabit.objects.create(title='Привычка', location='Дом', action='Зарядка',
+                                           time=time(6, 45), period=2, owner=self.user)
+        schedule = CrontabSchedule.objects.create(**schedule_registry.schedule_fields((6, 45, 2)))
+        schedule_registry.warm()
+
+        with CaptureQueriesContext(connection) as queries:
+            create_schedule_and_habit_periodic_task(habit)
+
+        self.assertFalse([query for query in queries if 'django_celery_beat_crontabschedule' in query['sql']])
+        self.assertEqual(PeriodicTask.objects.get(name=f'HabitTask{habit.id}').crontab_id, schedule.id)
+
+    def test_registry_miss_reuses_existing_schedule(self):
+        """Промах реестра находит уже созданное другим процессом расписание, а не создает дубль."""
+
+        schedule_registry.warm()
+        fields = schedule_registry.schedule_fields((5, 5, 3))
+        first = CrontabSchedule.objects.create(**fields)
+        CrontabSchedule.objects.create(**fields)
+
+        self.assertEqual(schedule_registry.get(time(5, 5), 3).id, first.id)
+        self.assertEqual(CrontabSchedule.objects.filter(**fields).count(), 2)
+
+    def test_registry_ignores_rolled_back_schedules(self):
+        """Расписание, созданное в откаченной транзакции, не остается в реестре."""
+
+        schedule_registry.warm()
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            schedule_registry.get(time(4, 4), 2)
+            raise RuntimeError
+
+        schedule = schedule_registry.get(time(4, 4), 2)
+        self.assertTrue(CrontabSchedule.objects.filter(id=schedule.id).exists())
+
+    def test_registry_reloaded_after_foreign_delete(self):
+        """Расписание, удаленное другим процессом, находится заново, и задача записывается."""
+
+        habit = UsefulHabit.objects.create(title='Привычка', location='Дом', action='Зарядка',
+                                           time=time(6, 15), period=1, owner=self.user)
+        schedule = CrontabSchedule.objects.create(**schedule_registry.schedule_fields((6, 15, 1)))
+        schedule_registry.warm()
+        # удаление без сигналов, как в другом процессе
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {CrontabSchedule._meta.db_table} WHERE id = %s', [schedule.id])
+
+        self.assertEqual(sync_habit_periodic_tasks([habit]), (1, 0, 0))
+        crontab = PeriodicTask.objects.get(name=f'HabitTask{habit.id}').crontab
+        self.assertEqual((crontab.hour, crontab.minute), ('6', '15'))
+
+
+@override_settings(TELEGRAM_RATE_LIMIT_BACKEND='main.ratelimit.MemoryTokenBucket',
+                   TELEGRAM_RATE_LIMIT_LOCATION='tests', TELEGRAM_BOT_TOKEN='token')
+class TelegramSenderTestCase(TestCase):
+
+    def setUp(self):
+        self.users = [
+            User.objects.create(email=f'sender{i}@test.ru', password='test', chat_id=2000 + i)
+            for i in range(5)
+        ]
+        self.habits = [
+            UsefulHabit.objects.create(title=f'Привычка {i}', location='Дом', action='Зарядка',
+                                       time=time(7, 0), owner=user)
+            for i, user in enumerate(self.users)
+        ]
+
+    def test_send_batch_reuses_connection(self):
+        """Пачка отправляется через одно keep-alive соединение."""
+
+        with FakeTelegramServer() as server, override_settings(TELEGRAM_API_URL=server.url):
+            send_messages_bot([habit.id for habit in self.habits])
+
+        self.assertEqual(
+            sorted(int(message['chat_id']) for message in server.messages),
+            [user.chat_id for user in self.users]
+        )
+        self.assertEqual(server.messages[0]['path'], '/bottoken/sendMessage')
+        self.assertEqual(server.connections, 1)
+
+    def test_token_bucket_limits(self):
+        """Токен списывается только когда он есть во всех корзинах."""
+
+        token_bucket = MemoryTokenBucket()
+        buckets = [('global', 30, 30), ('chat', 1, 1)]
+
+        self.assertEqual(token_bucket.reserve(buckets), 0)
+        self.assertGreater(token_bucket.reserve(buckets), 0)
+        self.assertEqual(token_bucket.reserve([('global', 30, 30), ('other_chat', 1, 1)]), 0)
+
+
+@override_settings(TELEGRAM_RATE_LIMIT_BACKEND='main.ratelimit.MemoryTokenBucket',
+                   TELEGRAM_RATE_LIMIT_LOCATION='delivery', TELEGRAM_BOT_TOKEN='token')
+class DeliveryEngineTestCase(TestCase):
+
+    def setUp(self):
+        self.reminders = [Reminder(i, 3000 + i, f'Напоминание {i}') for i in range(20)]
+
+    def test_deliver_with_bounded_concurrency(self):
+        """Все напоминания доставлены, соединений не больше заданной конкурентности."""
+
+        with FakeTelegramServer(delay=0.01) as server, override_settings(TELEGRAM_API_URL=server.url):
+            report = DeliveryEngine(concurrency=4).run(self.reminders).report()
+
+        self.assertEqual(report['sent'], 20)
+        self.assertEqual(report['failed'], 0)
+        self.assertLessEqual(server.connections, 4)
+        self.assertLessEqual(report['p50'], report['p99'])
+
+    def test_retry_with_backoff(self):
+        """Ошибки сервера повторяются, после исчерпания попыток напоминание считается неотправленным."""
+
+        with FakeTelegramServer(fail_first=2) as server, \
+                override_settings(TELEGRAM_API_URL=server.url, TELEGRAM_CHAT_RATE_LIMIT=100):
+            stats = DeliveryEngine(concurrency=1, max_attempts=2, backoff=0).run(self.reminders[:3])
+
+        self.assertEqual(stats.failed, [0])
+        self.assertEqual(stats.sent, [1, 2])
+        self.assertEqual(len(stats.latencies), 4)
+
+    def test_delivery_worker_catches_up_missed_minutes(self):
+        """Привычки минут, пропущенных за долгий разбор очереди, отправляются следующим проходом."""
+
+        user = User.objects.create(email='worker@test.ru', password='test', chat_id=3100)
+        habit = UsefulHabit.objects.create(title='Привычка', location='Дом', action='Зарядка', time=time(7, 0),
+                                           next_due_at=timezone.now() - timedelta(minutes=5), owner=user)
+
+        with FakeTelegramServer() as server, override_settings(TELEGRAM_API_URL=server.url):
+            call_command('delivery_worker', '--once', stdout=StringIO())
+
+        self.assertEqual([message['chat_id'] for message in server.messages], ['3100'])
+        self.assertEqual(ReminderOutbox.objects.get(habit=habit).status, ReminderOutbox.STATUS_SENT)
+        habit.refresh_from_db()
+        self.assertGreater(habit.next_due_at, timezone.now())
+
+    def test_no_wait_after_last_rate_limited_attempt(self):
+        """После последней попытки retry_after ответа 429 не выжидается."""
+
+        with FakeTelegramServer(fail_first=1, retry_after=30) as server, \
+                override_settings(TELEGRAM_API_URL=server.url, TELEGRAM_CHAT_RATE_LIMIT=100):
+            started = timezone.now()
+            stats = DeliveryEngine(concurrency=1, max_attempts=1).run(self.reminders[:1])
+
+        self.assertLess(timezone.now() - started, timedelta(seconds=5))
+        self.assertEqual(stats.errors, {0: 'Too Many Requests'})
+
+    def test_worker_failure_stops_delivery(self):
+        """Неожиданная ошибка корутины прерывает доставку, а не оставляет ее ждать места в очереди."""
+
+        reminders = [Reminder(i, 3000 + i, f'Напоминание {i}') for i in range(50)]
+        with mock.patch('main.delivery.get_token_bucket', side_effect=ConnectionError('redis')):
+            with self.assertRaises(ConnectionError):
+                DeliveryEngine(concurrency=2).run(reminders)
+
+    def test_deliver_reminders_async_task(self):
+        """Задача асинхронной доставки отправляет привычки и переносит следующее напоминание."""
+
+        user = User.objects.create(email='async@test.ru', password='test', chat_id=4000)
+        habit = UsefulHabit.objects.create(title='Привычка', location='Дом', action='Зарядка', time=time(7, 0),
+                                           next_due_at=timezone.now(), owner=user)
+
+        with FakeTelegramServer() as server, override_settings(TELEGRAM_API_URL=server.url):
+            report = deliver_reminders_async([habit.id])
+
+        self.assertEqual(report['sent'], 1)
+        self.assertEqual(server.messages[0]['chat_id'], '4000')
+        habit.refresh_from_db()
+        self.assertGreater(habit.next_due_at, timezone.now())
+
+
+@override_settings(TELEGRAM_RATE_LIMIT_BACKEND='main.ratelimit.MemoryTokenBucket',
+                   TELEGRAM_RATE_LIMIT_LOCATION='outbox', TELEGRAM_BOT_TOKEN='token',
+                   HABIT_DELIVERY_ENGINE='sync', HABIT_OUTBOX_MAX_ATTEMPTS=2)
+class ReminderOutboxTestCase(TestCase):
+
+    def setUp(self):
+        self.slot = timezone.now().replace(second=0, microsecond=0)
+        self.entries = []
+        for i in range(2):
+            user = User.objects.create(email=f'outbox{i}@test.ru', password='test', chat_id=5000 + i)
+            habit = UsefulHabit.objects.create(title=f'Привычка {i}', location='Дом', action='Зарядка',
+                                               time=time(7, 0), owner=user)
+            self.entries.append(ReminderOutbox.objects.create(habit=habit, scheduled_for=self.slot,
+                                                              next_attempt_at=timezone.now()))
+
+    def test_drain_marks_sent_and_retries_failed(self):
+        """Отправленные помечаются, неудачные откладываются, после последней попытки - не отправлено."""
+
+        with FakeTelegramServer(fail_first=1) as server, override_settings(TELEGRAM_API_URL=server.url):
+            self.assertEqual(drain_reminder_outbox(), 1)
+
+        statuses = dict(ReminderOutbox.objects.values_list('status', 'attempts'))
+        self.assertEqual(statuses, {ReminderOutbox.STATUS_SENT: 0, ReminderOutbox.STATUS_PENDING: 1})
+        retry = ReminderOutbox.objects.get(status=ReminderOutbox.STATUS_PENDING)
+        self.assertGreater(retry.next_attempt_at, timezone.now())
+
+        ReminderOutbox.objects.filter(id=retry.id).update(next_attempt_at=timezone.now())
+        with FakeTelegramServer(fail_first=1) as server, override_settings(TELEGRAM_API_URL=server.url):
+            self.assertEqual(drain_reminder_outbox(), 0)
+
+        retry.refresh_from_db()
+        self.assertEqual((retry.status, retry.attempts), (ReminderOutbox.STATUS_FAILED, 2))
+        self.assertIsNotNone(retry.last_error)
+
+    def test_missing_habit_fails_with_reason(self):
+        """Запись без напоминания сразу помечается как не отправленная с причиной."""
+
+        reminders = load_habit_reminders([self.entries[0].habit_id])
+        with FakeTelegramServer() as server, override_settings(TELEGRAM_API_URL=server.url), \
+                mock.patch('main.tasks.load_habit_reminders', return_value=reminders):
+            self.assertEqual(drain_reminder_outbox(), 1)
+
+        entry = ReminderOutbox.objects.get(id=self.entries[1].id)
+        self.assertEqual((entry.status, entry.attempts, entry.last_error),
+                         (ReminderOutbox.STATUS_FAILED, 1, OUTBOX_HABIT_MISSING_MESSAGE))
+
+    def test_prune_processed_entries(self):
+        """Обработанные записи старше срока хранения удаляются, ожидающие остаются."""
+
+        ReminderOutbox.objects.filter(id=self.entries[0].id).update(status=ReminderOutbox.STATUS_SENT)
+        later = self.slot + settings.HABIT_OUTBOX_RETENTION + timedelta(minutes=1)
+
+        self.assertEqual(prune_reminder_outbox(self.slot), 0)
+        self.assertEqual(prune_reminder_outbox(later), 1)
+        self.assertEqual(list(ReminderOutbox.objects.values_list('id', flat=True)), [self.entries[1].id])
+
+    def test_claimed_entries_are_leased(self):
+        """Захваченные записи не выдаются повторно до истечения аренды."""
+
+        self.assertEqual(len(claim_reminder_outbox(10)), 2)
+        self.assertEqual(claim_reminder_outbox(10), [])
+
+
+class ReminderOutboxSkipLockedTestCase(TransactionTestCase):
+
+    @mock.patch('main.tasks.sync_habit_schedule.apply_async')
+    def test_claim_skips_locked_rows(self, apply_async):
+        """Воркер пропускает строки, заблокированные другим воркером."""
+
+        user = User.objects.create(email='locked@test.ru', password='test', chat_id=5100)
+        habit = UsefulHabit.objects.create(title='Привычка', location='Дом', action='Зарядка', owner=user)
+        locked, free = [
+            ReminderOutbox.objects.create(habit=habit, scheduled_for=timezone.now() + timedelta(minutes=i),
+                                          next_attempt_at=timezone.now())
+            for i in range(2)
+        ]
+
+        claimed = []
+
+        def claim():
+            claimed.extend(claim_reminder_outbox(10))
+            connection.close()
+
+        with transaction.atomic():
+            ReminderOutbox.objects.select_for_update().get(id=locked.id)
+            worker = Thread(target=claim)
+            worker.start()
+            worker.join()
+
+        self.assertEqual([entry.id for entry in claimed], [free.id])
+
+
+@override_settings(TELEGRAM_RATE_LIMIT_BACKEND='main.ratelimit.MemoryTokenBucket',
+                   TELEGRAM_RATE_LIMIT_LOCATION='digest', TELEGRAM_BOT_TOKEN='token',
+                   HABIT_DELIVERY_ENGINE='sync', TELEGRAM_CHAT_RATE_LIMIT=100)
+class DigestTestCase(TestCase):
+
+    def setUp(self):
+        self.slot = timezone.localtime().replace(second=0, microsecond=0)
+        self.digest_user = User.objects.create(email='digest@test.ru', password='test', chat_id=6000, digest=True)
+        self.plain_user = User.objects.create(email='plain@test.ru', password='test', chat_id=6001)
+
+        pleasant = UsefulHabit.objects.create(title='Приятная', location='Дом', action='Выпить кофе', is_good=True,
+                                              owner=self.digest_user)
+        for i, extra in enumerate([{}, {'award': 'Шоколадка'}, {'related_habit': pleasant}]):
+            UsefulHabit.objects.create(title=f'Сводка {i}', location='Дом', action=f'Действие {i}',
+                                       time=self.slot.time(), next_due_at=self.slot, owner=self.digest_user, **extra)
+        for i in range(2):
+            UsefulHabit.objects.create(title=f'Обычная {i}', location='Дом', action=f'Действие {i}',
+                                       time=self.slot.time(), next_due_at=self.slot, owner=self.plain_user)
+
+    def test_digest_groups_in_single_query(self):
+        """Привычки пользователей со сводкой группируются одним запросом."""
+
+        with self.assertNumQueries(1):
+            groups = list(get_due_digest_habit_ids(self.slot))
+
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(len(groups[0]), 3)
+
+    def test_digest_reduces_outbound_calls(self):
+        """Пять привычек одной минуты уходят тремя сообщениями: одна сводка и два обычных."""
+
+        with mock.patch('main.tasks.drain_reminder_outbox.delay'):
+            dispatch_due_habits(self.slot.isoformat())
+
+        with FakeTelegramServer() as server, override_settings(TELEGRAM_API_URL=server.url):
+            self.assertEqual(drain_reminder_outbox(), 3)
+
+        self.assertEqual(len(server.messages), 3)
+        digest = next(message['text'] for message in server.messages if message['chat_id'] == '6000')
+        self.assertIn('Действие 0', digest)
+        self.assertIn('вознаграждение: [Шоколадка]', digest)
+        self.assertIn('затем [Выпить кофе]', digest)
+
+
+@override_settings(HABIT_REMINDER_CACHE_SIZE=100)
+class ReminderQueryCountTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        reminder_cache.clear()
+        self.user = User.objects.create(email='queries@test.ru', password='test', chat_id=7000)
+        self.habits = [
+            UsefulHabit.objects.create(title=f'Привычка {i}', location='Дом', action=f'Действие {i}',
+                                       time=time(7, 0), next_due_at=timezone.now(), owner=self.user)
+            for i in range(5)
+        ]
+
+    def test_send_message_bot_queries(self):
+        """Одиночная отправка: загрузка напоминания и перенос, на теплом кэше - только перенос."""
+
+        with mock.patch('main.tasks.send_message') as send, self.assertNumQueries(2):
+            send_message_bot(self.habits[0].id)
+        send.assert_called_once_with(7000, 'Я буду [Действие 0] в [07:00:00] в [Дом] !')
+
+        with mock.patch('main.tasks.send_message'), self.assertNumQueries(1):
+            send_message_bot(self.habits[0].id)
+
+    def test_send_messages_bot_queries_per_batch(self):
+        """Число запросов пачки не зависит от ее размера."""
+
+        habit_ids = [habit.id for habit in self.habits]
+        with mock.patch('main.tasks.send_message') as send, self.assertNumQueries(2):
+            send_messages_bot(habit_ids)
+        self.assertEqual(send.call_count, 5)
+
+        with mock.patch('main.tasks.send_message'), self.assertNumQueries(1):
+            send_messages_bot(habit_ids)
+
+    def test_evicted_version_not_reused(self):
+        """Вытесненная версия заменяется новой: напоминание, сохраненное до вытеснения, не читается."""
+
+        habit = self.habits[0]
+        load_habit_reminders([habit.id])
+        self.assertIsNotNone(cache.get(reminder_version_key(habit.id)))
+
+        cache.delete(reminder_version_key(habit.id))
+        UsefulHabit.objects.filter(id=habit.id).update(action='Новое действие')
+
+        self.assertEqual(load_habit_reminders([habit.id])[habit.id].text,
+                         'Я буду [Новое действие] в [07:00:00] в [Дом] !')
+
+    def test_cache_invalidated_on_habit_and_user_save(self):
+        """Сохранение привычки или пользователя сбрасывает кэш напоминаний."""
+
+        habit = self.habits[0]
+        with mock.patch('main.tasks.send_message'):
+            send_message_bot(habit.id)
+
+        habit.action = 'Новое действие'
+        habit.save()
+        self.user.chat_id = 7001
+        self.user.save()
+
+        with mock.patch('main.tasks.send_message') as send, self.assertNumQueries(2):
+            send_message_bot(habit.id)
+        send.assert_called_once_with(7001, 'Я буду [Новое действие] в [07:00:00] в [Дом] !')
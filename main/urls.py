@@ -1,6 +1,9 @@
 from django.urls import path
 from main.views import (UsefulHabitListAPIView, UsefulHabitViewAPIView, UsefulHabitCreateAPIView,
-                        UsefulHabitUpdateAPIView, UsefulHabitDeleteAPIView, UsefulHabitPublicListAPIView)
+                        UsefulHabitUpdateAPIView, UsefulHabitDeleteAPIView, UsefulHabitPublicListAPIView,
+                        UsefulHabitBatchCreateAPIView, UsefulHabitBatchUpdateAPIView, UsefulHabitBatchDeleteAPIView,
+                        UsefulHabitChainAPIView, UsefulHabitExportAPIView,
+                        UsefulHabitImportAPIView, HabitCompletionAPIView, UsefulHabitStatsAPIView)
 from main.apps import MainConfig
 
 app_name = MainConfig.name
@@ -8,8 +11,16 @@ app_name = MainConfig.name
 urlpatterns = [
     path('create/', UsefulHabitCreateAPIView.as_view(), name='useful_habit_create'),
     path('list/', UsefulHabitListAPIView.as_view(), name='useful_habit_list'),
+    path('stats/', UsefulHabitStatsAPIView.as_view(), name='useful_habit_stats'),
     path('view/<int:pk>/', UsefulHabitViewAPIView.as_view(), name='useful_habit_view'),
+    path('chain/<int:pk>/', UsefulHabitChainAPIView.as_view(), name='useful_habit_chain'),
     path('edit/<int:pk>/', UsefulHabitUpdateAPIView.as_view(), name='useful_habit_edit'),
     path('delete/<int:pk>/', UsefulHabitDeleteAPIView.as_view(), name='useful_habit_delete'),
+    path('export/<str:file_format>/', UsefulHabitExportAPIView.as_view(), name='useful_habit_export'),
+    path('import/<str:file_format>/', UsefulHabitImportAPIView.as_view(), name='useful_habit_import'),
     path('list_public/', UsefulHabitPublicListAPIView.as_view(), name='useful_habit_list_public'),
+    path('completions/', HabitCompletionAPIView.as_view(), name='habit_completions'),
+    path('batch/create/', UsefulHabitBatchCreateAPIView.as_view(), name='useful_habit_batch_create'),
+    path('batch/edit/', UsefulHabitBatchUpdateAPIView.as_view(), name='useful_habit_batch_edit'),
+    path('batch/delete/', UsefulHabitBatchDeleteAPIView.as_view(), name='useful_habit_batch_delete'),
 ]
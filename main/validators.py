@@ -13,7 +13,7 @@ def one_of_related_habit_or_award(value):
 def time_to_complete_no_more_120seconds(value):
     """Проверка на запрет использования времени выполнения привычки более 2-х минут"""
 
-    if value['time_to_complete'] > timedelta(minutes=2):
+    if value.get('time_to_complete') is not None and value['time_to_complete'] > timedelta(minutes=2):
         raise serializers.ValidationError('Время выполнения должно быть не больше 120 секунд.')
 
 
@@ -28,7 +28,57 @@ def only_good_habit_into_related_habit(value):
 def good_habit_cannot_have_award_or_related_habit(value):
     """Проверка на использование в приятных привычках вознаграждения или связанной привычки."""
 
-    if (value['is_good'] and
+    if (value.get('is_good') and
             ((value.get('related_habit') is not None
               or value.get('award') is not None))):
         raise serializers.ValidationError('У приятной привычки не может быть вознаграждения или связанной привычки.')
+
+
+def only_own_habit_into_related_habit(value, owner):
+    """Проверка на использование в связанных привычках только своих привычек."""
+
+    if (value.get('related_habit') is not None
+            and value['related_habit'].owner_id != owner.id):
+        raise serializers.ValidationError('Ошибка. Связанная привычка должна принадлежать вам')
+
+
+class OwnRelatedHabit:
+    """Проверка владельца связанной привычки для сериализатора: владелец - пользователь запроса"""
+    requires_context = True
+
+    def __call__(self, value, serializer):
+        request = serializer.context.get('request')
+        if request is not None:
+            only_own_habit_into_related_habit(value, request.user)
+
+
+HABIT_VALIDATORS = [
+    one_of_related_habit_or_award,
+    time_to_complete_no_more_120seconds,
+    only_good_habit_into_related_habit,
+    good_habit_cannot_have_award_or_related_habit,
+]
+
+
+def validate_habits(values, owner=None):
+    """
+    Проверка пачки привычек всей цепочкой проверок.
+    Связанные привычки должны быть загружены заранее, см. UsefulHabitListSerializer, запросов к базе нет.
+    :param values: проверенные по полям данные привычек.
+    :param owner: владелец пачки, если задан - проверяется и владелец связанных привычек.
+    :return: списки ошибок по элементам, пустой список - элемент без ошибок.
+    """
+    validators = list(HABIT_VALIDATORS)
+    if owner is not None:
+        validators.append(lambda value: only_own_habit_into_related_habit(value, owner))
+
+    errors = []
+    for value in values:
+        item_errors = []
+        for validator in validators:
+            try:
+                validator(value)
+            except serializers.ValidationError as exc:
+                item_errors.extend(exc.detail)
+        errors.append(item_errors)
+    return errors
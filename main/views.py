@@ -1,35 +1,89 @@
-from rest_framework import generics
+from datetime import timedelta
+from io import TextIOWrapper
+
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404, StreamingHttpResponse
+from django.utils import timezone
+from rest_framework import generics, serializers, status
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import IsAuthenticated
-from main.models import UsefulHabit
-from main.serializers import UsefulHabitSerializer
+from rest_framework.response import Response
+from main.changes import deferred_habit_changes
+from main.etags import habit_list_etag, habit_etag, is_not_modified, not_modified_response, set_validators
+from main.exports import EXPORT_FORMATS, export_habit_lines
+from main.imports import IMPORT_FORMATS, HabitImport, read_habit_rows
+from main.fieldsets import get_habit_fields, habit_columns
+from main.feed_cache import public_feed_key, get_public_feed_page, set_public_feed_page
+from main.completions import list_completion_partitions, record_habit_completions
+from main.models import UsefulHabit, HabitCompletion
+from main.serializers import (UsefulHabitSerializer, HabitRowSerializer, HabitCompletionSerializer,
+                              HabitStatsSerializer)
+from main.services import get_habit_chain
+from main.stats import habit_stats_rows
 from main.permissions import IsOwner
-from main.paginators import MainPaginator
+from main.paginators import HabitPaginator
+
+
+class OwnerHabitMixin:
+    """
+    Отбор привычек по Владельцу в запросе: привычка загружается одним запросом в get_object,
+    а чужая привычка не находится (404), не раскрывая ее существование.
+    """
+
+    def get_queryset(self):
+        return UsefulHabit.objects.filter(owner=self.request.user)
+
+
+class HabitFieldsMixin:
+    """
+    Выбор полей ответа параметрами fields и exclude (см. main.fieldsets):
+    невыбранные поля не выводятся сериализатором и не загружаются из базы.
+    """
+
+    def get_field_names(self):
+        if not hasattr(self, '_field_names'):
+            self._field_names = get_habit_fields(self.request)
+        return self._field_names
 
-from main.services import create_schedule_and_habit_periodic_task, update_habit_periodic_task
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.get_field_names())
+        return super().get_serializer(*args, **kwargs)
+
+
+class HabitRowListMixin(HabitFieldsMixin):
+    """
+    Быстрый вывод списка: страница загружается .values() и выводится HabitRowSerializer
+    с тем же JSON, что и у UsefulHabitSerializer.
+    """
+    row_serializer_class = HabitRowSerializer
+
+    def list(self, request, *args, **kwargs):
+        serializer = self.row_serializer_class(self.get_field_names())
+        rows = serializer.values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(serializer.to_representation(page))
+        return Response(serializer.to_representation(rows))
 
 
 class UsefulHabitCreateAPIView(generics.CreateAPIView):
     """
     Представление для создания экземпляра модели Привычка.
+    Расписание напоминания создается после фиксации транзакции задачей sync_habit_schedule, см. main.signals.
     """
     permission_classes = [IsAuthenticated]
     serializer_class = UsefulHabitSerializer
 
-    def perform_create(self, serializer):
-        """
-        После создания (сохранения) экземпляра модели Привычка вызываем функцию создания расписания напоминания.
-        """
-        new_habit = serializer.save()
-        create_schedule_and_habit_periodic_task(new_habit)
 
-
-class UsefulHabitListAPIView(generics.ListAPIView):
+class UsefulHabitListAPIView(HabitRowListMixin, generics.ListAPIView):
     """
     Представление для отображения реквизитов списка экземпляров модели Привычка принадлежащих Владельцу.
     """
     permission_classes = [IsAuthenticated]
     serializer_class = UsefulHabitSerializer
-    pagination_class = MainPaginator
+    pagination_class = HabitPaginator
 
     def get_queryset(self):
         """
@@ -38,38 +92,324 @@ class UsefulHabitListAPIView(generics.ListAPIView):
         """
         return UsefulHabit.objects.filter(owner=self.request.user)
 
+    def list(self, request, *args, **kwargs):
+        """Неизмененный список отдается ответом 304 без запроса привычек и сериализации"""
+        etag = habit_list_etag(request)
+        if is_not_modified(request, etag):
+            return not_modified_response(etag)
+        return set_validators(super().list(request, *args, **kwargs), etag)
+
 
-class UsefulHabitViewAPIView(generics.RetrieveAPIView):
+class UsefulHabitViewAPIView(HabitFieldsMixin, OwnerHabitMixin, generics.RetrieveAPIView):
     """Отображение одной привычки"""
     permission_classes = [IsAuthenticated, IsOwner]
     serializer_class = UsefulHabitSerializer
-    queryset = UsefulHabit.objects.all()
+
+    def get_queryset(self):
+        """Кроме выбранных полей загружаются владелец для IsOwner и время изменения для ETag"""
+        queryset = super().get_queryset()
+        field_names = self.get_field_names()
+        if field_names is None:
+            return queryset
+        return queryset.only(*habit_columns(field_names), 'owner_id', 'updated_at')
+
+    def retrieve(self, request, *args, **kwargs):
+        """Неизмененная привычка отдается ответом 304 без сериализации"""
+        instance = self.get_object()
+        etag = habit_etag(instance.id, instance.updated_at, self.get_field_names())
+        if is_not_modified(request, etag, instance.updated_at):
+            return not_modified_response(etag, instance.updated_at)
+        return set_validators(Response(self.get_serializer(instance).data), etag, instance.updated_at)
 
 
-class UsefulHabitUpdateAPIView(generics.UpdateAPIView):
+class UsefulHabitChainAPIView(HabitFieldsMixin, generics.GenericAPIView):
+    """
+    Привычка с цепочкой связанных привычек одним запросом вместо обхода по view/<pk>/.
+    Параметры: depth - глубина цепочки, не больше HABIT_CHAIN_MAX_DEPTH;
+    reverse=1 - добавить привычки, которые ссылаются на эту (dependents); fields и exclude - поля привычек.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = UsefulHabitSerializer
+
+    def get_depth(self):
+        depth = self.request.query_params.get('depth')
+        if depth is None:
+            return settings.HABIT_CHAIN_MAX_DEPTH
+        if not depth.isdigit() or not 1 <= int(depth) <= settings.HABIT_CHAIN_MAX_DEPTH:
+            raise ValidationError({'depth': [f'Ожидается число от 1 до {settings.HABIT_CHAIN_MAX_DEPTH}.']})
+        return int(depth)
+
+    def get(self, request, *args, **kwargs):
+        reverse = request.query_params.get('reverse', '').lower() in ('1', 'true')
+        field_names = self.get_field_names()
+        columns = None if field_names is None else habit_columns(field_names)
+        chain = get_habit_chain(self.kwargs['pk'], request.user.id, self.get_depth(), reverse, columns)
+        if chain is None:
+            raise Http404
+
+        data = {
+            'habit': self.get_serializer(chain['habit']).data,
+            'related': self.get_serializer(chain['related'], many=True).data,
+            'cycle': chain['cycle'],
+            'truncated': chain['truncated'],
+        }
+        if reverse:
+            data['dependents'] = self.get_serializer(chain['dependents'], many=True).data
+        return Response(data)
+
+
+class UsefulHabitStatsAPIView(OwnerHabitMixin, generics.ListAPIView):
+    """
+    Сводки выполнения привычек Владельца: серии и отметки по периодам за последние days дней
+    (по умолчанию HABIT_STATS_DAYS). Сводки обновляются при добавлении отметок, история отметок не читается.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = HabitStatsSerializer
+    pagination_class = HabitPaginator
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('stats')
+
+    def get_days(self):
+        days = self.request.query_params.get('days')
+        if days is None:
+            return settings.HABIT_STATS_DAYS
+        if not days.isdigit() or not 1 <= int(days) <= settings.HABIT_STATS_MAX_DAYS:
+            raise ValidationError({'days': [f'Ожидается число от 1 до {settings.HABIT_STATS_MAX_DAYS}.']})
+        return int(days)
+
+    def list(self, request, *args, **kwargs):
+        days = self.get_days()
+        habits = self.paginate_queryset(self.get_queryset())
+        return self.get_paginated_response(self.get_serializer(habit_stats_rows(habits, days), many=True).data)
+
+
+class UsefulHabitExportAPIView(HabitFieldsMixin, OwnerHabitMixin, generics.GenericAPIView):
+    """
+    Потоковая выгрузка всех привычек Владельца файлом export/jsonl/ или export/csv/.
+    Поддерживает fields и exclude, см. main.fieldsets.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = UsefulHabitSerializer
+
+    def get(self, request, *args, **kwargs):
+        file_format = self.kwargs['file_format']
+        if file_format not in EXPORT_FORMATS:
+            raise Http404
+        lines = export_habit_lines(self.get_queryset(), file_format, settings.HABIT_EXPORT_CHUNK_SIZE,
+                                   self.get_field_names())
+        response = StreamingHttpResponse(lines, content_type=EXPORT_FORMATS[file_format])
+        response['Content-Disposition'] = f'attachment; filename="habits.{file_format}"'
+        return response
+
+
+class UsefulHabitImportAPIView(generics.GenericAPIView):
+    """
+    Загрузка привычек из файла JSONL или CSV (поле file) в import/jsonl/ или import/csv/.
+    Файл читается построчно, строки записываются пачками, ответ - отчет о загрузке с ошибками по строкам.
+    Загрузка идет в запросе, поэтому файл не больше HABIT_IMPORT_MAX_UPLOAD_SIZE, большие загружаются import_habits.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = UsefulHabitSerializer
+    parser_classes = [MultiPartParser]
+
+    def post(self, request, *args, **kwargs):
+        file_format = self.kwargs['file_format']
+        if file_format not in IMPORT_FORMATS:
+            raise Http404
+        upload = request.FILES.get('file')
+        if upload is None:
+            raise ValidationError({'file': ['Ожидается файл.']})
+        if upload.size > settings.HABIT_IMPORT_MAX_UPLOAD_SIZE:
+            raise ValidationError({'file': [
+                f'Файл больше {settings.HABIT_IMPORT_MAX_UPLOAD_SIZE} байт, '
+                f'большие файлы загружаются командой import_habits.'
+            ]})
+
+        lines = TextIOWrapper(upload.file, encoding='utf-8', newline='')
+        habit_import = HabitImport(request.user).run(read_habit_rows(lines, file_format))
+        return Response(habit_import.report(), status=status.HTTP_201_CREATED)
+
+
+class UsefulHabitUpdateAPIView(OwnerHabitMixin, generics.UpdateAPIView):
     """Обновления данных привычки"""
     permission_classes = [IsAuthenticated, IsOwner]
     serializer_class = UsefulHabitSerializer
-    queryset = UsefulHabit.objects.all()
 
-    def perform_update(self, serializer):
-        """Обновление расписания"""
-        new_habit = serializer.save()
-        update_habit_periodic_task(new_habit)
 
-
-class UsefulHabitDeleteAPIView(generics.DestroyAPIView):
+class UsefulHabitDeleteAPIView(OwnerHabitMixin, generics.DestroyAPIView):
     """Удаление привычки"""
     permission_classes = [IsAuthenticated, IsOwner]
     serializer_class = UsefulHabitSerializer
-    queryset = UsefulHabit.objects.all()
 
 
-class UsefulHabitPublicListAPIView(generics.ListAPIView):
+class UsefulHabitPublicListAPIView(HabitRowListMixin, generics.ListAPIView):
     """Отображение списка публичных привычек"""
     permission_classes = [IsAuthenticated]
     serializer_class = UsefulHabitSerializer
+    pagination_class = HabitPaginator
 
     def get_queryset(self):
         """Фильтр по признаку публичность"""
         return UsefulHabit.objects.filter(is_public=True)
+
+    def list(self, request, *args, **kwargs):
+        """Страницы ленты отдаются из кэша, сброс - в main.signals"""
+        if not settings.HABIT_PUBLIC_FEED_CACHE_TIMEOUT:
+            return super().list(request, *args, **kwargs)
+
+        key = public_feed_key(request)
+        data = get_public_feed_page(key)
+        if data is not None:
+            return Response(data, headers={'X-Cache': 'HIT'})
+
+        response = super().list(request, *args, **kwargs)
+        set_public_feed_page(key, response.data)
+        response['X-Cache'] = 'MISS'
+        return response
+
+
+class BatchMixin:
+    """Проверка тела пакетного запроса: непустой список не длиннее HABIT_BATCH_MAX_SIZE"""
+
+    def get_batch(self):
+        items = self.request.data
+        if not isinstance(items, list) or not items:
+            raise ValidationError({'non_field_errors': ['Ожидается непустой список.']})
+        if len(items) > settings.HABIT_BATCH_MAX_SIZE:
+            raise ValidationError({'non_field_errors': [
+                f'В одном запросе не больше {settings.HABIT_BATCH_MAX_SIZE} элементов.'
+            ]})
+        return items
+
+    def find_habits(self, ids):
+        """
+        Привычки Владельца по идентификаторам одним запросом.
+        :return: привычки по идентификатору и ошибки по элементам: ненайденные и повторы.
+        """
+        habits = self.get_queryset().in_bulk([habit_id for habit_id in ids if isinstance(habit_id, int)])
+        errors = []
+        seen = set()
+        for habit_id in ids:
+            if habit_id not in habits:
+                errors.append({'id': ['Привычка не найдена.']})
+            elif habit_id in seen:
+                errors.append({'id': ['Привычка повторяется в запросе.']})
+            else:
+                errors.append({})
+                seen.add(habit_id)
+        return habits, errors
+
+
+class UsefulHabitBatchCreateAPIView(BatchMixin, generics.CreateAPIView):
+    """
+    Создание пачки привычек одним запросом: проверка всех элементов, одна вставка,
+    расписания напоминаний - одной задачей после фиксации. Ошибки возвращаются по элементам.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = UsefulHabitSerializer
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=self.get_batch(), many=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class UsefulHabitBatchUpdateAPIView(OwnerHabitMixin, BatchMixin, generics.GenericAPIView):
+    """
+    Редактирование пачки привычек: элементы с id и изменяемыми полями.
+    Элемент проверяется вместе с текущими значениями привычки, все изменения пишутся одним bulk_update.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = UsefulHabitSerializer
+
+    def patch(self, request, *args, **kwargs):
+        items = self.get_batch()
+        ids = [item.get('id') if isinstance(item, dict) else None for item in items]
+        habits, errors = self.find_habits(ids)
+
+        found = [index for index, error in enumerate(errors) if not error]
+        instances = [habits[ids[index]] for index in found]
+        data = []
+        for index, habit in zip(found, instances):
+            current = self.get_serializer(habit).data
+            current.pop('owner')
+            data.append({**current, **items[index]})
+
+        serializer = self.get_serializer(instances, data=data, many=True)
+        if not serializer.is_valid():
+            for index, error in zip(found, serializer.errors):
+                errors[index] = error
+        if any(errors):
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer.save()
+        return Response(serializer.data)
+
+
+class UsefulHabitBatchDeleteAPIView(OwnerHabitMixin, BatchMixin, generics.GenericAPIView):
+    """Удаление пачки привычек по списку идентификаторов. Если хоть одна не найдена, ничего не удаляется."""
+    permission_classes = [IsAuthenticated]
+    serializer_class = UsefulHabitSerializer
+
+    def post(self, request, *args, **kwargs):
+        ids = self.get_batch()
+        habits, errors = self.find_habits(ids)
+        if any(errors):
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic(), deferred_habit_changes():
+            self.get_queryset().filter(id__in=habits).delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class HabitCompletionAPIView(BatchMixin, generics.GenericAPIView):
+    """
+    Отметки о выполнении привычек Владельца.
+    GET - отметки за период since..until (по умолчанию последние 30 дней), можно по одной привычке habit.
+    POST - пачка отметок [{"habit": id, "completed_at": время}], записывается одной вставкой.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = HabitCompletionSerializer
+
+    def get_datetime_param(self, name, default):
+        value = self.request.query_params.get(name)
+        if value is None:
+            return default
+        try:
+            return serializers.DateTimeField().to_internal_value(value)
+        except ValidationError as exc:
+            raise ValidationError({name: exc.detail})
+
+    def get(self, request, *args, **kwargs):
+        until = self.get_datetime_param('until', timezone.now())
+        since = self.get_datetime_param('since', until - timedelta(days=30))
+        completions = HabitCompletion.objects.filter(user=request.user, completed_at__gte=since,
+                                                     completed_at__lt=until)
+        habit_id = request.query_params.get('habit')
+        if habit_id is not None:
+            if not habit_id.isdigit():
+                raise ValidationError({'habit': ['Ожидается идентификатор привычки.']})
+            completions = completions.filter(habit_id=habit_id)
+
+        completions = completions.order_by('-completed_at')[:settings.HABIT_COMPLETION_LIST_LIMIT]
+        return Response(self.get_serializer(completions, many=True).data)
+
+    def post(self, request, *args, **kwargs):
+        items = self.get_batch()
+        # неверные значения habit (списки, словари) отклонит сериализатор
+        ids = {item['habit'] for item in items if isinstance(item, dict) and isinstance(item.get('habit'), int)}
+        habits = UsefulHabit.objects.filter(owner=request.user).only('id').in_bulk(ids)
+
+        serializer = self.get_serializer(data=items, many=True, context={
+            **self.get_serializer_context(),
+            'related_habits': habits,
+            'completion_months': set(list_completion_partitions()),
+        })
+        serializer.is_valid(raise_exception=True)
+        completions = record_habit_completions(
+            HabitCompletion(habit=attrs['habit'], user=request.user, completed_at=attrs['completed_at'])
+            for attrs in serializer.validated_data
+        )
+        return Response(self.get_serializer(completions, many=True).data, status=status.HTTP_201_CREATED)
@@ -0,0 +1,146 @@
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from users.models import User
+
+
+class UserCache:
+    """
+    Ограниченный LRU кэш пользователей в памяти процесса со сроком жизни записей.
+    Запись - значения полей пользователя без пароля и его версия из общего кэша Django: сохранение
+    пользователя в любом процессе меняет версию, и запись перестает совпадать.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, user_id, version):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] != version or entry[2] < time.monotonic():
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+    def set(self, user_id, version, values):
+        with self._lock:
+            self._entries[user_id] = (version, values, time.monotonic() + settings.USER_AUTH_CACHE_TIMEOUT)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > settings.USER_AUTH_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def discard(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_cache = UserCache()
+
+
+def user_version_key(user_id):
+    return f'auth-user:version:{user_id}'
+
+
+def user_values_key(user_id, version):
+    return f'auth-user:{user_id}:{version}'
+
+
+def user_version(user_id):
+    """Версия пользователя в общем кэше. После вытеснения ключа начинается новая версия."""
+    key = user_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def user_field_names():
+    """
+    Поля пользователя в кэше. Хэш пароля в общий кэш не попадает: у пользователя из кэша password отложен,
+    для проверки отзыва токена хранится только md5 хэша, он же записан в самом токене.
+    """
+    return [field.attname for field in User._meta.concrete_fields if field.attname != 'password']
+
+
+def get_cached_user(user_id, version):
+    """
+    Пользователь из кэша процесса, а при промахе - из общего кэша. Каждый вызов получает свой экземпляр.
+    :return: пользователь и md5 хэша его пароля или None, если его нет в кэше.
+    """
+    entry = user_cache.get(user_id, version)
+    if entry is None:
+        entry = cache.get(user_values_key(user_id, version))
+        if entry is None:
+            return None
+        user_cache.set(user_id, version, entry)
+    values, password_hash = entry
+    return User.from_db('default', user_field_names(), values), password_hash
+
+
+def cache_user(user, version):
+    """:param version: версия, прочитанная до загрузки пользователя: сброс во время загрузки ее сменит"""
+    entry = (tuple(getattr(user, name) for name in user_field_names()), get_md5_hash_password(user.password))
+    cache.set(user_values_key(user.id, version), entry, timeout=settings.USER_AUTH_CACHE_TIMEOUT)
+    user_cache.set(user.id, version, entry)
+
+
+def invalidate_cached_users(user_ids):
+    """
+    Сброс пользователей в кэшах всех процессов сменой версии. Повторяется после фиксации транзакции:
+    пользователь, прочитанный другим процессом до фиксации, не останется в кэше.
+    """
+    user_ids = list(user_ids)
+    if not settings.USER_AUTH_CACHE_SIZE or not user_ids:
+        return
+
+    def bump():
+        user_cache.discard(user_ids)
+        cache.set_many({user_version_key(user_id): uuid4().hex for user_id in user_ids}, timeout=None)
+
+    bump()
+    transaction.on_commit(bump)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    Аутентификация по JWT с пользователем из кэша вместо запроса к базе на каждый запрос.
+    Кэш сбрасывается при сохранении пользователя, в том числе смене пароля и отключении, см. users.signals.
+    """
+
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        if not settings.USER_AUTH_CACHE_SIZE or user_id is None or api_settings.USER_ID_FIELD != 'id':
+            return super().get_user(validated_token)
+
+        version = user_version(user_id)
+        cached = get_cached_user(user_id, version)
+        if cached is None:
+            user = super().get_user(validated_token)
+            cache_user(user, version)
+            return user
+
+        # те же проверки, что и для пользователя из базы
+        user, password_hash = cached
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        if api_settings.CHECK_REVOKE_TOKEN and validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != password_hash:
+            raise AuthenticationFailed(_("The user's password has been changed."), code='password_changed')
+        return user
@@ -0,0 +1,51 @@
+import csv
+import json
+import time
+from itertools import islice
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from main.imports import parse_jsonl
+from users.services import password_hasher, provision_users
+
+
+class Command(BaseCommand):
+    """Массовое создание пользователей из файла CSV или JSONL с полями email, chat_id, password, digest"""
+    help = 'Создает пользователей пачками: пароли хэшируются пулом процессов, вставка - одним запросом на пачку'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='файл пользователей')
+        parser.add_argument('--format', choices=('csv', 'jsonl'), help='формат файла, по умолчанию - по расширению')
+        parser.add_argument('--chunk-size', type=int, default=settings.USER_PROVISION_CHUNK_SIZE,
+                            help='пользователей в одной вставке')
+        parser.add_argument('--workers', type=int, default=settings.USER_PROVISION_WORKERS,
+                            help='процессов для хэширования паролей')
+
+    def handle(self, *args, **options):
+        path = Path(options['path'])
+        file_format = options['format'] or path.suffix.lstrip('.')
+        if file_format not in ('csv', 'jsonl'):
+            raise CommandError(f'Неизвестный формат файла {path.name}, укажите --format')
+
+        started = time.perf_counter()
+        processed = created = failed = 0
+        with path.open(encoding='utf-8', newline='') as lines, password_hasher(options['workers']) as hash_passwords:
+            # нечитаемая строка JSONL - ошибка записи, а не остановка загрузки после записанных пачек
+            rows = csv.DictReader(lines) if file_format == 'csv' else parse_jsonl(lines)
+            while chunk := list(islice(rows, options['chunk_size'])):
+                users, errors = provision_users(chunk, hash_passwords)
+                for number, item_errors in enumerate(errors, start=processed + 1):
+                    if item_errors:
+                        self.stderr.write(f'Запись {number}: {json.dumps(item_errors, ensure_ascii=False)}')
+                processed += len(chunk)
+                created += len(users)
+                failed += sum(1 for item_errors in errors if item_errors)
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f'Записей: {processed}, создано: {created}, {created / elapsed:.0f} в секунду')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Создано пользователей: {created} из {processed} за {time.perf_counter() - started:.1f} с. '
+            f'Ошибок: {failed}'
+        ))
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='digest',
+            field=models.BooleanField(default=False, help_text='Привычки одного времени приходят одним сообщением', verbose_name='сводка напоминаний'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-18 13:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_user_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='habits_version',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Растет при каждом изменении привычек, см. ETag списка', verbose_name='версия привычек'),
+        ),
+    ]
@@ -8,6 +8,10 @@ class User(AbstractUser):
 
     email = models.EmailField(unique=True, verbose_name='почта')
     chat_id = models.IntegerField(unique=True, verbose_name='идентификатор телеграм')
+    digest = models.BooleanField(default=False, verbose_name='сводка напоминаний',
+                                 help_text='Привычки одного времени приходят одним сообщением')
+    habits_version = models.PositiveIntegerField(default=0, editable=False, verbose_name='версия привычек',
+                                                 help_text='Растет при каждом изменении привычек, см. ETag списка')
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
@@ -1,4 +1,5 @@
 from rest_framework import serializers
+from rest_framework.validators import UniqueValidator
 from users.models import User
 
 
@@ -8,12 +9,14 @@ class UserSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = User
-        fields = ['email', 'password', 'chat_id', 'is_active']
+        fields = ['email', 'password', 'chat_id', 'is_active', 'digest']
 
     def create(self, validated_data):
-        user = User.objects.create(
+        """Пароль хэшируется до вставки, пользователь записывается одним запросом"""
+        user = User(
             email=validated_data['email'],
             chat_id=validated_data['chat_id'],
+            digest=validated_data.get('digest', False),
             is_staff=False,
             is_superuser=False,
             is_active=True
@@ -22,3 +25,23 @@ class UserSerializer(serializers.ModelSerializer):
         user.set_password(validated_data['password'])
         user.save()
         return user
+
+
+class UserProfileSerializer(serializers.ModelSerializer):
+    """Профиль текущего пользователя: chat_id и сводка напоминаний. Почта не меняется"""
+
+    class Meta:
+        model = User
+        fields = ['email', 'chat_id', 'digest']
+        read_only_fields = ['email']
+
+
+class UserBulkSerializer(UserSerializer):
+    """Проверка элемента пачки пользователей: уникальность проверяется сразу для всей пачки, см. users.services"""
+
+    def get_fields(self):
+        fields = super().get_fields()
+        for field in fields.values():
+            field.validators = [validator for validator in field.validators
+                                if not isinstance(validator, UniqueValidator)]
+        return fields
@@ -0,0 +1,120 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+
+from users.models import User
+from users.serializers import UserBulkSerializer
+
+UNIQUE_FIELDS = ('email', 'chat_id')
+CONFLICT_MESSAGE = 'Почту или chat_id пачки заняли во время создания, повторите загрузку.'
+INVALID_ROW_MESSAGE = 'Строка не является объектом JSON'
+
+
+def unique_error_message(field_name):
+    """Сообщение о занятом значении, как у UniqueValidator сериализатора"""
+    field = User._meta.get_field(field_name)
+    return field.error_messages['unique'] % {'model_name': User._meta.verbose_name, 'field_label': field.verbose_name}
+
+
+@contextmanager
+def password_hasher(workers=None):
+    """
+    Функция хэширования списка паролей. PBKDF2 намеренно дорог, поэтому при workers > 1 пароли
+    хэшируются пулом процессов. Процессы запускаются через spawn: они не наследуют соединения
+    с базой и потоки веб-сервера, Django настраивается в каждом заново.
+    """
+    workers = settings.USER_PROVISION_WORKERS if workers is None else workers
+    if workers <= 1:
+        yield lambda passwords: [make_password(password) for password in passwords]
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'),
+                             initializer=django.setup) as executor:
+        yield lambda passwords: list(executor.map(make_password, passwords,
+                                                  chunksize=max(1, len(passwords) // (workers * 4))))
+
+
+def validate_user_rows(rows):
+    """
+    Проверка пачки пользователей: поля - по элементам, уникальность почты и chat_id - одним запросом
+    на всю пачку и между элементами пачки.
+    :return: проверенные данные (None для ошибочных) и ошибки по элементам.
+    """
+    validated, errors = [], []
+    for row in rows:
+        # нечитаемая строка файла, см. main.imports.parse_jsonl
+        if row is None:
+            validated.append(None)
+            errors.append({'non_field_errors': [INVALID_ROW_MESSAGE]})
+            continue
+        serializer = UserBulkSerializer(data=row)
+        if serializer.is_valid():
+            validated.append(serializer.validated_data)
+            errors.append({})
+        else:
+            validated.append(None)
+            errors.append(serializer.errors)
+
+    values = {field: {attrs[field] for attrs in validated if attrs is not None} for field in UNIQUE_FIELDS}
+    taken = {field: set() for field in UNIQUE_FIELDS}
+    for email, chat_id in User.objects.filter(Q(email__in=values['email']) | Q(chat_id__in=values['chat_id'])) \
+            .values_list('email', 'chat_id'):
+        taken['email'].add(email)
+        taken['chat_id'].add(chat_id)
+
+    seen = {field: set() for field in UNIQUE_FIELDS}
+    for index, attrs in enumerate(validated):
+        if attrs is None:
+            continue
+        item_errors = {}
+        for field in UNIQUE_FIELDS:
+            if attrs[field] in taken[field]:
+                item_errors[field] = [unique_error_message(field)]
+            elif attrs[field] in seen[field]:
+                item_errors[field] = ['Значение повторяется в запросе.']
+            seen[field].add(attrs[field])
+        if item_errors:
+            validated[index] = None
+            errors[index] = item_errors
+    return validated, errors
+
+
+def create_users(validated, hash_passwords):
+    """
+    Создание проверенных пользователей одним bulk_create, хэши паролей считаются пачкой.
+    :param hash_passwords: функция из password_hasher.
+    """
+    passwords = hash_passwords([attrs['password'] for attrs in validated])
+    users = [
+        User(email=attrs['email'], chat_id=attrs['chat_id'], digest=attrs.get('digest', False),
+             password=password, is_staff=False, is_superuser=False, is_active=True)
+        for attrs, password in zip(validated, passwords)
+    ]
+    with transaction.atomic():
+        return User.objects.bulk_create(users)
+
+
+def provision_users(rows, hash_passwords):
+    """
+    Создание пачки пользователей: ошибочные элементы пропускаются. Если почту или chat_id заняли
+    между проверкой и вставкой, пачка проверяется и вставляется еще раз. Если не удалось и во второй раз,
+    пачка не создается, а ее элементы возвращаются с ошибкой: следующие пачки создаются как обычно.
+    :return: созданные пользователи и ошибки по элементам.
+    """
+    validated, errors = validate_user_rows(rows)
+    try:
+        return create_users([attrs for attrs in validated if attrs is not None], hash_passwords), errors
+    except IntegrityError:
+        pass
+
+    validated, errors = validate_user_rows(rows)
+    try:
+        return create_users([attrs for attrs in validated if attrs is not None], hash_passwords), errors
+    except IntegrityError:
+        return [], [item_errors or {'non_field_errors': [CONFLICT_MESSAGE]} for item_errors in errors]
@@ -1,6 +1,22 @@
+import tempfile
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+
+from django.contrib.auth.hashers import check_password
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from main.models import UsefulHabit
+from users.authentication import user_cache, user_values_key, user_version
 from users.models import User
+from users.services import CONFLICT_MESSAGE, INVALID_ROW_MESSAGE, password_hasher, provision_users
 
 
 class UsersTestCase(APITestCase):
@@ -50,5 +66,198 @@ class UsersTestCase(APITestCase):
             True
         )
 
+    def test_update_profile_digest(self):
+        """Сводку напоминаний можно включить после регистрации, почта не меняется"""
+        user = User.objects.create(email='profile@test.ru', password='test', chat_id=159482674)
+        self.client.force_authenticate(user=user)
+
+        response = self.client.patch('/users/profile/', data={'digest': True, 'email': 'other@test.ru'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'email': 'profile@test.ru', 'chat_id': 159482674, 'digest': True})
+        user.refresh_from_db()
+        self.assertEqual((user.email, user.digest), ('profile@test.ru', True))
+
     def tearDown(self):
         User.objects.all().delete()
+
+
+@override_settings(USER_AUTH_CACHE_SIZE=100)
+class CachedJWTAuthenticationTestCase(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        user_cache.clear()
+        self.user = User.objects.create(email='owner@test.ru', chat_id=7100)
+        self.user.set_password('secret')
+        self.user.save()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+
+    def user_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/list/')
+        return response, [query for query in queries if 'FROM "users_user"' in query['sql']]
+
+    def test_warm_cache_no_queries(self):
+        """Со второго запроса пользователь берется из кэша, запросов аутентификации нет"""
+        response, queries = self.user_queries()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(queries), 1)
+
+        response, queries = self.user_queries()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(queries, [])
+
+        # другой процесс: кэш процесса пуст, пользователь берется из общего кэша
+        user_cache.clear()
+        self.assertEqual(self.user_queries()[1], [])
+
+    def test_password_not_cached(self):
+        """Хэш пароля не попадает в общий кэш"""
+        self.user_queries()
+
+        values, _ = cache.get(user_values_key(self.user.id, user_version(self.user.id)))
+        self.assertNotIn(self.user.password, values)
+
+    @mock.patch('main.tasks.sync_habit_schedule.apply_async')
+    def test_invalidated_on_save(self, apply_async):
+        """Отключение, смена пароля и новая версия привычек сбрасывают пользователя в кэше"""
+        self.user_queries()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.set_password('changed')
+            self.user.save()
+        self.assertEqual(len(self.user_queries()[1]), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            UsefulHabit.objects.create(title='Привычка', location='Дом', action='Зарядка', owner=self.user)
+        response, queries = self.user_queries()
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(response.data['count'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        response, queries = self.user_queries()
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_bounded(self):
+        """Кэш процесса не больше USER_AUTH_CACHE_SIZE записей"""
+        with self.settings(USER_AUTH_CACHE_SIZE=1):
+            self.user_queries()
+            other = User.objects.create(email='other@test.ru', chat_id=7101)
+            self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(other)}')
+            self.user_queries()
+        self.assertEqual(list(user_cache._entries), [other.id])
+
+
+@override_settings(USER_PROVISION_WORKERS=1)
+class UserProvisionTestCase(APITestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create(email='admin@test.ru', chat_id=7200, is_staff=True)
+        User.objects.create(email='taken@test.ru', chat_id=7201)
+        self.client.force_authenticate(user=self.admin)
+
+    def test_create_user_single_write(self):
+        """Пользователь записывается одним запросом, пароль уже захэширован"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/users/create/', data={'email': 'new@test.ru', 'chat_id': 7202,
+                                                                'password': 'secret'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        writes = [query for query in queries if query['sql'].startswith(('INSERT', 'UPDATE'))]
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(User.objects.get(email='new@test.ru').check_password('secret'))
+
+    def test_bulk_create(self):
+        """Пачка проверяется и записывается за постоянное количество запросов"""
+        rows = [{'email': f'user{i}@test.ru', 'chat_id': 7300 + i, 'password': f'secret{i}'} for i in range(10)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/users/bulk/', data=rows, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # проверка уникальности и вставка, без точек сохранения транзакции
+        self.assertEqual([query['sql'].split()[0] for query in queries if 'SAVEPOINT' not in query['sql']],
+                         ['SELECT', 'INSERT'])
+        self.assertEqual([user['email'] for user in response.json()], [row['email'] for row in rows])
+        self.assertTrue(User.objects.get(email='user3@test.ru').check_password('secret3'))
+
+    def test_bulk_create_errors(self):
+        """Занятые и повторяющиеся почта и chat_id - ошибки по элементам, никто не создается"""
+        response = self.client.post('/users/bulk/', data=[
+            {'email': 'one@test.ru', 'chat_id': 7400, 'password': 'x'},
+            {'email': 'taken@test.ru', 'chat_id': 7401, 'password': 'x'},
+            {'email': 'two@test.ru', 'chat_id': 7400, 'password': 'x'},
+            {'email': 'three@test.ru', 'password': 'x'},
+        ], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), [
+            {},
+            {'email': ['пользователь с таким почта уже существует.']},
+            {'chat_id': ['Значение повторяется в запросе.']},
+            {'chat_id': ['Обязательное поле.']},
+        ])
+        self.assertFalse(User.objects.filter(email='one@test.ru').exists())
+
+    def test_bulk_create_size_and_no_pool(self):
+        """Эндпоинт не запускает пул процессов, большие пачки отклоняются"""
+        rows = [{'email': f'user{i}@test.ru', 'chat_id': 7300 + i, 'password': 'x'} for i in range(3)]
+        with mock.patch('users.services.ProcessPoolExecutor') as executor:
+            response = self.client.post('/users/bulk/', data=rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        executor.assert_not_called()
+
+        with self.settings(USER_PROVISION_MAX_SIZE=2):
+            response = self.client.post('/users/bulk/', data=rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_provision_repeated_conflict(self):
+        """Повторная гонка при вставке не прерывает загрузку: элементы пачки возвращаются с ошибкой"""
+        rows = [{'email': 'a@test.ru', 'chat_id': 7600, 'password': 'x'},
+                {'email': 'taken@test.ru', 'chat_id': 7601, 'password': 'x'}]
+        with mock.patch('users.services.create_users', side_effect=IntegrityError):
+            users, errors = provision_users(rows, lambda passwords: passwords)
+
+        self.assertEqual(users, [])
+        self.assertEqual(errors[0], {'non_field_errors': [CONFLICT_MESSAGE]})
+        self.assertEqual(list(errors[1]), ['email'])
+
+    def test_bulk_create_admin_only(self):
+        self.client.force_authenticate(user=User.objects.get(email='taken@test.ru'))
+        response = self.client.post('/users/bulk/', data=[{'email': 'x@test.ru', 'chat_id': 1, 'password': 'x'}],
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_password_hasher_pool(self):
+        """Хэши пула процессов принимаются check_password"""
+        with password_hasher(workers=2) as hash_passwords:
+            hashes = hash_passwords(['first', 'second'])
+        self.assertTrue(check_password('second', hashes[1]))
+
+    def test_provision_command_invalid_jsonl(self):
+        """Нечитаемая строка JSONL - ошибка записи, остальные пользователи создаются"""
+        path = Path(tempfile.mkdtemp()) / 'users.jsonl'
+        path.write_text('{"email": "a@test.ru", "chat_id": 7510, "password": "x"}\n'
+                        '{"email": "broken@test.ru", \n'
+                        '{"email": "b@test.ru", "chat_id": 7512, "password": "x"}\n', encoding='utf-8')
+
+        stderr = StringIO()
+        call_command('provision_users', str(path), '--chunk-size', '2', stdout=StringIO(), stderr=stderr)
+
+        self.assertEqual(sorted(User.objects.filter(chat_id__gte=7510).values_list('email', flat=True)),
+                         ['a@test.ru', 'b@test.ru'])
+        self.assertIn(f'Запись 2: {{"non_field_errors": ["{INVALID_ROW_MESSAGE}"]}}', stderr.getvalue())
+
+    def test_provision_command(self):
+        """Команда создает пользователей пачками и пропускает ошибочные записи"""
+        path = Path(tempfile.mkdtemp()) / 'users.csv'
+        path.write_text('email,chat_id,password,digest\n'
+                        'a@test.ru,7500,x,true\n'
+                        'taken@test.ru,7501,x,false\n'
+                        'b@test.ru,7502,x,false\n', encoding='utf-8')
+
+        call_command('provision_users', str(path), '--chunk-size', '2', stdout=StringIO(), stderr=StringIO())
+
+        self.assertEqual(sorted(User.objects.filter(chat_id__gte=7500).values_list('email', 'digest')),
+                         [('a@test.ru', True), ('b@test.ru', False)])
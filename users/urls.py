@@ -1,7 +1,7 @@
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from django.urls import path
 
-from users.views import UserCreateAPIView
+from users.views import UserCreateAPIView, UserBulkCreateAPIView, UserProfileAPIView
 
 from users.apps import UsersConfig
 
@@ -9,6 +9,8 @@ app_name = UsersConfig.name
 
 urlpatterns = [
     path('create/', UserCreateAPIView.as_view(), name='create'),
+    path('bulk/', UserBulkCreateAPIView.as_view(), name='bulk_create'),
+    path('profile/', UserProfileAPIView.as_view(), name='profile'),
 
     path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
@@ -1,6 +1,12 @@
-from rest_framework import generics
-from rest_framework.permissions import AllowAny
-from users.serializers import UserSerializer
+from django.conf import settings
+from django.db import IntegrityError
+from rest_framework import generics, status
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
+from rest_framework.response import Response
+from users.models import User
+from users.serializers import UserProfileSerializer, UserSerializer
+from users.services import create_users, password_hasher, validate_user_rows
 
 
 class UserCreateAPIView(generics.CreateAPIView):
@@ -8,3 +14,49 @@ class UserCreateAPIView(generics.CreateAPIView):
 
     serializer_class = UserSerializer
     permission_classes = [AllowAny]
+
+
+class UserProfileAPIView(generics.RetrieveUpdateAPIView):
+    """
+    Профиль текущего пользователя, в том числе включение сводки напоминаний digest.
+    Пользователь читается из базы, а не из кэша аутентификации: сохранение копии из кэша
+    вернуло бы устаревшие значения остальных полей.
+    """
+    serializer_class = UserProfileSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_object(self):
+        return User.objects.get(pk=self.request.user.pk)
+
+
+class UserBulkCreateAPIView(generics.GenericAPIView):
+    """
+    Массовое создание пользователей администратором. Почта и chat_id проверяются одним запросом на пачку,
+    пользователи записываются одной вставкой. Пароли хэшируются в процессе запроса, без пула процессов,
+    поэтому пачка не больше USER_PROVISION_MAX_SIZE, большие файлы загружаются командой provision_users.
+    Если хоть один элемент с ошибкой, никто не создается, ошибки возвращаются по элементам.
+    """
+    serializer_class = UserSerializer
+    permission_classes = [IsAdminUser]
+
+    def post(self, request, *args, **kwargs):
+        rows = request.data
+        if not isinstance(rows, list) or not rows:
+            raise ValidationError({'non_field_errors': ['Ожидается непустой список.']})
+        if len(rows) > settings.USER_PROVISION_MAX_SIZE:
+            raise ValidationError({'non_field_errors': [
+                f'В одном запросе не больше {settings.USER_PROVISION_MAX_SIZE} элементов, '
+                f'большие пачки загружаются командой provision_users.'
+            ]})
+
+        validated, errors = validate_user_rows(rows)
+        if any(errors):
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            with password_hasher(workers=1) as hash_passwords:
+                users = create_users(validated, hash_passwords)
+        except IntegrityError:
+            # почту или chat_id заняли после проверки
+            return Response(validate_user_rows(rows)[1], status=status.HTTP_400_BAD_REQUEST)
+        return Response(self.get_serializer(users, many=True).data, status=status.HTTP_201_CREATED)